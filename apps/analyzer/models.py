@@ -1,6 +1,8 @@
+import re
 import datetime
+import threading
 import mongoengine as mongo
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from django.db import models
 from django.contrib.auth.models import User
 from django.template.loader import render_to_string
@@ -10,6 +12,9 @@ from apps.rss_feeds.models import Feed
 from apps.analyzer.tasks import EmailPopularityQuery
 from utils import log as logging
 
+# Compiled ClassifierMatchers kept per process, keyed by their classifiers.
+CLASSIFIER_MATCHER_CACHE_SIZE = 256
+
 class FeatureCategory(models.Model):
     user = models.ForeignKey(User)
     feed = models.ForeignKey(Feed)
@@ -238,6 +243,123 @@ def apply_classifier_feeds(classifiers, feed, social_user_ids=None):
             return classifier.score
     return 0
     
+class ClassifierMatcher(object):
+    """ Title, author and tag classifiers compiled for scoring many stories,
+        giving the same scores as apply_classifier_titles, _authors and _tags.
+        
+        Classifiers are grouped by feed up front, so a story only looks at its
+        own feed's. Authors and tags become dicts of the score the classifier
+        loop would settle on. Each feed's titles are lowercased once and
+        joined into one compiled pattern, which rules out most stories in a
+        single search before any title is checked on its own.
+        
+        ClassifierMatcher.for_classifiers() reuses a compiled matcher across
+        river pages and recounts that load the same classifiers.
+    """
+    
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+    
+    def __init__(self, classifier_titles=None, classifier_authors=None, classifier_tags=None):
+        self.titles = defaultdict(list)
+        for classifier in classifier_titles or []:
+            self.titles[classifier.feed_id].append((classifier.title.lower(), classifier.score))
+        self.title_patterns = {}
+        for feed_id, titles in self.titles.items():
+            try:
+                pattern = u'|'.join(re.escape(title) for title, _ in titles)
+                self.title_patterns[feed_id] = re.compile(pattern, re.UNICODE)
+            except (re.error, UnicodeDecodeError):
+                self.title_patterns[feed_id] = None
+        
+        # The first positive score for an author, otherwise its last score.
+        self.authors = defaultdict(dict)
+        for classifier in classifier_authors or []:
+            authors = self.authors[classifier.feed_id]
+            if authors.get(classifier.author, 0) <= 0:
+                authors[classifier.author] = classifier.score
+        
+        # Per tag, the (position, score) of its first positive classifier and
+        # of its last classifier, so stories with several tags can pick the
+        # one the classifier loop would have stopped on.
+        self.tag_classifiers = defaultdict(list)
+        self.tags = defaultdict(dict)
+        for position, classifier in enumerate(classifier_tags or []):
+            self.tag_classifiers[classifier.feed_id].append(classifier)
+            first_positive, _ = self.tags[classifier.feed_id].get(classifier.tag, (None, None))
+            if not first_positive and classifier.score > 0:
+                first_positive = (position, classifier.score)
+            self.tags[classifier.feed_id][classifier.tag] = (first_positive, (position, classifier.score))
+    
+    @classmethod
+    def for_classifiers(cls, classifier_titles=None, classifier_authors=None, classifier_tags=None):
+        key = (tuple((c.feed_id, c.title, c.score) for c in classifier_titles or []),
+               tuple((c.feed_id, c.author, c.score) for c in classifier_authors or []),
+               tuple((c.feed_id, c.tag, c.score) for c in classifier_tags or []))
+        with cls._cache_lock:
+            matcher = cls._cache.pop(key, None)
+            if matcher:
+                cls._cache[key] = matcher
+                return matcher
+        
+        matcher = cls(classifier_titles, classifier_authors, classifier_tags)
+        with cls._cache_lock:
+            cls._cache[key] = matcher
+            while len(cls._cache) > CLASSIFIER_MATCHER_CACHE_SIZE:
+                cls._cache.popitem(last=False)
+        
+        return matcher
+    
+    def score_titles(self, story):
+        titles = self.titles.get(story['story_feed_id'])
+        if not titles:
+            return 0
+        story_title = story['story_title'].lower()
+        pattern = self.title_patterns[story['story_feed_id']]
+        if pattern and not pattern.search(story_title):
+            return 0
+        
+        score = 0
+        for title, title_score in titles:
+            if title in story_title:
+                score = title_score
+                if score > 0: return score
+        return score
+    
+    def score_authors(self, story):
+        authors = self.authors.get(story['story_feed_id'])
+        if not authors or not story.get('story_authors'):
+            return 0
+        return authors.get(story['story_authors'], 0)
+    
+    def score_tags(self, story):
+        tags = self.tags.get(story['story_feed_id'])
+        if not tags or not story['story_tags']:
+            return 0
+        if isinstance(story['story_tags'], basestring):
+            return apply_classifier_tags(self.tag_classifiers[story['story_feed_id']], story)
+        
+        first_positive = last = None
+        for tag in set(story['story_tags']):
+            if tag not in tags:
+                continue
+            tag_first_positive, tag_last = tags[tag]
+            if tag_first_positive and (not first_positive or tag_first_positive[0] < first_positive[0]):
+                first_positive = tag_first_positive
+            if not last or tag_last[0] > last[0]:
+                last = tag_last
+        if first_positive:
+            return first_positive[1]
+        return last[1] if last else 0
+    
+    def score(self, story):
+        """ The author, tags and title scores for a story's intelligence. """
+        return {
+            'author': self.score_authors(story),
+            'tags': self.score_tags(story),
+            'title': self.score_titles(story),
+        }
+    
 def get_classifiers_for_user(user, feed_id=None, social_user_id=None, classifier_feeds=None, classifier_authors=None, 
                              classifier_titles=None, classifier_tags=None):
     params = dict(user_id=user.pk)
@@ -277,6 +399,34 @@ def get_classifiers_for_user(user, feed_id=None, social_user_id=None, classifier
     
     return payload
     
+def load_classifiers_for_feed(feed_id, user_ids):
+    """ Every classifier a set of users has on one feed, in one query per
+        classifier type, grouped by user as
+        {user_id: {'feeds': [...], 'authors': [...], 'titles': [...], 'tags': [...]}}.
+        Users without classifiers get empty lists.
+    """
+    classifiers = dict((user_id, dict(feeds=[], authors=[], titles=[], tags=[]))
+                       for user_id in user_ids)
+    if not classifiers:
+        return classifiers
+    
+    params = dict(feed_id=feed_id)
+    user_ids = classifiers.keys()
+    if len(user_ids) == 1:
+        params['user_id'] = user_ids[0]
+    else:
+        params['user_id__in'] = user_ids
+    
+    for key, classifier_cls in (('feeds', MClassifierFeed),
+                                ('authors', MClassifierAuthor),
+                                ('titles', MClassifierTitle),
+                                ('tags', MClassifierTag)):
+        query = dict(params, social_user_id=0) if key == 'feeds' else params
+        for classifier in classifier_cls.objects(**query):
+            classifiers[classifier.user_id][key].append(classifier)
+    
+    return classifiers
+    
 def sort_classifiers_by_feed(user, feed_ids=None,
                              classifier_feeds=None,
                              classifier_authors=None,
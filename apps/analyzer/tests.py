@@ -8,6 +8,8 @@ from itertools import groupby
 from apps.analyzer.tokenizer import Tokenizer
 from vendor.reverend.thomas import Bayes
 from apps.analyzer.phrase_filter import PhraseFilter
+from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierTag, ClassifierMatcher
+from apps.analyzer.models import apply_classifier_titles, apply_classifier_authors, apply_classifier_tags
 
 
 class QuadgramCollocationFinder(nltk.collocations.AbstractCollocationFinder):
@@ -196,4 +198,38 @@ class ClassifierTest(TestCase):
         guess = classifier.guess('Nothing doing: 393 Pacific St.')
         self.assertTrue('bad' not in guess)
         self.assertTrue('good' not in guess)
-        
\ No newline at end of file
+        
+
+
+class ClassifierMatcherTest(TestCase):
+    
+    def test_matches_apply_classifiers(self):
+        titles = [MClassifierTitle(feed_id=1, title='Day', score=-1),
+                  MClassifierTitle(feed_id=1, title='house of', score=1),
+                  MClassifierTitle(feed_id=1, title='watch', score=-1),
+                  MClassifierTitle(feed_id=2, title='pacific', score=1)]
+        authors = [MClassifierAuthor(feed_id=1, author='Alice', score=-1),
+                   MClassifierAuthor(feed_id=1, author='Bob', score=1),
+                   MClassifierAuthor(feed_id=1, author='Alice', score=1)]
+        tags = [MClassifierTag(feed_id=1, tag='condos', score=-1),
+                MClassifierTag(feed_id=1, tag='brooklyn', score=-1),
+                MClassifierTag(feed_id=1, tag='parks', score=1),
+                MClassifierTag(feed_id=2, tag='condos', score=1)]
+        stories = [
+            dict(story_feed_id=1, story_title='House of the Day: 393 Pacific St.',
+                 story_authors='Alice', story_tags=['condos', 'parks']),
+            dict(story_feed_id=1, story_title='Development Watch: Yatta',
+                 story_authors='Carol', story_tags=['brooklyn', 'condos']),
+            dict(story_feed_id=1, story_title='Streetlevel', story_authors='', story_tags=[]),
+            dict(story_feed_id=2, story_title='393 Pacific St.', story_authors='Alice',
+                 story_tags=['condos']),
+            dict(story_feed_id=3, story_title='House of the Day', story_authors='Bob',
+                 story_tags=['parks']),
+        ]
+        
+        matcher = ClassifierMatcher.for_classifiers(titles, authors, tags)
+        self.assertTrue(ClassifierMatcher.for_classifiers(titles, authors, tags) is matcher)
+        for story in stories:
+            self.assertEquals(matcher.score_titles(story), apply_classifier_titles(titles, story))
+            self.assertEquals(matcher.score_authors(story), apply_classifier_authors(authors, story))
+            self.assertEquals(matcher.score_tags(story), apply_classifier_tags(tags, story))
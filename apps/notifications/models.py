@@ -11,8 +11,7 @@ from django.core.mail import EmailMultiAlternatives
 # from django.utils.html import strip_tags
 from apps.rss_feeds.models import MStory, Feed
 from apps.reader.models import UserSubscription
-from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierFeed, MClassifierTag
-from apps.analyzer.models import compute_story_score
+from apps.analyzer.models import compute_story_score, load_classifiers_for_feed
 from utils.story_functions import truncate_chars
 from utils import log as logging
 from utils import mongoengine_fields
@@ -128,15 +127,19 @@ class MUserFeedNotification(mongo.Document):
         stories = Feed.format_stories(mstories)
         total_sent_count = 0
         
+        usersubs = UserSubscription.objects.filter(user__in=[n.user_id for n in notifications],
+                                                   feed=feed.pk)
+        usersubs = dict((usersub.user_id, usersub) for usersub in usersubs)
+        feed_classifiers = load_classifiers_for_feed(feed.pk, [usersub.user_id for usersub in usersubs.values()
+                                                               if usersub.is_trained])
+        
         for user_feed_notification in notifications:
             sent_count = 0
             last_notification_date = user_feed_notification.last_notification_date
-            try:
-                usersub = UserSubscription.objects.get(user=user_feed_notification.user_id,
-                                                       feed=user_feed_notification.feed_id)
-            except UserSubscription.DoesNotExist:
+            usersub = usersubs.get(user_feed_notification.user_id)
+            if not usersub:
                 continue
-            classifiers = user_feed_notification.classifiers(usersub)
+            classifiers = feed_classifiers.get(usersub.user_id, {})
 
             if classifiers == None:
                 logging.debug("Has no usersubs")
@@ -165,11 +168,7 @@ class MUserFeedNotification(mongo.Document):
     def classifiers(self, usersub):
         classifiers = {}
         if usersub.is_trained:
-            classifiers['feeds']   = list(MClassifierFeed.objects(user_id=self.user_id, feed_id=self.feed_id,
-                                                                 social_user_id=0))
-            classifiers['authors'] = list(MClassifierAuthor.objects(user_id=self.user_id, feed_id=self.feed_id))
-            classifiers['titles']  = list(MClassifierTitle.objects(user_id=self.user_id, feed_id=self.feed_id))
-            classifiers['tags']    = list(MClassifierTag.objects(user_id=self.user_id, feed_id=self.feed_id))
+            classifiers = load_classifiers_for_feed(self.feed_id, [self.user_id])[self.user_id]
             
         return classifiers
     
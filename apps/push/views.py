@@ -39,11 +39,10 @@ def push_callback(request, push_id):
         return HttpResponse(challenge, content_type='text/plain')
     elif request.method == 'POST':
         subscription = get_object_or_404(PushSubscription, pk=push_id)
-        fetch_history = MFetchHistory.feed(subscription.feed_id)
+        push_history = MFetchHistory.history(subscription.feed_id, 'push')
         latest_push_date_delta = None
-        if fetch_history and fetch_history.get('push_history'):
-            latest_push = fetch_history['push_history'][0]['push_date']
-            latest_push_date = datetime.datetime.strptime(latest_push, '%Y-%m-%d %H:%M:%S')
+        if push_history:
+            latest_push_date = push_history[0][0]
             latest_push_date_delta = datetime.datetime.now() - latest_push_date
             if latest_push_date > datetime.datetime.now() - datetime.timedelta(minutes=1):
                 logging.debug('   ---> [%-30s] ~SN~FBSkipping feed fetch, pushed %s seconds ago' % (unicode(subscription.feed)[:30], latest_push_date_delta.seconds))
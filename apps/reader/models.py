@@ -10,6 +10,7 @@ from utils import json_functions as json
 from django.db import models, IntegrityError
 from django.db.models import Q
 from django.db.models import Count
+from django.db.models import F
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
@@ -20,7 +21,8 @@ from apps.reader.managers import UserSubscriptionManager
 from apps.rss_feeds.models import Feed, MStory, DuplicateFeed
 from apps.rss_feeds.tasks import NewFeeds
 from apps.analyzer.models import MClassifierFeed, MClassifierAuthor, MClassifierTag, MClassifierTitle
-from apps.analyzer.models import apply_classifier_titles, apply_classifier_feeds, apply_classifier_authors, apply_classifier_tags
+from apps.analyzer.models import apply_classifier_feeds
+from apps.analyzer.models import load_classifiers_for_feed, ClassifierMatcher
 from apps.analyzer.tfidf import tfidf
 from utils.feed_functions import add_object_to_folder, chunks
 
@@ -33,6 +35,13 @@ class UserSubscription(models.Model):
     are not accurate and need to be calculated with `self.calculate_feed_scores()`.
     """
     UNREAD_CUTOFF = datetime.datetime.utcnow() - datetime.timedelta(days=settings.DAYS_OF_UNREAD)
+    # Unread counts are kept up to date as stories arrive and are read, and
+    # recounted from scratch when loaded if it's been this long since the last
+    # full count, a few subscriptions per load.
+    UNREAD_RECONCILE_HOURS = 24
+    UNREAD_RECONCILE_PER_LOAD = 10
+    # Subscriptions recounted together by each ComputeFeedScores task.
+    SCORE_BATCH_SIZE = 500
     
     user = models.ForeignKey(User, related_name='subscriptions')
     feed = models.ForeignKey(Feed, related_name='subscribers')
@@ -427,6 +436,8 @@ class UserSubscription(models.Model):
         if feed_ids:
             user_subs = user_subs.filter(feed__in=feed_ids)
         
+        reconcile_cutoff = datetime.datetime.now() - datetime.timedelta(hours=cls.UNREAD_RECONCILE_HOURS)
+        reconcile_count = 0
         for i, sub in enumerate(user_subs):
             # Count unreads if subscription is stale.
             if (force or 
@@ -434,6 +445,11 @@ class UserSubscription(models.Model):
                 sub.unread_count_updated < user.profile.unread_cutoff or 
                 sub.oldest_unread_story_date < user.profile.unread_cutoff):
                 sub = sub.calculate_feed_scores(silent=silent, force=force)
+            elif (sub.unread_count_updated < reconcile_cutoff and
+                  reconcile_count < cls.UNREAD_RECONCILE_PER_LOAD):
+                # Counts are kept incrementally, recount now and then in case they drifted.
+                reconcile_count += 1
+                sub = sub.calculate_feed_scores(silent=silent)
             if not sub: continue # TODO: Figure out the correct sub and give it a new feed_id
 
             feed_id = sub.feed_id
@@ -675,9 +691,9 @@ class UserSubscription(models.Model):
         if not request:
             request = self.user
     
-        if not self.needs_unread_recalc:
-            self.needs_unread_recalc = True
-            self.save(update_fields=['needs_unread_recalc'])
+        unread_story_hashes = self.unread_story_hashes_in(list(set(
+            MStory.ensure_story_hash(story_hash, story_feed_id=self.feed_id)
+            for story_hash in story_hashes)))
     
         if len(story_hashes) > 1:
             logging.user(request, "~FYRead %s stories in feed: %s" % (len(story_hashes), self.feed))
@@ -690,6 +706,7 @@ class UserSubscription(models.Model):
             RUserStory.mark_read(self.user_id, self.feed_id, story_hash, aggregated=aggregated)
             r.publish(self.user.username, 'story:read:%s' % story_hash)
 
+        self.adjust_unread_counts_for_stories(unread_story_hashes, sign=-1)
         r.publish(self.user.username, 'feed:%s' % self.feed_id)
         
         self.last_read_date = datetime.datetime.now()
@@ -718,7 +735,7 @@ class UserSubscription(models.Model):
         
         return data
         
-    def calculate_feed_scores(self, silent=False, stories=None, force=False):
+    def calculate_feed_scores(self, silent=False, stories=None, force=False, classifiers=None):
         # now = datetime.datetime.strptime("2009-07-06 22:30:03", "%Y-%m-%d %H:%M:%S")
         now = datetime.datetime.now()
         oldest_unread_story_date = now
@@ -780,44 +797,15 @@ class UserSubscription(models.Model):
             # if not silent:
             #     logging.info(' ---> [%s]    Format stories: %s' % (self.user, datetime.datetime.now() - now))
         
-            classifier_feeds   = list(MClassifierFeed.objects(user_id=self.user_id, feed_id=self.feed_id, social_user_id=0))
-            classifier_authors = list(MClassifierAuthor.objects(user_id=self.user_id, feed_id=self.feed_id))
-            classifier_titles  = list(MClassifierTitle.objects(user_id=self.user_id, feed_id=self.feed_id))
-            classifier_tags    = list(MClassifierTag.objects(user_id=self.user_id, feed_id=self.feed_id))
-            
-            if (not len(classifier_feeds) and 
-                not len(classifier_authors) and 
-                not len(classifier_titles) and 
-                not len(classifier_tags)):
+            if classifiers is None:
+                classifiers = self.load_classifiers()
+            if not any(classifiers.values()):
                 self.is_trained = False
             
             # if not silent:
             #     logging.info(' ---> [%s]    Classifiers: %s (%s)' % (self.user, datetime.datetime.now() - now, classifier_feeds.count() + classifier_authors.count() + classifier_tags.count() + classifier_titles.count()))
             
-            scores = {
-                'feed': apply_classifier_feeds(classifier_feeds, self.feed),
-            }
-        
-            for story in unread_stories:
-                scores.update({
-                    'author' : apply_classifier_authors(classifier_authors, story),
-                    'tags'   : apply_classifier_tags(classifier_tags, story),
-                    'title'  : apply_classifier_titles(classifier_titles, story),
-                })
-            
-                max_score = max(scores['author'], scores['tags'], scores['title'])
-                min_score = min(scores['author'], scores['tags'], scores['title'])
-                if max_score > 0:
-                    feed_scores['positive'] += 1
-                elif min_score < 0:
-                    feed_scores['negative'] += 1
-                else:
-                    if scores['feed'] > 0:
-                        feed_scores['positive'] += 1
-                    elif scores['feed'] < 0:
-                        feed_scores['negative'] += 1
-                    else:
-                        feed_scores['neutral'] += 1
+            feed_scores = self.count_story_scores(unread_stories, classifiers)
         else:
             # print " ---> Cutoff date: %s" % date_delta
             unread_story_hashes = self.story_hashes(user_id=self.user_id, feed_ids=[self.feed_id],
@@ -862,6 +850,186 @@ class UserSubscription(models.Model):
         
         return self
     
+    @classmethod
+    def stories_for_scoring(cls, feed):
+        """ The feed's stories in the unread window, formatted for scoring and
+            cached for a minute under S:<feed_id>, which calculate_feed_scores
+            reads. Stories the secondaries haven't caught up on yet are read
+            from the primary.
+        """
+        stories = cache.get('S:%s' % feed.pk)
+        if stories is not None:
+            return stories
+        
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        stories = MStory.objects(story_feed_id=feed.pk,
+                                 story_date__gte=feed.unread_cutoff)
+        stories = Feed.format_stories(stories, feed.pk)
+        story_hashes = r.zrangebyscore('zF:%s' % feed.pk, int(feed.unread_cutoff.strftime('%s')),
+                                       int(time.time() + 60*60*24))
+        missing_story_hashes = set(story_hashes) - set([s['story_hash'] for s in stories])
+        if missing_story_hashes:
+            missing_stories = MStory.objects(story_feed_id=feed.pk,
+                                             story_hash__in=missing_story_hashes)\
+                                    .read_preference(pymongo.ReadPreference.PRIMARY)
+            missing_stories = Feed.format_stories(missing_stories, feed.pk)
+            stories = missing_stories + stories
+            logging.debug(u'   ---> [%-30s] ~FYFound ~SB~FC%s(of %s)/%s~FY~SN un-secondaried stories while computing scores' % (feed.log_title[:30], len(missing_stories), len(missing_story_hashes), len(stories)))
+        cache.set("S:%s" % feed.pk, stories, 60)
+        
+        return stories
+    
+    @classmethod
+    def calculate_feed_scores_for_subs(cls, feed_id, user_sub_ids, silent=True):
+        """ Recounts a batch of subscriptions to one feed that are flagged
+            with needs_unread_recalc. The feed's stories are loaded once and
+            the classifiers of every trained subscriber come from one query
+            per classifier type, rather than four queries per subscription.
+        """
+        feed = Feed.get_by_id(feed_id)
+        if not feed:
+            return
+        user_subs = list(cls.objects.select_related('user').filter(pk__in=user_sub_ids,
+                                                                   needs_unread_recalc=True))
+        if not user_subs:
+            return
+        
+        stories = cls.stories_for_scoring(feed)
+        classifiers = load_classifiers_for_feed(feed.pk, [sub.user_id for sub in user_subs
+                                                          if sub.is_trained])
+        for sub in user_subs:
+            sub.feed = feed
+            sub.calculate_feed_scores(silent=silent, stories=stories,
+                                      classifiers=classifiers.get(sub.user_id))
+    
+    def load_classifiers(self):
+        return load_classifiers_for_feed(self.feed_id, [self.user_id])[self.user_id]
+    
+    def count_story_scores(self, stories, classifiers=None):
+        """ How many of `stories` are positive, neutral and negative for this
+            subscription. Without classifiers every story is neutral.
+        """
+        feed_scores = dict(negative=0, neutral=0, positive=0)
+        if not classifiers:
+            feed_scores['neutral'] = len(stories)
+            return feed_scores
+        
+        feed_score = apply_classifier_feeds(classifiers['feeds'], int(self.feed_id))
+        matcher = ClassifierMatcher.for_classifiers(classifiers['titles'], classifiers['authors'],
+                                                    classifiers['tags'])
+        for story in stories:
+            scores = matcher.score(story)
+            scores['feed'] = feed_score
+            score = self.score_story(scores)
+            if score > 0:
+                feed_scores['positive'] += 1
+            elif score < 0:
+                feed_scores['negative'] += 1
+            else:
+                feed_scores['neutral'] += 1
+        
+        return feed_scores
+    
+    @classmethod
+    def adjust_unread_counts(cls, usersubs, feed_scores, sign=1):
+        """ Adds `feed_scores` to the unread counts of every subscription in
+            the `usersubs` queryset in one UPDATE, or takes them away with
+            sign=-1, never going below zero. Doesn't touch unread_count_updated,
+            which stays the time of the last full count.
+        """
+        updates = {}
+        for score in ('positive', 'neutral', 'negative'):
+            if feed_scores.get(score):
+                field = 'unread_count_%s' % score
+                updates[field] = F(field) + sign * feed_scores[score]
+        if not updates:
+            return
+        
+        usersubs.update(**updates)
+        if sign < 0:
+            for field in updates:
+                usersubs.filter(**{'%s__lt' % field: 0}).update(**{field: 0})
+    
+    @classmethod
+    def add_unread_stories(cls, feed, stories):
+        """ Counts newly fetched `stories` into the unread counts of the
+            feed's subscriptions, scoring them for trained subscriptions.
+            Returns the subscriptions that couldn't be counted this way and
+            need a full recount: ones already flagged, ones marked read past
+            the oldest of the stories, and all of them when a story is older
+            than the unread cutoff.
+        """
+        user_subs = cls.objects.filter(feed=feed, 
+                                       active=True,
+                                       user__profile__last_seen_on__gte=feed.unread_cutoff)
+        unread_cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=settings.DAYS_OF_UNREAD_FREE)
+        if not stories or min(s.story_date for s in stories) < unread_cutoff:
+            return user_subs
+        
+        oldest_story_date = min(s.story_date for s in stories)
+        countable_subs = user_subs.filter(needs_unread_recalc=False, 
+                                          mark_read_date__lt=oldest_story_date)
+        
+        untrained_subs = countable_subs.filter(is_trained=False)
+        cls.adjust_unread_counts(untrained_subs, dict(neutral=len(stories)))
+        untrained_subs.filter(oldest_unread_story_date__gt=oldest_story_date)\
+                      .update(oldest_unread_story_date=oldest_story_date)
+        
+        trained_subs = list(countable_subs.filter(is_trained=True))
+        if trained_subs:
+            formatted_stories = Feed.format_stories(stories, feed.pk)
+            classifiers = load_classifiers_for_feed(feed.pk, [sub.user_id for sub in trained_subs])
+        for sub in trained_subs:
+            feed_scores = sub.count_story_scores(formatted_stories, classifiers[sub.user_id])
+            sub_query = cls.objects.filter(pk=sub.pk)
+            cls.adjust_unread_counts(sub_query, feed_scores)
+            sub_query.filter(oldest_unread_story_date__gt=oldest_story_date)\
+                     .update(oldest_unread_story_date=oldest_story_date)
+        
+        return user_subs.filter(Q(needs_unread_recalc=True) | 
+                                Q(mark_read_date__gte=oldest_story_date))
+    
+    def unread_story_hashes_in(self, story_hashes, r=None):
+        """ The subset of `story_hashes` counted as unread right now: not read,
+            and newer than both mark_read_date and the user's unread cutoff.
+        """
+        if not story_hashes:
+            return []
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        
+        read_date = int(max(self.mark_read_date, self.user.profile.unread_cutoff).strftime('%s'))
+        read_stories_key = 'RS:%s:%s' % (self.user_id, self.feed_id)
+        sorted_stories_key = 'zF:%s' % self.feed_id
+        p = r.pipeline()
+        for story_hash in story_hashes:
+            p.sismember(read_stories_key, story_hash)
+            p.zscore(sorted_stories_key, story_hash)
+        results = p.execute()
+        
+        return [story_hash for story_hash, is_read, timestamp
+                in zip(story_hashes, results[0::2], results[1::2])
+                if not is_read and timestamp is not None and timestamp >= read_date]
+    
+    def adjust_unread_counts_for_stories(self, story_hashes, sign=-1):
+        """ Takes story hashes that were just read (or, with sign=1, marked
+            unread) out of (or back into) the unread counts. A subscription
+            that's waiting on a full recount is left to it.
+        """
+        if not story_hashes or self.needs_unread_recalc:
+            return
+        
+        classifiers = None
+        stories = story_hashes
+        if self.is_trained:
+            classifiers = self.load_classifiers()
+            stories = Feed.format_stories(MStory.objects(story_hash__in=story_hashes), self.feed_id)
+        feed_scores = self.count_story_scores(stories, classifiers)
+        UserSubscription.adjust_unread_counts(UserSubscription.objects.filter(pk=self.pk), feed_scores, sign=sign)
+        for score in ('positive', 'neutral', 'negative'):
+            field = 'unread_count_%s' % score
+            setattr(self, field, max(0, getattr(self, field) + sign * feed_scores[score]))
+    
     @staticmethod
     def score_story(scores):
         max_score = max(scores['author'], scores['tags'], scores['title'])
@@ -32,15 +32,25 @@ class FreshenHomepage(Task):
             sub.save()
             sub.calculate_feed_scores(silent=True)
 
+class ComputeFeedScores(Task):
+    name = 'compute-feed-scores'
+    max_retries = 0
+    ignore_result = True
+    time_limit = 5*60
+    soft_time_limit = 4*60
+
+    def run(self, feed_id, user_sub_ids, **kwargs):
+        UserSubscription.calculate_feed_scores_for_subs(feed_id, user_sub_ids)
+
 class CleanAnalytics(Task):
     name = 'clean-analytics'
     hard = 720*10
 
     def run(self, **kwargs):
-        logging.debug(" ---> Cleaning analytics... %s feed fetches" % (
-            settings.MONGOANALYTICSDB.nbanalytics.feed_fetches.count(),
+        logging.debug(" ---> Cleaning analytics... %s minutes of feed fetches" % (
+            settings.MONGOANALYTICSDB.nbanalytics.feed_fetch_minutes.count(),
         ))
         day_ago = datetime.datetime.utcnow() - datetime.timedelta(days=1)
-        settings.MONGOANALYTICSDB.nbanalytics.feed_fetches.delete_many({
+        settings.MONGOANALYTICSDB.nbanalytics.feed_fetch_minutes.delete_many({
             "date": {"$lt": day_ago},
         })
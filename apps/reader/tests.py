@@ -1,9 +1,15 @@
+import datetime
+import redis
 from utils import json_functions as json
 from django.test.client import Client
 from django.test import TestCase
 from django.core.urlresolvers import reverse
+from django.core.cache import cache
 from django.conf import settings
 from mongoengine.connection import connect, disconnect
+from apps.reader.models import UserSubscription
+from apps.rss_feeds.models import Feed, MStory
+from apps.analyzer.models import MClassifierTitle
 
 class ReaderTest(TestCase):
     fixtures = ['../../rss_feeds/fixtures/rss_feeds.json', 
@@ -127,4 +133,120 @@ class ReaderTest(TestCase):
         self.assertEquals(len(feed['classifiers']['tags']), 0)
         # self.assert_(connection.queries)
         
-        # settings.DEBUG = False
\ No newline at end of file
+        # settings.DEBUG = False
+
+
+class UnreadCountTest(TestCase):
+    fixtures = ['../../rss_feeds/fixtures/rss_feeds.json', 
+                'subscriptions.json', 
+                '../../rss_feeds/fixtures/gawker1.json']
+    
+    def setUp(self):
+        disconnect()
+        settings.MONGODB = connect('test_newsblur')
+        settings.REDIS_STORY_HASH_POOL = redis.ConnectionPool(host=settings.REDIS_STORY['host'], port=6379, db=10)
+        settings.REDIS_FEED_READ_POOL = redis.ConnectionPool(host=settings.SESSION_REDIS_HOST, port=6379, db=10)
+        
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        for key in ['RS:1', 'lRS:1', 'RS:1:1', 'RS:2', 'lRS:2', 'RS:2:1', 'F:1', 'zF:1']:
+            r.delete(key)
+        cache.delete('S:1')
+        
+        self.client = Client()
+        self.feed = Feed.objects.get(pk=1)
+        self.usersub = UserSubscription.objects.get(user=1, feed=1)
+        self.usersub.active = True
+        self.usersub.mark_read_date = datetime.datetime.now() - datetime.timedelta(days=2)
+        self.usersub.save()
+    
+    def tearDown(self):
+        settings.MONGODB.drop_database('test_newsblur')
+    
+    def add_stories(self, titles, hours_ago=1):
+        stories = []
+        for i, title in enumerate(titles):
+            story = MStory(story_feed_id=self.feed.pk,
+                           story_date=datetime.datetime.now() - datetime.timedelta(hours=hours_ago, minutes=i*10),
+                           story_title=title,
+                           story_content="<p>%s</p>" % title,
+                           story_guid="http://gawker.com/%s-%s" % (hours_ago, i),
+                           story_permalink="http://gawker.com/%s-%s" % (hours_ago, i))
+            story.save()
+            stories.append(story)
+        return stories
+    
+    def assertCountsMatchRecount(self, usersub):
+        usersub = UserSubscription.objects.get(pk=usersub.pk)
+        counts = (usersub.unread_count_negative, usersub.unread_count_neutral, usersub.unread_count_positive)
+        
+        cache.delete('S:%s' % usersub.feed_id)
+        usersub.calculate_feed_scores(silent=True, force=True)
+        recount = (usersub.unread_count_negative, usersub.unread_count_neutral, usersub.unread_count_positive)
+        self.assertEquals(counts, recount)
+        return counts
+    
+    def test_add_unread_stories(self):
+        trained_sub = UserSubscription.objects.create(user_id=2, feed=self.feed, active=True,
+                                                      mark_read_date=self.usersub.mark_read_date,
+                                                      is_trained=True)
+        MClassifierTitle.objects.create(user_id=2, feed_id=1, social_user_id=0, title="Apple", score=1)
+        MClassifierTitle.objects.create(user_id=2, feed_id=1, social_user_id=0, title="Gossip", score=-1)
+        
+        stories = self.add_stories(["Apple earnings", "Gossip roundup", "Weekend links"])
+        recount_subs = UserSubscription.add_unread_stories(self.feed, stories)
+        
+        self.assertEquals(list(recount_subs), [])
+        self.assertEquals(self.assertCountsMatchRecount(self.usersub), (0, 3, 0))
+        self.assertEquals(self.assertCountsMatchRecount(trained_sub), (1, 1, 1))
+    
+    def test_mark_story_hashes_as_read(self):
+        stories = self.add_stories(["Apple earnings", "Gossip roundup", "Weekend links"])
+        UserSubscription.add_unread_stories(self.feed, stories)
+        self.client.login(username='conesus', password='test')
+        
+        response = self.client.post(reverse('mark-story-hashes-as-read'), 
+                                    {'story_hash': [stories[0].story_hash, stories[1].story_hash]})
+        content = json.decode(response.content)
+        self.assertEquals(content['code'], 1)
+        self.assertEquals(self.assertCountsMatchRecount(self.usersub), (0, 1, 0))
+        
+        # Reading a story that's already read leaves the counts alone.
+        response = self.client.post(reverse('mark-story-hashes-as-read'), 
+                                    {'story_hash': stories[0].story_hash})
+        self.assertEquals(self.assertCountsMatchRecount(self.usersub), (0, 1, 0))
+    
+    def test_mark_story_hash_as_unread(self):
+        stories = self.add_stories(["Apple earnings", "Gossip roundup"])
+        UserSubscription.add_unread_stories(self.feed, stories)
+        self.client.login(username='conesus', password='test')
+        
+        self.client.post(reverse('mark-story-hashes-as-read'), {'story_hash': stories[0].story_hash})
+        self.assertEquals(self.assertCountsMatchRecount(self.usersub), (0, 1, 0))
+        
+        response = self.client.post(reverse('mark-story-hash-as-unread'), 
+                                    {'story_hash': stories[0].story_hash})
+        content = json.decode(response.content)
+        self.assertEquals(content['code'], 1)
+        self.assertEquals(self.assertCountsMatchRecount(self.usersub), (0, 2, 0))
+        
+        # Marking an unread story unread again leaves the counts alone.
+        self.client.post(reverse('mark-story-hash-as-unread'), {'story_hash': stories[0].story_hash})
+        self.assertEquals(self.assertCountsMatchRecount(self.usersub), (0, 2, 0))
+    
+    def test_mark_story_hash_as_unread_before_mark_read_date(self):
+        newer_stories = self.add_stories(["Apple earnings", "Gossip roundup"])
+        older_stories = self.add_stories(["Last week", "Earlier this week"], hours_ago=24*4)
+        UserSubscription.add_unread_stories(self.feed, newer_stories)
+        self.client.login(username='conesus', password='test')
+        
+        # Older than mark_read_date, so every story since it becomes unread too,
+        # while the story before it stays read.
+        response = self.client.post(reverse('mark-story-hash-as-unread'), 
+                                    {'story_hash': older_stories[0].story_hash})
+        content = json.decode(response.content)
+        self.assertEquals(content['code'], 1)
+        
+        usersub = UserSubscription.objects.get(pk=self.usersub.pk)
+        self.assertTrue(usersub.needs_unread_recalc)
+        usersub.calculate_feed_scores(silent=True)
+        self.assertEquals(self.assertCountsMatchRecount(usersub), (0, 3, 0))
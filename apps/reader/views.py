@@ -6,6 +6,7 @@ import requests
 import random
 import zlib
 import re
+from collections import defaultdict
 from django.shortcuts import get_object_or_404
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
@@ -29,9 +30,9 @@ from mongoengine.queryset import OperationError
 from mongoengine.queryset import NotUniqueError
 from apps.recommendations.models import RecommendedFeed
 from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierFeed, MClassifierTag
-from apps.analyzer.models import apply_classifier_titles, apply_classifier_feeds
-from apps.analyzer.models import apply_classifier_authors, apply_classifier_tags
+from apps.analyzer.models import apply_classifier_feeds
 from apps.analyzer.models import get_classifiers_for_user, sort_classifiers_by_feed
+from apps.analyzer.models import ClassifierMatcher
 from apps.profile.models import Profile, MCustomStyling
 from apps.reader.models import UserSubscription, UserSubscriptionFolders, RUserStory, Feature
 from apps.reader.forms import SignupForm, LoginForm, FeatureForm
@@ -324,7 +325,7 @@ def load_feed_favicons(request):
         user_subs = UserSubscription.objects.select_related('feed').filter(user=user, active=True)
         feed_ids  = [sub['feed__pk'] for sub in user_subs.values('feed__pk')]
 
-    feed_icons = dict([(i.feed_id, i.data) for i in MFeedIcon.objects(feed_id__in=feed_ids)])
+    feed_icons = dict([(feed_id, i.data) for feed_id, i in MFeedIcon.feed_icons(feed_ids).items()])
         
     return feed_icons
 
@@ -461,7 +462,7 @@ def refresh_feeds(request):
     favicons_fetching = [int(f) for f in favicons_fetching if f]
     feed_icons = {}
     if favicons_fetching:
-        feed_icons = dict([(i.feed_id, i) for i in MFeedIcon.objects(feed_id__in=favicons_fetching)])
+        feed_icons = MFeedIcon.feed_icons(favicons_fetching)
         for feed_id, feed in feeds.items():
             if feed_id in favicons_fetching and feed_id in feed_icons:
                 feeds[feed_id]['favicon'] = feed_icons[feed_id].data
@@ -687,6 +688,8 @@ def load_single_feed(request, feed_id):
             
     checkpoint4 = time.time()
     
+    classifier_matcher = ClassifierMatcher.for_classifiers(classifier_titles, classifier_authors,
+                                                           classifier_tags)
     for story in stories:
         if not include_story_content:
             del story['story_content']
@@ -717,12 +720,8 @@ def load_single_feed(request, feed_id):
                 story['shared_comments'] = strip_tags(shared_stories[story['story_hash']]['comments'])
         else:
             story['read_status'] = 1
-        story['intelligence'] = {
-            'feed': apply_classifier_feeds(classifier_feeds, feed),
-            'author': apply_classifier_authors(classifier_authors, story),
-            'tags': apply_classifier_tags(classifier_tags, story),
-            'title': apply_classifier_titles(classifier_titles, story),
-        }
+        story['intelligence'] = classifier_matcher.score(story)
+        story['intelligence']['feed'] = apply_classifier_feeds(classifier_feeds, feed)
         story['score'] = UserSubscription.score_story(story['intelligence'])
         
     # Intelligence
@@ -1098,13 +1097,11 @@ def folder_rss_feed(request, user_id, secret_token, unread_filter, folder_slug):
                              classifier_authors=classifier_authors,
                              classifier_titles=classifier_titles,
                              classifier_tags=classifier_tags)
+    classifier_matcher = ClassifierMatcher.for_classifiers(classifier_titles, classifier_authors,
+                                                           classifier_tags)
     for story in stories:
-        story['intelligence'] = {
-            'feed':   apply_classifier_feeds(classifier_feeds, story['story_feed_id']),
-            'author': apply_classifier_authors(classifier_authors, story),
-            'tags':   apply_classifier_tags(classifier_tags, story),
-            'title':  apply_classifier_titles(classifier_titles, story),
-        }
+        story['intelligence'] = classifier_matcher.score(story)
+        story['intelligence']['feed'] = apply_classifier_feeds(classifier_feeds, story['story_feed_id'])
         story['score'] = UserSubscription.score_story(story['intelligence'])
         if unread_filter == 'focus' and story['score'] >= 1:
             filtered_stories.append(story)
@@ -1396,6 +1393,8 @@ def load_river_stories__redis(request):
     
     # Just need to format stories
     nowtz = localtime_for_timezone(now, user.profile.timezone)
+    classifier_matcher = ClassifierMatcher.for_classifiers(classifier_titles, classifier_authors,
+                                                           classifier_tags)
     for story in stories:
         if read_filter == 'starred':
             story['read_status'] = 1
@@ -1415,12 +1414,8 @@ def load_river_stories__redis(request):
             story['starred_date'] = format_story_link_date__long(starred_date, now)
             story['starred_timestamp'] = starred_date.strftime('%s')
             story['user_tags'] = starred_stories[story['story_hash']]['user_tags']
-        story['intelligence'] = {
-            'feed':   apply_classifier_feeds(classifier_feeds, story['story_feed_id']),
-            'author': apply_classifier_authors(classifier_authors, story),
-            'tags':   apply_classifier_tags(classifier_tags, story),
-            'title':  apply_classifier_titles(classifier_titles, story),
-        }
+        story['intelligence'] = classifier_matcher.score(story)
+        story['intelligence']['feed'] = apply_classifier_feeds(classifier_feeds, story['story_feed_id'])
         story['score'] = UserSubscription.score_story(story['intelligence'])
     
     if include_feeds:
@@ -1639,6 +1634,17 @@ def mark_story_hashes_as_read(request):
     except UnreadablePostError:
         return dict(code=-1, message="Missing `story_hash` list parameter.")
     
+    # Note which stories are unread before marking them, to take them out of the counts.
+    hashes_by_feed = defaultdict(list)
+    for story_hash in set(story_hashes):
+        story_feed_id, _ = MStory.split_story_hash(story_hash)
+        if story_feed_id:
+            hashes_by_feed[int(story_feed_id)].append(story_hash)
+    usersubs = UserSubscription.objects.filter(user=request.user.pk, feed__in=hashes_by_feed.keys())
+    usersubs = dict((usersub.feed_id, usersub) for usersub in usersubs)
+    unread_hashes_by_feed = dict((feed_id, usersub.unread_story_hashes_in(hashes_by_feed[feed_id]))
+                                 for feed_id, usersub in usersubs.items())
+    
     feed_ids, friend_ids = RUserStory.mark_story_hashes_read(request.user.pk, story_hashes, username=request.user.username)
     
     if friend_ids:
@@ -1653,15 +1659,11 @@ def mark_story_hashes_as_read(request):
 
     # Also count on original subscription
     for feed_id in feed_ids:
-        usersubs = UserSubscription.objects.filter(user=request.user.pk, feed=feed_id)
-        if usersubs:
-            usersub = usersubs[0]
+        usersub = usersubs.get(int(feed_id))
+        if usersub:
+            usersub.adjust_unread_counts_for_stories(unread_hashes_by_feed[usersub.feed_id], sign=-1)
             usersub.last_read_date = datetime.datetime.now()
-            if not usersub.needs_unread_recalc:
-                usersub.needs_unread_recalc = True
-                usersub.save(update_fields=['needs_unread_recalc', 'last_read_date'])
-            else:
-                usersub.save(update_fields=['last_read_date'])
+            usersub.save(update_fields=['last_read_date'])
             r.publish(request.user.username, 'feed:%s' % feed_id)
     
     hash_count = len(story_hashes)
@@ -1764,10 +1766,6 @@ def mark_story_as_unread(request):
         usersub = None
         feed = Feed.get_by_id(feed_id)
         
-    if usersub and not usersub.needs_unread_recalc:
-        usersub.needs_unread_recalc = True
-        usersub.save(update_fields=['needs_unread_recalc'])
-        
     data = dict(code=0, payload=dict(story_id=story_id))
     
     story, found_original = MStory.find_story(feed_id, story_id)
@@ -1776,7 +1774,9 @@ def mark_story_as_unread(request):
         logging.user(request, "~FY~SBUnread~SN story in feed: %s (NOT FOUND)" % (feed))
         return dict(code=-1, message="Story not found.")
     
+    was_unread = False
     if usersub:
+        was_unread = bool(usersub.unread_story_hashes_in([story.story_hash]))
         data = usersub.invert_read_stories_after_unread_story(story, request)
 
     message = RUserStory.story_can_be_marked_read_by_user(story, request.user)
@@ -1791,6 +1791,8 @@ def mark_story_as_unread(request):
     dirty_count = social_subs and social_subs.count()
     dirty_count = ("(%s social_subs)" % dirty_count) if dirty_count else ""
     RUserStory.mark_story_hash_unread(request.user, story_hash=story.story_hash)
+    if usersub and not was_unread and usersub.unread_story_hashes_in([story.story_hash]):
+        usersub.adjust_unread_counts_for_stories([story.story_hash], sign=1)
     
     r = redis.Redis(connection_pool=settings.REDIS_PUBSUB_POOL)
     r.publish(request.user.username, 'feed:%s' % feed_id)
@@ -1817,15 +1819,15 @@ def mark_story_hash_as_unread(request):
     
     # Also count on original subscription
     usersubs = UserSubscription.objects.filter(user=request.user.pk, feed=feed_id)
-    if usersubs:
-        usersub = usersubs[0]
-        if not usersub.needs_unread_recalc:
-            usersub.needs_unread_recalc = True
-            usersub.save(update_fields=['needs_unread_recalc'])
+    usersub = usersubs[0] if usersubs else None
+    if usersub:
+        was_unread = bool(usersub.unread_story_hashes_in([story.story_hash]))
         data = usersub.invert_read_stories_after_unread_story(story, request)
         r.publish(request.user.username, 'feed:%s' % feed_id)
 
     feed_id, friend_ids = RUserStory.mark_story_hash_unread(request.user, story_hash)
+    if usersub and not was_unread and usersub.unread_story_hashes_in([story.story_hash]):
+        usersub.adjust_unread_counts_for_stories([story.story_hash], sign=1)
 
     if friend_ids:
         socialsubs = MSocialSubscription.objects.filter(
@@ -15,14 +15,14 @@ def render_recommended_feed(context, recommended_feeds, unmoderated=False):
     if context['user'].is_authenticated():
         usersub = UserSubscription.objects.filter(user=user, feed=recommended_feeds[0].feed)
     recommended_feed = recommended_feeds and recommended_feeds[0]
-    feed_icon = MFeedIcon.objects(feed_id=recommended_feed.feed_id)
+    feed_icon = MFeedIcon.feed_icons([recommended_feed.feed_id]).get(recommended_feed.feed_id)
     
     if recommended_feed:
         return {
             'recommended_feed'  : recommended_feed,
             'description'       : recommended_feed.description or recommended_feed.feed.data.feed_tagline,
             'usersub'           : usersub,
-            'feed_icon'         : feed_icon and feed_icon[0],
+            'feed_icon'         : feed_icon,
             'user'              : context['user'],
             'has_next_page'     : len(recommended_feeds) > 1,
             'unmoderated'       : unmoderated,
@@ -32,14 +32,14 @@ def load_recommended_feed(request):
     if not recommended_feeds:
         return HttpResponse("")
         
-    feed_icon = MFeedIcon.objects(feed_id=recommended_feed.feed_id)
+    feed_icon = MFeedIcon.feed_icons([recommended_feed.feed_id]).get(recommended_feed.feed_id)
     
     if recommended_feed:
         return render_to_response('recommendations/render_recommended_feed.xhtml', {
             'recommended_feed'  : recommended_feed,
             'description'       : recommended_feed.description or recommended_feed.feed.data.feed_tagline,
             'usersub'           : usersub,
-            'feed_icon'         : feed_icon and feed_icon[0],
+            'feed_icon'         : feed_icon,
             'has_next_page'     : len(recommended_feeds) > 1,
             'has_previous_page' : page != 0,
             'unmoderated'       : unmoderated,
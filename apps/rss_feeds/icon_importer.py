@@ -1,4 +1,3 @@
-import urllib2
 import lxml.html
 import numpy
 import scipy
@@ -16,14 +15,18 @@ from socket import error as SocketError
 from boto.s3.key import Key
 from StringIO import StringIO
 from django.conf import settings
-from apps.rss_feeds.models import MFeedPage, MFeedIcon
+from apps.rss_feeds.models import MFeedPage, MFeedIcon, MIconData, MSiteIcon
 from utils.facebook_fetcher import FacebookFetcher
 from utils import log as logging
+from utils import http_pool
 from utils.feed_functions import timelimit, TimeoutError
 from OpenSSL.SSL import Error as OpenSSLError
 from pyasn1.error import PyAsn1Error
 from requests.packages.urllib3.exceptions import LocationParseError
 
+# Icons larger than this are downsampled before picking their color.
+ICON_COLOR_SAMPLE_SIZE = 32
+
 
 class IconImporter(object):
 
@@ -52,45 +55,58 @@ class IconImporter(object):
         if not image:
             image, image_file, icon_url = self.fetch_image_from_path(force=self.force)
 
-        if image:
+        icon_hash = None
+        if isinstance(image, MSiteIcon):
+            # Another feed already fetched and analyzed this url.
+            icon_hash, color = image.icon_hash, image.color
+        elif image:
             image = self.normalize_image(image)
-            try:
-                color = self.determine_dominant_color_in_image(image)
-            except IndexError:
-                return
             try:
                 image_str = self.string_from_image(image)
             except TypeError:
                 return
-
-            if len(image_str) > 500000:
-                image = None
-            if (image and
-                (self.force or
-                 self.feed_icon.data != image_str or
-                 self.feed_icon.icon_url != icon_url or
-                 self.feed_icon.not_found or
-                 (settings.BACKED_BY_AWS.get('icons_on_s3') and not self.feed.s3_icon))):
+            if len(image_str) <= 500000:
+                icon_hash = MIconData.hash_data(image_str)
+                color = MIconData.color_for(icon_hash)
+                if not color:
+                    try:
+                        color = self.determine_dominant_color_in_image(image)
+                    except (IndexError, IOError):
+                        return
+                    MIconData.store(image_str, color)
+            MSiteIcon.record(icon_url, icon_hash, color if icon_hash else None)
+
+        if icon_hash:
+            if (self.force or
+                self.feed_icon.icon_hash != icon_hash or
+                self.feed_icon.data or
+                self.feed_icon.icon_url != icon_url or
+                self.feed_icon.not_found or
+                (settings.BACKED_BY_AWS.get('icons_on_s3') and not self.feed.s3_icon)):
                 logging.debug("   ---> [%-30s] ~SN~FBIcon difference:~FY color:%s (%s/%s) data:%s url:%s notfound:%s no-s3:%s" % (
                     self.feed.log_title[:30],
                     self.feed_icon.color != color, self.feed_icon.color, color,
-                    self.feed_icon.data != image_str,
+                    self.feed_icon.icon_hash != icon_hash,
                     self.feed_icon.icon_url != icon_url,
                     self.feed_icon.not_found,
                     settings.BACKED_BY_AWS.get('icons_on_s3') and not self.feed.s3_icon))
-                self.feed_icon.data = image_str
+                # Only the hash is kept per feed, the image lives in icon_data.
+                self.feed_icon.data = None
+                self.feed_icon.icon_hash = icon_hash
                 self.feed_icon.icon_url = icon_url
                 self.feed_icon.color = color
                 self.feed_icon.not_found = False
                 self.feed_icon.save()
                 if settings.BACKED_BY_AWS.get('icons_on_s3'):
-                    self.save_to_s3(image_str)
+                    icon_data = MIconData.objects(icon_hash=icon_hash).only('data').first()
+                    if icon_data:
+                        self.save_to_s3(icon_data.data)
             if self.feed.favicon_color != color:
                 self.feed.favicon_color = color
                 self.feed.favicon_not_found = False
                 self.feed.save(update_fields=['favicon_color', 'favicon_not_found'])
 
-        if not image:
+        if not icon_hash:
             self.feed_icon.not_found = True
             self.feed_icon.save()
             self.feed.favicon_not_found = True
@@ -212,7 +228,7 @@ class IconImporter(object):
         url = self._url_from_html(content)
         if not url:
             try:
-                content = requests.get(self.cleaned_feed_link).content
+                content = http_pool.get(self.cleaned_feed_link).content
                 url = self._url_from_html(content)
             except (AttributeError, SocketError, requests.ConnectionError,
                     requests.models.MissingSchema, requests.sessions.InvalidSchema,
@@ -270,6 +286,13 @@ class IconImporter(object):
         if not url:
             return None, None
 
+        if not self.force:
+            site_icon = MSiteIcon.fresh(url)
+            if site_icon and site_icon.not_found:
+                return None, None
+            elif site_icon:
+                return site_icon, None
+
         @timelimit(30)
         def _1(url):
             headers = {
@@ -282,12 +305,13 @@ class IconImporter(object):
                                   's' if self.feed.num_subscribers != 1 else '',
                                   self.feed.permalink
                               ),
-                'Connection': 'close',
                 'Accept': 'image/png,image/x-icon,image/*;q=0.9,*/*;q=0.8'
             }
             try:
-                request = urllib2.Request(url, headers=headers)
-                icon = urllib2.urlopen(request).read()
+                response = http_pool.get(url, headers=headers)
+                if response.status_code >= 400:
+                    return None
+                icon = response.content
             except Exception:
                 return None
             return icon
@@ -300,6 +324,7 @@ class IconImporter(object):
             icon_file = StringIO(icon)
             image = Image.open(icon_file)
         except (IOError, ValueError):
+            MSiteIcon.record(url)
             return None, None
 
         return image, icon_file
@@ -335,7 +360,56 @@ class IconImporter(object):
 
         return image
 
-    def determine_dominant_color_in_image(self, image):
+    @classmethod
+    def determine_dominant_color_in_image(cls, image):
+        """ Most common color in the icon, as a hex string. Pixels are bucketed
+            into a fixed 8x8x8 palette on a downsampled copy, and the busiest
+            bucket that isn't nearly black or white wins. Its color is the mean
+            of the pixels in it, not the bucket's corner.
+        """
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        if max(image.size) > ICON_COLOR_SAMPLE_SIZE:
+            # Nearest keeps real pixel colors instead of blending new ones.
+            image = image.resize((min(image.size[0], ICON_COLOR_SAMPLE_SIZE),
+                                  min(image.size[1], ICON_COLOR_SAMPLE_SIZE)), Image.NEAREST)
+        
+        pixels = numpy.asarray(image, dtype=numpy.uint8).reshape(-1, 4)
+        opaque = pixels[pixels[:, 3] >= 128]
+        if len(opaque):
+            pixels = opaque
+        if not len(pixels):
+            raise IndexError("Icon has no pixels")
+        rgb = pixels[:, :3].astype(numpy.int64)
+        
+        bins = (rgb[:, 0] >> 5) << 6 | (rgb[:, 1] >> 5) << 3 | (rgb[:, 2] >> 5)
+        counts = numpy.bincount(bins, minlength=512)
+        sums = numpy.column_stack([numpy.bincount(bins, weights=rgb[:, c], minlength=512)
+                                   for c in range(3)])
+        used = counts > 0
+        means = numpy.zeros((512, 3))
+        means[used] = sums[used] / counts[used][:, numpy.newaxis]
+        
+        # Pare buckets, removing blacks and whites and shades of really dark and really light.
+        candidates = used
+        for low, hi in [(60, 200), (35, 230), (10, 250)]:
+            dark = (means < low).all(axis=1)
+            light = (means > hi).all(axis=1)
+            keep = used & ~dark & ~light
+            if keep.any():
+                candidates = keep
+                break
+        
+        peak = numpy.where(candidates, counts, -1).argmax()
+        color = means[peak].round().astype(int)
+        
+        return '%02x%02x%02x' % tuple(color)
+
+    @classmethod
+    def determine_dominant_color_in_image_kmeans(cls, image):
+        """ The original kmeans color, kept to compare against in
+            `./manage.py benchmark_icon_colors`.
+        """
         NUM_CLUSTERS = 5
 
         # Convert image into array of values for each point.
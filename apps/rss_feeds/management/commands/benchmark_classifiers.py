@@ -0,0 +1,75 @@
+import re
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from apps.rss_feeds.models import Feed, MStory
+from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierTag
+from apps.analyzer.models import apply_classifier_titles, apply_classifier_authors, apply_classifier_tags
+from apps.analyzer.models import ClassifierMatcher
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = ("Times the compiled ClassifierMatcher against the apply_classifier_* functions on "
+            "a user's classifiers and recent stories, and checks they score every story the same.")
+    option_list = BaseCommand.option_list + (
+        make_option("-u", "--user", dest="user", help="User id or username."),
+        make_option("-s", "--stories", dest="stories", type="int", default=100,
+            help="Stories per page, taken from the user's trained feeds."),
+        make_option("-r", "--rounds", dest="rounds", type="int", default=20,
+            help="Pages scored by each implementation."),
+    )
+
+    def handle(self, *args, **options):
+        if not options['user']:
+            raise CommandError("Specify a user with --user.")
+        if re.match(r"^[0-9]+$", options['user']):
+            user = User.objects.get(pk=int(options['user']))
+        else:
+            user = User.objects.get(username=options['user'])
+
+        titles = list(MClassifierTitle.objects(user_id=user.pk))
+        authors = list(MClassifierAuthor.objects(user_id=user.pk))
+        tags = list(MClassifierTag.objects(user_id=user.pk))
+        feed_ids = list(set(c.feed_id for c in titles + authors + tags if c.feed_id))
+        if not feed_ids:
+            raise CommandError("%s has no feed classifiers." % user.username)
+
+        stories = MStory.objects(story_feed_id__in=feed_ids).order_by('-story_date')[:options['stories']]
+        stories = Feed.format_stories(stories)
+        print " ---> %s: %s title, %s author, %s tag classifiers over %s feeds, %s stories" % (
+            user.username, len(titles), len(authors), len(tags), len(feed_ids), len(stories))
+
+        def score_apply():
+            return [(apply_classifier_authors(authors, story),
+                     apply_classifier_tags(tags, story),
+                     apply_classifier_titles(titles, story)) for story in stories]
+
+        def score_matcher():
+            matcher = ClassifierMatcher.for_classifiers(titles, authors, tags)
+            return [(matcher.score_authors(story),
+                     matcher.score_tags(story),
+                     matcher.score_titles(story)) for story in stories]
+
+        start = time.clock()
+        ClassifierMatcher(titles, authors, tags)
+        build = time.clock() - start
+
+        timings = {}
+        for name, score in (('apply', score_apply), ('matcher', score_matcher)):
+            start = time.clock()
+            for _ in range(options['rounds']):
+                score()
+            timings[name] = (time.clock() - start) / options['rounds']
+
+        mismatches = [(story['story_hash'], expected, actual)
+                      for story, expected, actual in zip(stories, score_apply(), score_matcher())
+                      if expected != actual]
+        for story_hash, expected, actual in mismatches[:10]:
+            print " ---> Mismatch on %s: apply %s, matcher %s (author/tags/title)" % (
+                story_hash, expected, actual)
+
+        print " ---> apply:   %.2fms per page" % (timings['apply'] * 1000)
+        print " ---> matcher: %.2fms per page, %.1fx faster (%.2fms to build)" % (
+            timings['matcher'] * 1000, timings['apply'] / max(timings['matcher'], 1e-9), build * 1000)
+        print " ---> %s mismatches" % len(mismatches)
@@ -0,0 +1,274 @@
+import os
+import re
+import json
+import time
+import random
+import threading
+import BaseHTTPServer
+import SocketServer
+import redis
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connection
+from apps.rss_feeds.models import Feed, MStory
+from apps.profile.middleware import DBProfilerMiddleware
+from utils.mongo_raw_log_middleware import MongoDumpMiddleware
+from utils.redis_raw_log_middleware import RedisDumpMiddleware
+from utils import feed_fetcher
+from utils import http_pool
+from optparse import make_option
+
+# Variants served from each recorded feed, on top of the feed itself.
+SCENARIOS = ('redirect', 'slow', 'huge', 'malformed')
+SLOW_SECONDS = 3
+HUGE_BYTES = 8 * 1024 * 1024
+
+
+class RecordedFeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves /feed/<name> from the corpus, behaving like the scenario in
+        the feed's sidecar: redirects, slow responses, huge bodies, broken
+        XML, and 304s for conditional requests that match its ETag.
+    """
+    def do_GET(self):
+        match = re.match(r'^/feed/([^/?]+)', self.path)
+        feed = match and self.server.corpus.get(match.group(1))
+        if not feed:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        if feed.get('redirect'):
+            self.send_response(301)
+            self.send_header('Location', '/feed/%s' % feed['redirect'])
+            self.end_headers()
+            return
+        if feed.get('delay'):
+            time.sleep(feed['delay'])
+
+        etag = '"%s"' % feed['name']
+        if feed.get('etag', True) and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(feed.get('status', 200))
+        self.send_header('Content-Type', feed.get('content_type', 'application/rss+xml'))
+        self.send_header('Content-Length', str(len(feed['body'])))
+        if feed.get('etag', True):
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(feed['body'])
+
+    def log_message(self, *args):
+        pass
+
+
+class RecordedFeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, corpus, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), RecordedFeedHandler)
+        self.corpus = corpus
+
+    def url_for(self, name):
+        return 'http://127.0.0.1:%s/feed/%s' % (self.server_address[1], name)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class Command(BaseCommand):
+    help = ("Runs the Dispatcher against feeds recorded in a corpus directory and served "
+            "locally, reporting feeds/sec, per-stage timings and queries per feed. Writes "
+            "benchmark feeds and stories to the configured databases, so point it at "
+            "local ones.")
+    option_list = BaseCommand.option_list + (
+        make_option("-c", "--corpus", dest="corpus", default=None,
+            help="Directory of recorded feeds: <name>.xml with an optional <name>.json sidecar."),
+        make_option("-r", "--record", dest="record", type="int", default=0,
+            help="Record this many of the most subscribed feeds into the corpus and exit."),
+        make_option("-n", "--rounds", dest="rounds", type="int", default=2,
+            help="Fetch rounds. Rounds after the first see 304s and unchanged bodies."),
+        make_option("-w", "--concurrency", dest="concurrency", type="int", default=1,
+            help="Feed downloads kept in flight at once."),
+        make_option("-p", "--port", dest="port", type="int", default=0),
+        make_option("-k", "--keep", dest="keep", action="store_true",
+            help="Keep the benchmark feeds and their stories afterwards."),
+        make_option("-V", "--verbose", dest="verbose", action="store_true"),
+    )
+
+    def handle(self, *args, **options):
+        if not options['corpus']:
+            raise CommandError("Specify a corpus directory with --corpus.")
+        if options['record']:
+            return self.record(options['corpus'], options['record'])
+        if not settings.DEBUG:
+            raise CommandError("benchmark_fetch writes to the databases, run it with DEBUG on.")
+
+        corpus = self.load_corpus(options['corpus'])
+        if not corpus:
+            raise CommandError("No recorded feeds in %s." % options['corpus'])
+        server = RecordedFeedServer(corpus, port=options['port'])
+        server.start()
+
+        self.instrument_queries()
+        feeds = self.create_feeds(server, corpus)
+        print " ---> Serving %s recorded feeds on %s" % (len(feeds), server.url_for(''))
+
+        try:
+            for round_number in range(1, options['rounds'] + 1):
+                stats, elapsed = self.run_round(feeds, options)
+                self.report(round_number, stats, elapsed)
+        finally:
+            server.shutdown()
+            if not options['keep']:
+                self.delete_feeds(feeds)
+            http_pool.http_pool.close()
+
+    def record(self, corpus_dir, count):
+        if not os.path.exists(corpus_dir):
+            os.makedirs(corpus_dir)
+        feeds = Feed.objects.filter(active=True, num_subscribers__gt=1).order_by('-num_subscribers')
+        recorded = 0
+        for feed in feeds[:count * 2]:
+            try:
+                response = http_pool.get(feed.feed_address, headers=feed.fetch_headers(), timeout=10)
+            except Exception, e:
+                print " ---> Failed %s: %s" % (feed.feed_address, e)
+                continue
+            if response.status_code != 200 or not response.content:
+                continue
+            with open(os.path.join(corpus_dir, '%s.xml' % feed.pk), 'wb') as f:
+                f.write(response.content)
+            content_type = response.headers.get('Content-Type', 'application/rss+xml')
+            with open(os.path.join(corpus_dir, '%s.json' % feed.pk), 'w') as f:
+                json.dump({'content_type': content_type, 'etag': bool(response.headers.get('ETag'))}, f)
+            recorded += 1
+            if recorded >= count:
+                break
+        print " ---> Recorded %s feeds into %s" % (recorded, corpus_dir)
+
+    def load_corpus(self, corpus_dir):
+        """ Recorded feeds by name, plus a redirecting, slow, huge and malformed
+            copy of a handful of them so every run exercises those paths.
+        """
+        corpus = {}
+        for filename in sorted(os.listdir(corpus_dir)):
+            name, ext = os.path.splitext(filename)
+            if ext != '.xml':
+                continue
+            feed = {'name': name}
+            sidecar = os.path.join(corpus_dir, '%s.json' % name)
+            if os.path.exists(sidecar):
+                with open(sidecar) as f:
+                    feed.update(json.load(f))
+            with open(os.path.join(corpus_dir, filename), 'rb') as f:
+                feed['body'] = f.read()
+            corpus[name] = feed
+
+        recorded = sorted(corpus.values(), key=lambda f: f['name'])
+        sample = random.Random(len(recorded)).sample(recorded, min(len(recorded), 5))
+        for source in sample:
+            for scenario in SCENARIOS:
+                name = '%s-%s' % (source['name'], scenario)
+                feed = dict(source, name=name)
+                if scenario == 'redirect':
+                    feed['redirect'] = source['name']
+                elif scenario == 'slow':
+                    feed['delay'] = SLOW_SECONDS
+                elif scenario == 'huge':
+                    feed['body'] = self.huge_body(source['body'])
+                elif scenario == 'malformed':
+                    feed['body'] = source['body'][:len(source['body']) / 2]
+                corpus[name] = feed
+
+        return corpus
+
+    @staticmethod
+    def huge_body(body):
+        """ The feed with its entries repeated until it's HUGE_BYTES long. """
+        for tag in ('</item>', '</entry>'):
+            end = body.rfind(tag)
+            if end != -1:
+                break
+        else:
+            return body * (HUGE_BYTES / max(len(body), 1))
+        start = max(body.find('<item'), body.find('<entry'))
+        entries = body[start:end + len(tag)]
+        copies = max(HUGE_BYTES / max(len(entries), 1), 1)
+        return body[:start] + entries * copies + body[end + len(tag):]
+
+    def instrument_queries(self):
+        profiler = DBProfilerMiddleware()
+        profiler.activated_segments = ['db_profiler']
+        MongoDumpMiddleware().process_celery(profiler)
+        RedisDumpMiddleware().process_celery(profiler)
+
+    def create_feeds(self, server, corpus):
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
+        feeds = []
+        for name in sorted(corpus.keys()):
+            feed = Feed.objects.create(feed_address=server.url_for(name), feed_link='',
+                                       feed_title='Benchmark: %s' % name)
+            # The page and icon queue isn't part of the benchmark.
+            r.setex('pF:%s' % feed.pk, 1, 60*60*24)
+            r.setex('iF:%s' % feed.pk, 1, 60*60*24)
+            feeds.append(feed)
+
+        return feeds
+
+    def delete_feeds(self, feeds):
+        feed_ids = [feed.pk for feed in feeds]
+        MStory.objects(story_feed_id__in=feed_ids).delete()
+        Feed.objects.filter(pk__in=feed_ids).delete()
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        r.delete(*(['F:%s' % feed_id for feed_id in feed_ids] +
+                   ['zF:%s' % feed_id for feed_id in feed_ids]))
+
+    def run_round(self, feeds, options):
+        dispatcher = feed_fetcher.Dispatcher({
+            'single_threaded': True,
+            'concurrency': options['concurrency'],
+            'verbose': options['verbose'],
+            'timeout': 10,
+            'force': False,
+            'compute_scores': True,
+            'quick': 0,
+            'updates_off': False,
+            'unthrottled': True,
+            'record_stats': True,
+        }, 1)
+        feed_ids = [feed.pk for feed in feeds]
+        random.shuffle(feed_ids)
+        dispatcher.add_jobs([feed_ids], len(feed_ids))
+        start = time.time()
+        dispatcher.run_jobs()
+        elapsed = time.time() - start
+        connection.close()
+
+        return dispatcher.fetch_stats, elapsed
+
+    def report(self, round_number, stats, elapsed):
+        print "\n ---> Round %s: %s feeds in %.2fs, %.2f feeds/sec" % (
+            round_number, len(stats), elapsed, len(stats) / max(elapsed, 0.001))
+        for stage in ('feed_fetch', 'feed_process', 'total'):
+            timings = sorted(s[stage] for s in stats if s[stage] is not None)
+            print " ---> %-13s p50 %7.3fs  p99 %7.3fs  (%s feeds)" % (
+                stage, self.percentile(timings, 50), self.percentile(timings, 99), len(timings))
+        for counter in ('sql', 'mongo', 'redis'):
+            counts = [s[counter] for s in stats if s[counter] is not None]
+            print " ---> %-13s %.1f per feed, %s max" % (
+                counter, float(sum(counts)) / max(len(counts), 1), max(counts or [0]))
+        codes = {}
+        for s in stats:
+            codes[s['feed_code']] = codes.get(s['feed_code'], 0) + 1
+        print " ---> Codes: %s" % ', '.join('%s: %s' % (code, codes[code]) for code in sorted(codes))
+
+    @staticmethod
+    def percentile(values, percent):
+        if not values:
+            return 0
+        index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+        return values[index]
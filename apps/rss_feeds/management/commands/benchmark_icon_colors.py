@@ -0,0 +1,87 @@
+import os
+import time
+import numpy
+from StringIO import StringIO
+from PIL import Image
+from django.core.management.base import BaseCommand
+from apps.rss_feeds.models import MIconData
+from apps.rss_feeds.icon_importer import IconImporter
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = "Compares CPU time and agreement of the palette and kmeans favicon colors."
+    option_list = BaseCommand.option_list + (
+        make_option("-l", "--limit", dest="limit", type="int", default=1000,
+            help="Icons to read from icon_data."),
+        make_option("-p", "--path", dest="path", default=None,
+            help="Directory of icon files to use instead of icon_data."),
+        make_option("-d", "--distance", dest="distance", type="int", default=48,
+            help="RGB distance under which two colors count as agreeing."),
+        make_option("-V", "--verbose", dest="verbose", action="store_true"),
+    )
+
+    def handle(self, *args, **options):
+        images = self.load_images(options)
+        if not images:
+            print " ---> No icons found."
+            return
+
+        timings = {'palette': 0, 'kmeans': 0}
+        compared = exact = close = 0
+        for name, image in images:
+            start = time.clock()
+            palette = IconImporter.determine_dominant_color_in_image(image)
+            timings['palette'] += time.clock() - start
+
+            start = time.clock()
+            try:
+                kmeans = IconImporter.determine_dominant_color_in_image_kmeans(image)
+            except IndexError:
+                continue
+            timings['kmeans'] += time.clock() - start
+            compared += 1
+
+            distance = self.color_distance(palette, kmeans)
+            exact += palette == kmeans
+            close += distance <= options['distance']
+            if options['verbose'] and distance > options['distance']:
+                print " ---> %s: palette %s, kmeans %s (%.0f apart)" % (name, palette, kmeans, distance)
+
+        count = max(compared, 1)
+        print " ---> %s icons" % compared
+        print " ---> kmeans:  %.3fs CPU (%.2fms/icon)" % (timings['kmeans'], timings['kmeans'] * 1000 / count)
+        print " ---> palette: %.3fs CPU (%.2fms/icon), %.1fx faster" % (
+            timings['palette'], timings['palette'] * 1000 / count,
+            timings['kmeans'] / max(timings['palette'], 1e-9))
+        print " ---> Agreement: %.1f%% exact, %.1f%% within %s" % (
+            exact * 100. / count, close * 100. / count, options['distance'])
+
+    def load_images(self, options):
+        images = []
+        if options['path']:
+            for filename in sorted(os.listdir(options['path']))[:options['limit']]:
+                try:
+                    image = Image.open(os.path.join(options['path'], filename))
+                    image.load()
+                except IOError:
+                    continue
+                images.append((filename, image.convert('RGBA')))
+            return images
+
+        icons = MIconData.objects.only('icon_hash', 'data')
+        for icon in icons.limit(options['limit']):
+            try:
+                image = Image.open(StringIO(icon.data.decode('base64')))
+                image.load()
+            except (IOError, ValueError):
+                continue
+            images.append((icon.icon_hash, image.convert('RGBA')))
+
+        return images
+
+    @staticmethod
+    def color_distance(a, b):
+        a = numpy.array([int(a[i:i+2], 16) for i in (0, 2, 4)])
+        b = numpy.array([int(b[i:i+2], 16) for i in (0, 2, 4)])
+        return numpy.sqrt(((a - b) ** 2).sum())
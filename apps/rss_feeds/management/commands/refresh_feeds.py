@@ -26,6 +26,16 @@ class Command(BaseCommand):
             dest='skip', default=0, help='Skip stories per month < #.'),
         make_option('-w', '--workerthreads', type='int', default=4,
             help='Worker threads that will fetch feeds in parallel.'),
+        make_option('-c', '--concurrency', type='int', default=1,
+            help='Feed downloads each worker keeps in flight at once.'),
+        make_option('-p', '--pipeline', dest='pipeline', action='store_true',
+            help='Download on I/O threads and parse in a separate process pool.'),
+        make_option('--io_workers', type='int', default=None,
+            help='Pipeline download threads. Defaults to --workerthreads.'),
+        make_option('--cpu_workers', type='int', default=None,
+            help='Pipeline parsing processes. Defaults to the number of cores.'),
+        make_option('--queue_size', type='int', default=None,
+            help='Downloaded feeds waiting to be parsed before downloads block.'),
     )
 
     def handle(self, *args, **options):
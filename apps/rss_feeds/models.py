@@ -12,6 +12,7 @@ import redis
 import pymongo
 import HTMLParser
 import urlparse
+import collections
 from collections import defaultdict
 from operator import itemgetter
 from bson.objectid import ObjectId
@@ -31,10 +32,9 @@ from django.utils.encoding import smart_str, smart_unicode
 from mongoengine.queryset import OperationError, Q, NotUniqueError
 from mongoengine.base import ValidationError
 from vendor.timezones.utilities import localtime_for_timezone
-from apps.rss_feeds.tasks import UpdateFeeds, PushFeeds, ScheduleCountTagsForUser
+from apps.rss_feeds.tasks import UpdateFeeds, PushFeeds, ScheduleCountTagsForUser, FetchPageAndIcon
 from apps.rss_feeds.text_importer import TextImporter
 from apps.search.models import SearchStory, SearchFeed
-from apps.statistics.rstats import RStats
 from utils import json_functions as json
 from utils import feedfinder2 as feedfinder
 from utils import urlnorm
@@ -47,9 +47,47 @@ from utils.feed_functions import seconds_timesince
 from utils.story_functions import strip_tags, htmldiff, strip_comments, strip_comments__lxml
 from utils.story_functions import prep_for_search
 from utils.story_functions import create_signed_url
+from utils.story_functions import simhash, simhash_bands
 
 ENTRY_NEW, ENTRY_UPDATED, ENTRY_SAME, ENTRY_ERR = range(4)
 
+# Original pages are refetched after new stories, or once they're this old.
+PAGE_REFRESH_SECONDS = 60*60*24
+# Favicons are refetched once they're this old.
+ICON_REFRESH_SECONDS = 60*60*24*30
+# Favicon urls that failed aren't retried by other feeds for this long.
+ICON_NOT_FOUND_SECONDS = 60*60*24
+# Feed addresses are grouped with where they last redirected to for this long.
+FETCH_REDIRECT_SECONDS = 60*60*24*7
+# Queued feeds are split into these classes, each worked oldest first and
+# given a weighted share of every tasking round (see TaskFeeds).
+QUEUED_FEED_CLASSES = ('premium', 'active', 'inactive', 'error')
+# Celery priorities for UpdateFeeds batches, lower goes first.
+FEED_PRIORITY_PREMIUM = 0
+FEED_PRIORITY_DEFAULT = 5
+# Predictive scheduling needs this many stories in a feed's publishing profile.
+PREDICTIVE_MIN_STORIES = 30
+# Predicted fetches come no sooner than a quarter of the usual interval, and no
+# later than 4x the usual interval or 6 hours, whichever is sooner. Feeds usually
+# fetched less often than that can be put off by up to 12 more hours instead
+# (PREDICTIVE_MAX_DELAY in settings).
+PREDICTIVE_MIN_SHRINK = 4
+PREDICTIVE_MAX_STRETCH = 4
+PREDICTIVE_MAX_STALENESS = 60*6
+PREDICTIVE_MAX_DELAY = 60*12
+
+# Parts of a feed body that change on every request without the stories
+# changing: build dates, the feed-level Atom <updated>, and cache/timing
+# comments left by blog engines.
+VOLATILE_FEED_ELEMENTS = [
+    re.compile(r'<lastBuildDate>.*?</lastBuildDate>', re.I | re.S),
+    re.compile(r'<!--.*?-->', re.S),
+]
+VOLATILE_FEED_HEADER_ELEMENTS = [
+    re.compile(r'<(\w+:)?updated>.*?</(\w+:)?updated>', re.I | re.S),
+    re.compile(r'<(\w+:)?date>.*?</(\w+:)?date>', re.I | re.S),
+]
+
 
 class Feed(models.Model):
     feed_address = models.URLField(max_length=764, db_index=True)
@@ -88,6 +126,9 @@ class Feed(models.Model):
     s3_page = models.NullBooleanField(default=False, blank=True, null=True)
     s3_icon = models.NullBooleanField(default=False, blank=True, null=True)
     search_indexed = models.NullBooleanField(default=None, null=True, blank=True)
+    
+    # Set by the feed fetcher while it holds this feed's writes, see FeedFetchSession.
+    fetch_session = None
 
     class Meta:
         db_table="feeds"
@@ -202,11 +243,9 @@ class Feed(models.Model):
         }
         
         if include_favicon:
-            try:
-                feed_icon = MFeedIcon.objects.get(feed_id=self.pk)
+            feed_icon = MFeedIcon.feed_icons([self.pk]).get(self.pk)
+            if feed_icon:
                 feed['favicon'] = feed_icon.data
-            except MFeedIcon.DoesNotExist:
-                pass
         if self.has_page_exception or self.has_feed_exception:
             feed['has_exception'] = True
             feed['exception_type'] = 'feed' if self.has_feed_exception else 'page'
@@ -227,6 +266,10 @@ class Feed(models.Model):
         return feed
     
     def save(self, *args, **kwargs):
+        if self.fetch_session:
+            self.fetch_session.defer_save(kwargs.get('update_fields'))
+            return self
+        
         if not self.last_update:
             self.last_update = datetime.datetime.utcnow()
         if not self.next_scheduled_update:
@@ -516,6 +559,11 @@ class Feed(models.Model):
         
     @classmethod
     def task_feeds(cls, feeds, queue_size=12, verbose=True):
+        """ Sends feeds to the update_feeds queue in UpdateFeeds batches of
+            about `queue_size`, one message per batch. Feeds that share an
+            address always land in the same batch, and batches of feeds with
+            premium subscribers go out ahead of the rest.
+        """
         if not feeds: return
         r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
 
@@ -529,16 +577,119 @@ class Feed(models.Model):
         if isinstance(feeds, QuerySet):
             feeds = [f.pk for f in feeds]
         
-        r.srem('queued_feeds', *feeds)
         now = datetime.datetime.now().strftime("%s")
         p = r.pipeline()
-        for feed_id in feeds:
-            p.zadd('tasked_feeds', feed_id, now)
+        cls.unqueue_feeds(p, feeds)
+        for pos in xrange(0, len(feeds), 1000):
+            p.zadd('tasked_feeds', *[arg for feed_id in feeds[pos:pos + 1000]
+                                     for arg in (feed_id, now)])
         p.execute()
         
-        # for feed_ids in (feeds[pos:pos + queue_size] for pos in xrange(0, len(feeds), queue_size)):
-        for feed_id in feeds:
-            UpdateFeeds.apply_async(args=(feed_id,), queue='update_feeds')
+        batches = cls.batch_feeds(feeds, queue_size)
+        for priority, feed_ids in batches:
+            UpdateFeeds.apply_async(args=(feed_ids,), queue='update_feeds', priority=priority)
+        if verbose:
+            logging.debug(" ---> ~SN~FBTasked ~SB%s~SN feeds in ~SB%s~SN batches" % (len(feeds), len(batches)))
+    
+    @classmethod
+    def batch_feeds(cls, feeds, batch_size):
+        """ Packs fetch groups into (priority, feed_ids) batches of up to
+            `batch_size` feeds. A group bigger than that gets a batch to itself.
+        """
+        groups = cls.group_by_fetch_address(feeds)
+        batches = []
+        for priority in (FEED_PRIORITY_PREMIUM, FEED_PRIORITY_DEFAULT):
+            batch = []
+            for group_priority, group in groups:
+                if group_priority != priority:
+                    continue
+                if batch and len(batch) + len(group) > batch_size:
+                    batches.append((priority, batch))
+                    batch = []
+                batch.extend(group)
+            if batch:
+                batches.append((priority, batch))
+        
+        return batches
+    
+    @staticmethod
+    def normalized_fetch_address(address):
+        """ The address with differences that don't change what's served
+            removed: scheme, case, www., default ports, trailing slashes and
+            fragments.
+        """
+        if not address:
+            return
+        try:
+            address = urlnorm.normalize(address)
+            _, netloc, path, query, _ = urlparse.urlsplit(address)
+        except (ValueError, AttributeError, KeyError):
+            return address
+        if netloc.startswith('www.'):
+            netloc = netloc[4:]
+        
+        return "%s%s%s" % (netloc, path.rstrip('/'), ("?%s" % query) if query else "")
+    
+    @staticmethod
+    def fetch_redirect_key(normalized_address):
+        return 'fR:%s' % hashlib.md5(smart_str(normalized_address)).hexdigest()
+    
+    @classmethod
+    def fetch_group_keys(cls, addresses, r=None):
+        """ Feeds with the same key are fetched from about the same place:
+            either where their address last redirected to, or the address
+            itself. Only good for grouping feeds into the same task, a
+            redirect may have changed since it was recorded.
+        """
+        if not addresses:
+            return []
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
+        normalized = [cls.normalized_fetch_address(address) for address in addresses]
+        redirects = r.mget([cls.fetch_redirect_key(n) for n in normalized])
+        
+        return [redirect or n for n, redirect in zip(normalized, redirects)]
+    
+    @classmethod
+    def record_fetch_redirect(cls, address, final_url):
+        source = cls.normalized_fetch_address(address)
+        target = cls.normalized_fetch_address(final_url)
+        if not source or not target or source == target:
+            return
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
+        r.setex(cls.fetch_redirect_key(source), target, FETCH_REDIRECT_SECONDS)
+    
+    @classmethod
+    def clear_fetch_redirect(cls, address):
+        source = cls.normalized_fetch_address(address)
+        if not source:
+            return
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
+        r.delete(cls.fetch_redirect_key(source))
+    
+    @classmethod
+    def group_by_fetch_address(cls, feed_ids):
+        """ Splits feed_ids into (priority, feed_ids) groups of feeds that
+            share a fetch group key, in the order each group first appears. A
+            group is premium priority if any of its feeds has a premium
+            subscriber.
+        """
+        feeds = dict((pk, (address, premium_subscribers)) for pk, address, premium_subscribers in
+                     cls.objects.filter(pk__in=feed_ids).values_list('pk', 'feed_address',
+                                                                     'active_premium_subscribers'))
+        known_ids = [feed_id for feed_id in feed_ids if int(feed_id) in feeds]
+        keys = cls.fetch_group_keys([feeds[int(feed_id)][0] for feed_id in known_ids])
+        key_for = dict(zip(known_ids, keys))
+        
+        groups = collections.OrderedDict()
+        priorities = {}
+        for feed_id in feed_ids:
+            key = key_for.get(feed_id) or ('feed', feed_id)
+            groups.setdefault(key, []).append(feed_id)
+            if feeds.get(int(feed_id), (None, 0))[1] > 0:
+                priorities[key] = FEED_PRIORITY_PREMIUM
+        
+        return [(priorities.get(key, FEED_PRIORITY_DEFAULT), group) for key, group in groups.items()]
     
     @classmethod
     def drain_task_feeds(cls):
@@ -546,13 +697,61 @@ class Feed(models.Model):
 
         tasked_feeds = r.zrange('tasked_feeds', 0, -1)
         logging.debug(" ---> ~FRDraining %s tasked feeds..." % len(tasked_feeds))
-        r.sadd('queued_feeds', *tasked_feeds)
+        cls.queue_feeds(tasked_feeds, r=r)
         r.zremrangebyrank('tasked_feeds', 0, -1)
 
         errored_feeds = r.zrange('error_feeds', 0, -1)
         logging.debug(" ---> ~FRDraining %s errored feeds..." % len(errored_feeds))
-        r.sadd('queued_feeds', *errored_feeds)
+        cls.queue_feeds(errored_feeds, r=r)
         r.zremrangebyrank('error_feeds', 0, -1)
+    
+    @classmethod
+    def queue_feeds(cls, feed_ids, scores=None, r=None):
+        """ Adds feeds to queued_feeds and to their class's queue, scored by
+            when they came due, so TaskFeeds can work each class oldest first.
+        """
+        if not feed_ids:
+            return
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
+        now = int(datetime.datetime.utcnow().strftime('%s'))
+        classes = cls.queued_feed_classes(feed_ids)
+        p = r.pipeline()
+        for pos in xrange(0, len(feed_ids), 1000):
+            feed_ids_chunk = feed_ids[pos:pos + 1000]
+            p.sadd('queued_feeds', *feed_ids_chunk)
+            by_class = defaultdict(list)
+            for feed_id in feed_ids_chunk:
+                score = scores.get(feed_id, now) if scores else now
+                by_class[classes.get(int(feed_id), 'inactive')].extend([feed_id, score])
+            for feed_class, args in by_class.items():
+                p.zadd('queued_feeds:%s' % feed_class, *args)
+        p.execute()
+    
+    @classmethod
+    def queued_feed_classes(cls, feed_ids):
+        """ Which of QUEUED_FEED_CLASSES each feed is queued under. """
+        classes = {}
+        feeds = cls.objects.filter(pk__in=feed_ids).values_list('pk', 'active_premium_subscribers',
+                                                                'active_subscribers', 'errors_since_good')
+        for feed_id, premium_subscribers, active_subscribers, errors in feeds:
+            if errors:
+                classes[feed_id] = 'error'
+            elif premium_subscribers > 0:
+                classes[feed_id] = 'premium'
+            elif active_subscribers > 0:
+                classes[feed_id] = 'active'
+            else:
+                classes[feed_id] = 'inactive'
+        
+        return classes
+    
+    @staticmethod
+    def unqueue_feeds(r, feed_ids):
+        """ Takes feeds out of queued_feeds and every class queue. `r` can be a pipeline. """
+        r.srem('queued_feeds', *feed_ids)
+        for feed_class in QUEUED_FEED_CLASSES:
+            r.zrem('queued_feeds:%s' % feed_class, *feed_ids)
         
     def update_all_statistics(self, has_new_stories=False, force=False):
         recount = not self.counts_converted_to_redis        
@@ -659,16 +858,17 @@ class Feed(models.Model):
         return bool(feed_address), feed
 
     def save_feed_history(self, status_code, message, exception=None, date=None):
-        fetch_history = MFetchHistory.add(feed_id=self.pk, 
-                                          fetch_type='feed',
-                                          code=int(status_code),
-                                          date=date,
-                                          message=message,
-                                          exception=exception)
+        MFetchHistory.add(feed_id=self.pk, 
+                          fetch_type='feed',
+                          code=int(status_code),
+                          date=date,
+                          message=message,
+                          exception=exception,
+                          erroring=bool(self.errors_since_good or self.has_feed_exception))
             
         if status_code not in (200, 304):
             self.errors_since_good += 1
-            self.count_errors_in_history('feed', status_code, fetch_history=fetch_history)
+            self.count_errors_in_history('feed', status_code)
             self.set_next_scheduled_update()
         elif self.has_feed_exception or self.errors_since_good:
             self.errors_since_good = 0
@@ -677,15 +877,16 @@ class Feed(models.Model):
             self.save()
         
     def save_page_history(self, status_code, message, exception=None, date=None):
-        fetch_history = MFetchHistory.add(feed_id=self.pk, 
-                                          fetch_type='page',
-                                          code=int(status_code),
-                                          date=date,
-                                          message=message,
-                                          exception=exception)
+        MFetchHistory.add(feed_id=self.pk, 
+                          fetch_type='page',
+                          code=int(status_code),
+                          date=date,
+                          message=message,
+                          exception=exception,
+                          erroring=self.has_page_exception)
             
         if status_code not in (200, 304):
-            self.count_errors_in_history('page', status_code, fetch_history=fetch_history)
+            self.count_errors_in_history('page', status_code)
         elif self.has_page_exception or not self.has_page:
             self.has_page_exception = False
             self.has_page = True
@@ -699,12 +900,52 @@ class Feed(models.Model):
                           message=raw_feed,
                           date=fetch_date)
         
-    def count_errors_in_history(self, exception_type='feed', status_code=None, fetch_history=None):
-        if not fetch_history:
-            fetch_history = MFetchHistory.feed(self.pk)
-        fh = fetch_history[exception_type + '_fetch_history']
-        non_errors = [h for h in fh if h['status_code'] and int(h['status_code'])     in (200, 304)]
-        errors     = [h for h in fh if h['status_code'] and int(h['status_code']) not in (200, 304)]
+    @staticmethod
+    def fingerprint_feed_body(content, normalize=True):
+        """ Hashes a raw feed body. Normalizing strips elements that change on
+            every request, so feeds that ignore conditional GETs still match.
+        """
+        if normalize:
+            for pattern in VOLATILE_FEED_ELEMENTS:
+                content = pattern.sub('', content)
+            first_story = re.search(r'<(item|entry)[\s>]', content)
+            if first_story:
+                header = content[:first_story.start()]
+                for pattern in VOLATILE_FEED_HEADER_ELEMENTS:
+                    header = pattern.sub('', header)
+                content = header + content[first_story.start():]
+        return hashlib.sha1(content).hexdigest()
+    
+    @property
+    def body_fingerprint(self):
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
+        return r.get('fH:%s' % self.pk)
+    
+    def set_body_fingerprint(self, fingerprint):
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
+        if fingerprint:
+            r.setex('fH:%s' % self.pk, fingerprint, 60*60*24*7)
+        else:
+            r.delete('fH:%s' % self.pk)
+    
+    @property
+    def processed_entry_digests(self):
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
+        return r.smembers('fE:%s' % self.pk)
+    
+    def set_processed_entry_digests(self, digests):
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
+        pipe = r.pipeline()
+        pipe.delete('fE:%s' % self.pk)
+        if digests:
+            pipe.sadd('fE:%s' % self.pk, *digests)
+            pipe.expire('fE:%s' % self.pk, 60*60*24*7)
+        pipe.execute()
+    
+    def count_errors_in_history(self, exception_type='feed', status_code=None):
+        codes = [code for _, code, _ in MFetchHistory.history(self.pk, exception_type)]
+        non_errors = [c for c in codes if c and int(c)     in (200, 304)]
+        errors     = [c for c in codes if c and int(c) not in (200, 304)]
         
         if len(non_errors) == 0 and len(errors) > 1:
             self.active = True
@@ -729,13 +970,11 @@ class Feed(models.Model):
         
         return errors, non_errors
 
-    def count_redirects_in_history(self, fetch_type='feed', fetch_history=None):
+    def count_redirects_in_history(self, fetch_type='feed'):
         logging.debug('   ---> [%-30s] Counting redirects in history...' % (self.log_title[:30]))
-        if not fetch_history:
-            fetch_history = MFetchHistory.feed(self.pk)
-        fh = fetch_history[fetch_type+'_fetch_history']
-        redirects     = [h for h in fh if h['status_code'] and int(h['status_code'])     in (301, 302)]
-        non_redirects = [h for h in fh if h['status_code'] and int(h['status_code']) not in (301, 302)]
+        codes = [code for _, code, _ in MFetchHistory.history(self.pk, fetch_type)]
+        redirects     = [c for c in codes if c and int(c)     in (301, 302)]
+        non_redirects = [c for c in codes if c and int(c) not in (301, 302)]
         
         return redirects, non_redirects
     
@@ -1023,6 +1262,7 @@ class Feed(models.Model):
                             month_count += 1 # Only count months that have stories for the average
         original_story_count_history = self.data.story_count_history
         self.data.story_count_history = json.encode({'months': months, 'hours': hours, 'days': days})
+        self.save_publishing_profile(hours, days)
         if self.data.story_count_history != original_story_count_history:
             self.data.save(update_fields=['story_count_history'])
         
@@ -1139,7 +1379,10 @@ class Feed(models.Model):
             'debug': kwargs.get('debug'),
             'fpf': kwargs.get('fpf'),
             'feed_xml': kwargs.get('feed_xml'),
-            'requesting_user_id': kwargs.get('requesting_user_id', None)
+            'requesting_user_id': kwargs.get('requesting_user_id', None),
+            'schedule_next_update': True,
+            'share_fetches': kwargs.get('share_fetches'),
+            'fetch_redirected': kwargs.get('fetch_redirected'),
         }
         
         if getattr(settings, 'TEST_DEBUG', False):
@@ -1153,18 +1396,20 @@ class Feed(models.Model):
             if self.feed_address != original_feed_address or self.feed_link != original_feed_link:
                 self.save(update_fields=['feed_address', 'feed_link'])
         
+        deferred = False
         if self.is_newsletter:
             feed = self.update_newsletter_icon()
+            if feed:
+                feed.last_update = datetime.datetime.utcnow()
+                feed.set_next_scheduled_update()
         else:
+            # The dispatcher schedules the next fetch in the same write as the fetch
             disp = feed_fetcher.Dispatcher(options, 1)        
             disp.add_jobs([[self.pk]])
             feed = disp.run_jobs()
+            deferred = original_feed_id in disp.deferred_feeds
         
-        if feed:
-            feed = Feed.get_by_id(feed.pk)
-        if feed:
-            feed.last_update = datetime.datetime.utcnow()
-            feed.set_next_scheduled_update()
+        if feed and not deferred:
             r.zadd('fetched_feeds_last_hour', feed.pk, int(datetime.datetime.now().strftime('%s')))
         
         if not feed or original_feed_id != feed.pk:
@@ -1177,6 +1422,40 @@ class Feed(models.Model):
         
         return feed
     
+    def schedule_page_and_icon_fetch(self, new_stories=False, force=False):
+        """ Queues the original page and favicon on their own task queue when
+            they're stale, so feed fetches never wait on the publisher's site.
+            Returns whether anything was queued.
+        """
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
+        pipe = r.pipeline()
+        pipe.exists('pF:%s' % self.pk)
+        pipe.exists('iF:%s' % self.pk)
+        page_fresh, icon_fresh = pipe.execute()
+        
+        fetch_page = bool(self.feed_link and self.has_page and
+                          (force or new_stories or not page_fresh))
+        fetch_icon = force or not icon_fresh
+        if not fetch_page and not fetch_icon:
+            return False
+        
+        # Marked as fetched when queued, so later fetches don't queue it again.
+        pipe = r.pipeline()
+        if fetch_page:
+            pipe.setex('pF:%s' % self.pk, 1, PAGE_REFRESH_SECONDS)
+        if fetch_icon:
+            pipe.setex('iF:%s' % self.pk, 1, ICON_REFRESH_SECONDS)
+        pipe.execute()
+        
+        # New stories and forced fetches go ahead of routine refreshes.
+        priority = 0 if force or new_stories else 5
+        FetchPageAndIcon.apply_async(args=(self.pk,), kwargs=dict(fetch_page=fetch_page,
+                                                                  fetch_icon=fetch_icon,
+                                                                  force_icon=force or not icon_fresh),
+                                     queue='page_icons', priority=priority)
+        
+        return True
+    
     def update_newsletter_icon(self):
         from apps.rss_feeds.icon_importer import IconImporter
         icon_importer = IconImporter(self)
@@ -1213,17 +1492,16 @@ class Feed(models.Model):
         ret_values = dict(new=0, updated=0, same=0, error=0)
         error_count = self.error_count
         new_story_hashes = [s.get('story_hash') for s in stories]
+        # Written together in one bulk write once every story is checked
+        new_stories = []
+        updated_stories = []
         
         if settings.DEBUG or verbose:
             logging.debug("   ---> [%-30s] ~FBChecking ~SB%s~SN new/updated against ~SB%s~SN stories" % (
                           self.log_title[:30],
                           len(stories),
                           len(existing_stories.keys())))
-        @timelimit(2)
-        def _1(story, story_content, existing_stories, new_story_hashes):
-            existing_story, story_has_changed = self._exists_story(story, story_content, 
-                                                                   existing_stories, new_story_hashes)
-            return existing_story, story_has_changed
+        existing_stories_index = self._index_existing_stories(existing_stories, new_story_hashes)
         
         for story in stories:
             if verbose:
@@ -1241,13 +1519,9 @@ class Feed(models.Model):
             story_link = self.get_permalink(story)
             replace_story_date = False
             
-            try:
-                existing_story, story_has_changed = _1(story, story_content, 
-                                                       existing_stories, new_story_hashes)
-            except TimeoutError, e:
-                logging.debug('   ---> [%-30s] ~SB~FRExisting story check timed out...' % (self.log_title[:30]))
-                existing_story = None
-                story_has_changed = False
+            existing_story, story_has_changed = self._exists_story(story, story_content,
+                                                                   existing_stories,
+                                                                   existing_stories_index)
                 
             if existing_story is None:
                 if settings.DEBUG and False:
@@ -1260,19 +1534,11 @@ class Feed(models.Model):
                        story_author_name = story.get('author'),
                        story_permalink = story_link,
                        story_guid = story.get('guid'),
-                       story_tags = story_tags
+                       story_tags = story_tags,
+                       story_content_simhash = story.get('simhash')
                 )
-                try:
-                    s.save()
-                    ret_values['new'] += 1
-                    s.publish_to_subscribers()
-                except (IntegrityError, OperationError), e:
-                    ret_values['error'] += 1
-                    if settings.DEBUG:
-                        logging.info('   ---> [%-30s] ~SN~FRIntegrityError on new story: %s - %s' % (self.feed_title[:30], story.get('guid'), e))
-                if self.search_indexed:
-                    s.index_story_for_search()
-            elif existing_story and story_has_changed and not updates_off and ret_values['updated'] < 3:
+                new_stories.append(s)
+            elif existing_story and story_has_changed and not updates_off and len(updated_stories) < 3:
                 # update story
                 original_content = None
                 try:
@@ -1326,30 +1592,36 @@ class Feed(models.Model):
                 existing_story.story_permalink = story_link
                 existing_story.story_guid = story.get('guid')
                 existing_story.story_tags = story_tags
+                existing_story.story_content_simhash = story.get('simhash')
                 existing_story.original_text_z = None # Reset Text view cache
                 # Do not allow publishers to change the story date once a story is published.
                 # Leads to incorrect unread story counts.
                 if replace_story_date:
                     existing_story.story_date = story.get('published') # Really shouldn't do this.
                 existing_story.extract_image_urls(force=True)
-                try:
-                    existing_story.save()
-                    ret_values['updated'] += 1
-                except (IntegrityError, OperationError):
-                    ret_values['error'] += 1
-                    if verbose:
-                        logging.info('   ---> [%-30s] ~SN~FRIntegrityError on updated story: %s' % (self.feed_title[:30], story.get('title')[:30]))
-                except ValidationError:
-                    ret_values['error'] += 1
-                    if verbose:
-                        logging.info('   ---> [%-30s] ~SN~FRValidationError on updated story: %s' % (self.feed_title[:30], story.get('title')[:30]))
-                if self.search_indexed:
-                    existing_story.index_story_for_search()
+                updated_stories.append(existing_story)
             else:
                 ret_values['same'] += 1
                 if verbose:
                     logging.debug("Unchanged story (%s): %s / %s " % (story.get('story_hash'), story.get('guid'), story.get('title')))
         
+        saved_stories = MStory.bulk_save(new_stories + updated_stories)
+        saved_ids = set(id(s) for s in saved_stories)
+        saved_new_stories = [s for s in new_stories if id(s) in saved_ids]
+        ret_values['new'] = len(saved_new_stories)
+        ret_values['new_stories'] = saved_new_stories
+        ret_values['updated'] = len([s for s in updated_stories if id(s) in saved_ids])
+        unsaved_count = len(new_stories) + len(updated_stories) - len(saved_stories)
+        ret_values['error'] += unsaved_count
+        if unsaved_count and (verbose or settings.DEBUG):
+            logging.info('   ---> [%-30s] ~SN~FRCould not save ~SB%s~SN new/updated stories' % (
+                         self.feed_title[:30], unsaved_count))
+        
+        MStory.publish_batch_to_subscribers(self.pk, saved_new_stories)
+        if self.search_indexed:
+            for s in saved_stories:
+                s.index_story_for_search()
+        
         return ret_values
     
     def update_story_with_new_guid(self, existing_story, new_story_guid):
@@ -1946,46 +2218,91 @@ class Feed(models.Model):
             link = entry.get('id')
         return link
     
-    def _exists_story(self, story, story_content, existing_stories, new_story_hashes):
+    @staticmethod
+    def _existing_story_content(existing_story):
+        if 'story_latest_content_z' in existing_story:
+            return smart_unicode(zlib.decompress(existing_story.story_latest_content_z))
+        elif 'story_latest_content' in existing_story:
+            return existing_story.story_latest_content
+        elif 'story_content_z' in existing_story:
+            return smart_unicode(zlib.decompress(existing_story.story_content_z))
+        elif 'story_content' in existing_story:
+            return existing_story.story_content
+        return u''
+    
+    def _index_existing_stories(self, existing_stories, new_story_hashes):
+        """Lookup tables over the existing stories that an incoming story with a
+        new hash could turn out to be: by permalink, by title, and by SimHash band,
+        so a story is only compared against plausible matches."""
+        index = dict(order={}, permalink=defaultdict(list), title=defaultdict(list),
+                     simhash=defaultdict(list))
+        new_story_hashes = set(new_story_hashes)
+        backfills = []
+        
+        for position, existing_story in enumerate(existing_stories.values()):
+            if isinstance(existing_story.id, unicode):
+                # Correcting a MongoDB bug
+                existing_story.story_guid = existing_story.id
+            if existing_story.story_hash in new_story_hashes:
+                # Story coming up later
+                continue
+            index['order'][id(existing_story)] = position
+            index['permalink'][existing_story.story_permalink].append(existing_story)
+            index['title'][existing_story.story_title].append(existing_story)
+            fingerprint = existing_story.story_content_simhash
+            if fingerprint is None:
+                # Stored before fingerprints were, so it's hashed once and kept
+                fingerprint = simhash(self._existing_story_content(existing_story))
+                if fingerprint is not None:
+                    existing_story.story_content_simhash = fingerprint
+                    backfills.append(pymongo.UpdateOne({'_id': existing_story.id},
+                                                       {'$set': {'story_content_simhash': fingerprint}}))
+            if fingerprint is not None:
+                for band in simhash_bands(fingerprint):
+                    index['simhash'][band].append(existing_story)
+        
+        if backfills:
+            try:
+                MStory._get_collection().bulk_write(backfills, ordered=False)
+            except pymongo.errors.BulkWriteError, e:
+                logging.debug("   ***> [%-30s] ~FRCouldn't store ~SB%s~SN story fingerprints: %s" % (
+                              self.log_title[:30], len(e.details['writeErrors']), e))
+        
+        return index
+    
+    def _exists_story(self, story, story_content, existing_stories, existing_stories_index):
         story_in_system = None
         story_has_changed = False
         story_link = self.get_permalink(story)
-        existing_stories_hashes = existing_stories.keys()
         story_pub_date = story.get('published')
         # story_published_now = story.get('published_now', False)
         # start_date = story_pub_date - datetime.timedelta(hours=8)
         # end_date = story_pub_date + datetime.timedelta(hours=8)
 
-        for existing_story in existing_stories.values():
+        if story.get('story_hash') in existing_stories:
+            candidates = [existing_stories[story.get('story_hash')]]
+        else:
+            # Matches on a different guid need a near identical story, which
+            # shares its permalink, its title or a band of its SimHash.
+            index = existing_stories_index
+            if 'simhash' not in story:
+                story['simhash'] = simhash(story_content)
+            matches = index['permalink'].get(story_link, []) + index['title'].get(story.get('title'), [])
+            if story['simhash'] is not None:
+                for band in simhash_bands(story['simhash']):
+                    matches.extend(index['simhash'].get(band, []))
+            candidates = dict((id(s), s) for s in matches).values()
+            candidates.sort(key=lambda s: index['order'][id(s)])
+
+        for existing_story in candidates:
             content_ratio = 0
             # existing_story_pub_date = existing_story.story_date
             # print 'Story pub date: %s %s' % (story_published_now, story_pub_date)
 
-            if isinstance(existing_story.id, unicode):
-                # Correcting a MongoDB bug
-                existing_story.story_guid = existing_story.id
-            
             if story.get('story_hash') == existing_story.story_hash:
                 story_in_system = existing_story
-            elif (story.get('story_hash') in existing_stories_hashes and 
-                story.get('story_hash') != existing_story.story_hash):
-                # Story already exists but is not this one
-                continue
-            elif (existing_story.story_hash in new_story_hashes and
-                  story.get('story_hash') != existing_story.story_hash):
-                  # Story coming up later
-                continue
 
-            if 'story_latest_content_z' in existing_story:
-                existing_story_content = smart_unicode(zlib.decompress(existing_story.story_latest_content_z))
-            elif 'story_latest_content' in existing_story:
-                existing_story_content = existing_story.story_latest_content
-            elif 'story_content_z' in existing_story:
-                existing_story_content = smart_unicode(zlib.decompress(existing_story.story_content_z))
-            elif 'story_content' in existing_story:
-                existing_story_content = existing_story.story_content
-            else:
-                existing_story_content = u''
+            existing_story_content = self._existing_story_content(existing_story)
                 
                   
             # Title distance + content distance, checking if story changed
@@ -2112,8 +2429,7 @@ class Feed(models.Model):
         # subscriber_bonus = int(subscriber_bonus)
 
         if self.is_push:
-            fetch_history = MFetchHistory.feed(self.pk)
-            if len(fetch_history['push_history']):
+            if len(MFetchHistory.history(self.pk, 'push')):
                 total = total * 12
         
         # 6 hour max for premiums, 48 hour max for free
@@ -2144,26 +2460,126 @@ class Feed(models.Model):
                               '~SB%s errors. Time: %s min' % (
                               self.log_title[:30], self.errors_since_good, total))
         
+        original_min_to_decay = self.min_to_decay
+        self.min_to_decay = total
+        
+        if not error_count and getattr(settings, 'PREDICTIVE_FEED_SCHEDULING', True):
+            predicted = self.predicted_minutes_to_next_update(total)
+            if predicted is not None:
+                if verbose:
+                    logging.debug('   ---> [%-30s] ~FBScheduling from publishing profile: '
+                                  '~SB%s min~SN instead of %s min' % (
+                                  self.log_title[:30], predicted, total))
+                total = predicted
+        
         random_factor = random.randint(0, total) / 4
         next_scheduled_update = datetime.datetime.utcnow() + datetime.timedelta(
                                 minutes = total + random_factor)
-        original_min_to_decay = self.min_to_decay
-        self.min_to_decay = total
         
         delta = self.next_scheduled_update - datetime.datetime.now()
         minutes_to_next_fetch = (delta.seconds + (delta.days * 24 * 3600)) / 60
         if minutes_to_next_fetch > self.min_to_decay or not skip_scheduling:
             self.next_scheduled_update = next_scheduled_update
+            p = r.pipeline()
             if self.active_subscribers >= 1:
-                r.zadd('scheduled_updates', self.pk, self.next_scheduled_update.strftime('%s'))
-            r.zrem('tasked_feeds', self.pk)
-            r.srem('queued_feeds', self.pk)
+                p.zadd('scheduled_updates', self.pk, self.next_scheduled_update.strftime('%s'))
+            p.zrem('tasked_feeds', self.pk)
+            self.unqueue_feeds(p, [self.pk])
+            p.execute()
         
         updated_fields = ['last_update', 'next_scheduled_update']
         if self.min_to_decay != original_min_to_decay:
             updated_fields.append('min_to_decay')
         self.save(update_fields=updated_fields)
     
+    def save_publishing_profile(self, hours, days):
+        """ Stories published by UTC hour of day and day of week (0 is Sunday),
+            kept in redis so scheduling doesn't have to load the feed's data.
+        """
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
+        profile = {
+            'hours': [int(hours.get(h, 0)) for h in range(24)],
+            'days': [int(days.get(d, 0)) for d in range(7)],
+        }
+        r.setex('fP:%s' % self.pk, json.encode(profile), 60*60*24*60)
+    
+    def publishing_profile(self):
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
+        profile = r.get('fP:%s' % self.pk)
+        
+        return profile and json.decode(profile)
+    
+    def predicted_minutes_to_next_update(self, total, now=None):
+        """ Stretches or shrinks the usual interval around when this feed tends
+            to publish. Returns None when the feed hasn't published enough to
+            have a profile.
+        """
+        profile = self.publishing_profile()
+        if not profile or sum(profile['hours']) < PREDICTIVE_MIN_STORIES:
+            return
+        min_minutes, max_minutes = self.prediction_bounds(total)
+        
+        return self.predict_minutes(profile['hours'], profile['days'], total,
+                                    now or datetime.datetime.utcnow(),
+                                    min_minutes=min_minutes, max_minutes=max_minutes)
+    
+    @staticmethod
+    def prediction_bounds(total):
+        """ How far a prediction may shrink or stretch a `total` minute interval. """
+        min_minutes = max(total / PREDICTIVE_MIN_SHRINK, 5)
+        if total < PREDICTIVE_MAX_STALENESS:
+            max_minutes = min(total * PREDICTIVE_MAX_STRETCH, PREDICTIVE_MAX_STALENESS)
+        else:
+            max_delay = getattr(settings, 'PREDICTIVE_MAX_DELAY', PREDICTIVE_MAX_DELAY)
+            max_minutes = min(total * PREDICTIVE_MAX_STRETCH, total + max_delay)
+        
+        return min_minutes, max_minutes
+    
+    @staticmethod
+    def predict_minutes(hours, days, total, now, min_minutes=0, max_minutes=None):
+        """ Minutes from `now` (UTC) until as many stories are expected as
+            would be at the feed's average rate in `total` minutes. Busy hours
+            bring the next fetch closer and quiet hours push it out, so the
+            number of fetches stays about the same but they land when stories
+            do. Counts are smoothed so quiet hours are never entirely skipped.
+        """
+        hour_total = float(sum(hours) + 24)
+        day_total = float(sum(days) + 7)
+        hour_rate = [(hours[h] + 1) * 24 / hour_total for h in range(24)]
+        day_rate = [(days[d] + 1) * 7 / day_total for d in range(7)]
+        
+        remaining = float(total)
+        elapsed = 0.0
+        moment = now
+        while remaining > 0 and (max_minutes is None or elapsed < max_minutes):
+            # Day of week as in story_count_history, where Sunday is 0.
+            rate = hour_rate[moment.hour] * day_rate[(moment.weekday() + 1) % 7]
+            left_in_hour = 60 - moment.minute - moment.second / 60.0
+            if rate * left_in_hour >= remaining:
+                elapsed += remaining / rate
+                break
+            remaining -= rate * left_in_hour
+            elapsed += left_in_hour
+            moment = now + datetime.timedelta(minutes=elapsed)
+        
+        if max_minutes is not None:
+            elapsed = min(elapsed, max_minutes)
+        
+        return int(round(max(elapsed, min_minutes)))
+    
+    def defer_fetch(self, seconds):
+        """ Pushes the next fetch out without touching the feed's error history,
+            used when the feed's host is throttling us.
+        """
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
+        self.next_scheduled_update = datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+        p = r.pipeline()
+        p.zadd('scheduled_updates', self.pk, self.next_scheduled_update.strftime('%s'))
+        p.zrem('tasked_feeds', self.pk)
+        self.unqueue_feeds(p, [self.pk])
+        p.execute()
+        self.save(update_fields=['next_scheduled_update'])
+    
     @property
     def error_count(self):
         r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
@@ -2274,6 +2690,7 @@ class MFeedIcon(mongo.Document):
     feed_id       = mongo.IntField(primary_key=True)
     color         = mongo.StringField(max_length=6)
     data          = mongo.StringField()
+    icon_hash     = mongo.StringField()
     icon_url      = mongo.StringField()
     not_found     = mongo.BooleanField(default=False)
     
@@ -2294,7 +2711,44 @@ class MFeedIcon(mongo.Document):
                 feed_icon = None
         
         return feed_icon
-            
+    
+    @classmethod
+    def feed_icons(cls, feed_ids):
+        """ Feed icons by feed_id, with `data` filled in from the shared
+            icon_data for icons that only store their hash.
+        """
+        feed_icons = dict((icon.feed_id, icon) for icon in cls.objects(feed_id__in=feed_ids))
+        icon_hashes = set(icon.icon_hash for icon in feed_icons.values()
+                          if icon.icon_hash and not icon.data)
+        if icon_hashes:
+            icon_data = dict((i.icon_hash, i.data) for i in MIconData.objects(icon_hash__in=icon_hashes))
+            for feed_icon in feed_icons.values():
+                if not feed_icon.data and feed_icon.icon_hash in icon_data:
+                    feed_icon.data = icon_data[feed_icon.icon_hash]
+        
+        return feed_icons
+    
+    @classmethod
+    def share_icon_data(cls, limit=None):
+        """ Moves icons still stored per feed into the shared icon_data. Only
+            run this once node/favicons serves icons by their icon_hash.
+        """
+        feed_icons = cls.objects(data__ne=None).only('feed_id', 'data', 'color')
+        if limit:
+            feed_icons = feed_icons.limit(limit)
+        moved = 0
+        for feed_icon in feed_icons:
+            if not feed_icon.data:
+                continue
+            icon_hash = MIconData.store(feed_icon.data, feed_icon.color)
+            cls._get_collection().update_one({'_id': feed_icon.feed_id},
+                                             {'$set': {'icon_hash': icon_hash},
+                                              '$unset': {'data': ''}})
+            moved += 1
+        logging.debug(" ---> ~FBMoved ~SB%s~SN feed icons to shared icon data" % moved)
+        
+        return moved
+    
     def save(self, *args, **kwargs):
         if self.icon_url:
             self.icon_url = unicode(self.icon_url)
@@ -2305,6 +2759,80 @@ class MFeedIcon(mongo.Document):
             if hasattr(self, '_id'): self.delete()
 
 
+class MIconData(mongo.Document):
+    """ Favicon images keyed by a hash of their contents, shared by every
+        feed whose icon looks the same.
+    """
+    icon_hash     = mongo.StringField(primary_key=True)
+    data          = mongo.StringField()
+    color         = mongo.StringField(max_length=6)
+    
+    meta = {
+        'collection'        : 'icon_data',
+        'allow_inheritance' : False,
+    }
+    
+    @staticmethod
+    def hash_data(data):
+        return hashlib.sha1(data).hexdigest()
+    
+    @classmethod
+    def color_for(cls, icon_hash):
+        icon = cls.objects(icon_hash=icon_hash).only('color').first()
+        return icon and icon.color
+    
+    @classmethod
+    def store(cls, data, color):
+        icon_hash = cls.hash_data(data)
+        cls._get_collection().update_one({'_id': icon_hash},
+                                         {'$setOnInsert': {'data': data, 'color': color}},
+                                         upsert=True)
+        return icon_hash
+
+
+class MSiteIcon(mongo.Document):
+    """ The last fetch of a favicon url, so feeds on the same site reuse it
+        instead of each fetching and analyzing the same icon.
+    """
+    url_hash      = mongo.StringField(primary_key=True)
+    icon_url      = mongo.StringField()
+    icon_hash     = mongo.StringField()
+    color         = mongo.StringField(max_length=6)
+    not_found     = mongo.BooleanField(default=False)
+    fetched_date  = mongo.DateTimeField()
+    
+    meta = {
+        'collection'        : 'site_icons',
+        'allow_inheritance' : False,
+    }
+    
+    @staticmethod
+    def hash_url(icon_url):
+        return hashlib.sha1(smart_str(icon_url)).hexdigest()
+    
+    @classmethod
+    def fresh(cls, icon_url):
+        """ The shared icon for this url if it's recent enough to reuse. """
+        site_icon = cls.objects(url_hash=cls.hash_url(icon_url)).first()
+        if not site_icon or not site_icon.fetched_date:
+            return
+        max_age = ICON_NOT_FOUND_SECONDS if site_icon.not_found else ICON_REFRESH_SECONDS
+        if site_icon.fetched_date < datetime.datetime.now() - datetime.timedelta(seconds=max_age):
+            return
+        
+        return site_icon
+    
+    @classmethod
+    def record(cls, icon_url, icon_hash=None, color=None):
+        cls._get_collection().update_one({'_id': cls.hash_url(icon_url)}, {'$set': {
+            'icon_url': unicode(icon_url),
+            'icon_hash': icon_hash,
+            'color': color,
+            'not_found': not icon_hash,
+            'fetched_date': datetime.datetime.now(),
+        }}, upsert=True)
+
+
 class MFeedPage(mongo.Document):
     feed_id = mongo.IntField(primary_key=True)
     page_data = mongo.BinaryField()
@@ -2354,6 +2882,7 @@ class MStory(mongo.Document):
     story_original_content_z = mongo.BinaryField()
     story_latest_content     = mongo.StringField()
     story_latest_content_z   = mongo.BinaryField()
+    story_content_simhash    = mongo.LongField()
     original_text_z          = mongo.BinaryField()
     original_page_z          = mongo.BinaryField()
     story_content_type       = mongo.StringField(max_length=255)
@@ -2405,12 +2934,23 @@ class MStory(mongo.Document):
         return h.unescape(self.story_title)
 
     def save(self, *args, **kwargs):
+        self.prepare_for_save()
+        
+        super(MStory, self).save(*args, **kwargs)
+        
+        self.sync_redis()
+        
+        return self
+    
+    def prepare_for_save(self):
         story_title_max = MStory._fields['story_title'].max_length
         story_content_type_max = MStory._fields['story_content_type'].max_length
         self.story_hash = self.feed_guid_hash
         
         self.extract_image_urls()
         
+        if self.story_content_simhash is None:
+            self.story_content_simhash = simhash(self.story_latest_content or self.story_content)
         if self.story_content:
             self.story_content_z = zlib.compress(smart_str(self.story_content))
             self.story_content = None
@@ -2424,12 +2964,57 @@ class MStory(mongo.Document):
             self.story_title = self.story_title[:story_title_max]
         if self.story_content_type and len(self.story_content_type) > story_content_type_max:
             self.story_content_type = self.story_content_type[:story_content_type_max]
+    
+    @classmethod
+    def bulk_save(cls, stories):
+        """ Writes new and updated stories in a single unordered bulk write, then
+            adds their hashes to redis in a single pipeline. Returns the stories
+            that were saved. Stories that fail validation or collide on
+            story_hash are left out.
+        """
+        operations = []
+        written = []
+        saved = []
+        for story in stories:
+            try:
+                story.prepare_for_save()
+                story.validate()
+            except ValidationError:
+                continue
+            if story.id:
+                sets, unsets = story._delta()
+                update = {}
+                if sets:
+                    update['$set'] = sets
+                if unsets:
+                    update['$unset'] = unsets
+                if not update:
+                    saved.append(story)
+                    continue
+                operations.append(pymongo.UpdateOne({'_id': story.id}, update))
+            else:
+                story.id = ObjectId()
+                operations.append(pymongo.InsertOne(story.to_mongo()))
+            written.append(story)
         
-        super(MStory, self).save(*args, **kwargs)
+        failed = set()
+        if operations:
+            try:
+                cls._get_collection().bulk_write(operations, ordered=False)
+            except pymongo.errors.BulkWriteError, e:
+                failed = set(error['index'] for error in e.details['writeErrors'])
+        
+        for i, story in enumerate(written):
+            if i in failed:
+                if isinstance(operations[i], pymongo.InsertOne):
+                    story.id = None
+                continue
+            story._clear_changed_fields()
+            saved.append(story)
         
-        self.sync_redis()
+        cls.sync_redis_batch(saved)
         
-        return self
+        return saved
     
     def delete(self, *args, **kwargs):
         self.remove_from_redis()
@@ -2444,6 +3029,21 @@ class MStory(mongo.Document):
         except redis.ConnectionError:
             logging.debug("   ***> [%-30s] ~BMRedis is unavailable for real-time." % (Feed.get_by_id(self.story_feed_id).title[:30],))
     
+    @classmethod
+    def publish_batch_to_subscribers(cls, story_feed_id, stories):
+        """ One message for all of a feed's new stories, as semicolon separated
+            `story_hash,timestamp` pairs.
+        """
+        if not stories:
+            return
+        message = ';'.join('%s,%s' % (story.story_hash, story.story_date.strftime('%s'))
+                           for story in stories)
+        try:
+            r = redis.Redis(connection_pool=settings.REDIS_PUBSUB_POOL)
+            r.publish("%s:story" % story_feed_id, message)
+        except redis.ConnectionError:
+            logging.debug("   ***> [%-30s] ~BMRedis is unavailable for real-time." % (Feed.get_by_id(story_feed_id).title[:30],))
+    
     @classmethod
     def purge_feed_stories(cls, feed, cutoff, verbose=True):
         stories = cls.objects(story_feed_id=feed.pk)
@@ -2647,6 +3247,27 @@ class MStory(mongo.Document):
             # r2.zadd('z' + feed_key, self.story_hash, time.mktime(self.story_date.timetuple()))
             # r2.expire('z' + feed_key, settings.DAYS_OF_STORY_HASHES*24*60*60)
     
+    @classmethod
+    def sync_redis_batch(cls, stories, r=None):
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        UNREAD_CUTOFF = datetime.datetime.now() - datetime.timedelta(days=settings.DAYS_OF_STORY_HASHES)
+        
+        pipeline = r.pipeline()
+        feed_keys = set()
+        for story in stories:
+            if not story.id or story.story_date <= UNREAD_CUTOFF:
+                continue
+            feed_key = 'F:%s' % story.story_feed_id
+            pipeline.sadd(feed_key, story.story_hash)
+            pipeline.zadd('z' + feed_key, story.story_hash, time.mktime(story.story_date.timetuple()))
+            feed_keys.add(feed_key)
+        for feed_key in feed_keys:
+            pipeline.expire(feed_key, settings.DAYS_OF_STORY_HASHES*24*60*60)
+            pipeline.expire('z' + feed_key, settings.DAYS_OF_STORY_HASHES*24*60*60)
+        if feed_keys:
+            pipeline.execute()
+    
     def remove_from_redis(self, r=None):
         if not r:
             r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
@@ -3138,19 +3759,23 @@ class MFetchHistory(mongo.Document):
         'collection': 'fetch_history',
         'allow_inheritance': False,
     }
+    
+    HISTORY_FIELDS = {
+        'feed': 'feed_fetch_history',
+        'page': 'page_fetch_history',
+        'push': 'push_history',
+        'raw_feed': 'raw_feed_history',
+    }
 
     @classmethod
     def feed(cls, feed_id, timezone=None, fetch_history=None):
+        """ History formatted for display in the user's timezone. """
         if not fetch_history:
-            try:
-                fetch_history = cls.objects.read_preference(pymongo.ReadPreference.PRIMARY)\
-                                           .get(feed_id=feed_id)
-            except cls.DoesNotExist:
-                fetch_history = cls.objects.create(feed_id=feed_id)
+            fetch_history = cls.objects(feed_id=feed_id).first()
         history = {}
 
         for fetch_type in ['feed_fetch_history', 'page_fetch_history', 'push_history']:
-            history[fetch_type] = getattr(fetch_history, fetch_type)
+            history[fetch_type] = getattr(fetch_history, fetch_type, None)
             if not history[fetch_type]:
                 history[fetch_type] = []
             for f, fetch in enumerate(history[fetch_type]):
@@ -3164,48 +3789,41 @@ class MFetchHistory(mongo.Document):
         return history
     
     @classmethod
-    def add(cls, feed_id, fetch_type, date=None, message=None, code=None, exception=None):
+    def history(cls, feed_id, fetch_type='feed'):
+        """ Unformatted [date, status_code, message] entries, newest first. """
+        field = cls.HISTORY_FIELDS[fetch_type]
+        collection = cls._get_collection().with_options(read_preference=pymongo.ReadPreference.PRIMARY)
+        fetch_history = collection.find_one({'feed_id': feed_id}, {field: True})
+        
+        return (fetch_history and fetch_history.get(field)) or []
+    
+    @classmethod
+    def add(cls, feed_id, fetch_type, date=None, message=None, code=None, exception=None,
+            erroring=False):
+        """ Prepends a fetch in a single atomic update, without reading the history
+            back. Healthy histories keep 5 entries and raw feeds 10, but a failed
+            fetch or an `erroring` feed keeps 25 to count errors from.
+        """
         if not date:
             date = datetime.datetime.now()
-        try:
-            fetch_history = cls.objects.read_preference(pymongo.ReadPreference.PRIMARY)\
-                                       .get(feed_id=feed_id)
-        except cls.DoesNotExist:
-            fetch_history = cls.objects.create(feed_id=feed_id)
-        
-        if fetch_type == 'feed':
-            history = fetch_history.feed_fetch_history or []
-        elif fetch_type == 'page':
-            history = fetch_history.page_fetch_history or []
-        elif fetch_type == 'push':
-            history = fetch_history.push_history or []
-        elif fetch_type == 'raw_feed':
-            history = fetch_history.raw_feed_history or []
-
-        history = [[date, code, message]] + history
-        any_exceptions = any([c for d, c, m in history if c not in [200, 304]])
-        if any_exceptions:
-            history = history[:25]
-        elif fetch_type == 'raw_feed':            
-            history = history[:10]
+        field = cls.HISTORY_FIELDS[fetch_type]
+        healthy = code and (200 <= int(code) < 300 or int(code) == 304) and not erroring
+        if fetch_type == 'raw_feed':
+            limit = 10
+        elif healthy:
+            limit = 5
         else:
-            history = history[:5]
-
-        if fetch_type == 'feed':
-            fetch_history.feed_fetch_history = history
-        elif fetch_type == 'page':
-            fetch_history.page_fetch_history = history
-        elif fetch_type == 'push':
-            fetch_history.push_history = history
-        elif fetch_type == 'raw_feed':
-            fetch_history.raw_feed_history = history
-        
-        fetch_history.save()
-        
-        if fetch_type == 'feed':
-            RStats.add('feed_fetch')
-        
-        return cls.feed(feed_id, fetch_history=fetch_history)
+            limit = 25
+        
+        cls._get_collection().update_one({'feed_id': feed_id}, {
+            '$push': {
+                field: {
+                    '$each': [[date, code, message]],
+                    '$position': 0,
+                    '$slice': limit,
+                }
+            }
+        }, upsert=True)
 
 
 class DuplicateFeed(models.Model):
@@ -13,6 +13,7 @@ from boto.s3.key import Key
 from django.conf import settings
 from django.utils.text import compress_string
 from utils import log as logging
+from utils import http_pool
 from apps.rss_feeds.models import MFeedPage
 from utils.feed_functions import timelimit, TimeoutError
 from OpenSSL.SSL import Error as OpenSSLError
@@ -91,10 +92,9 @@ class PageImporter(object):
                     data = response.read()
                 else:
                     try:
-                        response = requests.get(feed_link, headers=self.headers)
-                        response.connection.close()
+                        response = http_pool.get(feed_link, headers=self.headers)
                     except requests.exceptions.TooManyRedirects:
-                        response = requests.get(feed_link)
+                        response = http_pool.get(feed_link)
                     except (AttributeError, SocketError, OpenSSLError, PyAsn1Error, TypeError), e:
                         logging.debug('   ***> [%-30s] Page fetch failed using requests: %s' % (self.feed.log_title[:30], e))
                         self.save_no_page()
@@ -3,6 +3,7 @@ import os
 import shutil
 import time
 import redis
+import traceback
 from celery.task import Task
 from celery.exceptions import SoftTimeLimitExceeded
 from utils import log as logging
@@ -12,12 +13,29 @@ from apps.profile.middleware import DBProfilerMiddleware
 from utils.mongo_raw_log_middleware import MongoDumpMiddleware
 from utils.redis_raw_log_middleware import RedisDumpMiddleware
 FEED_TASKING_MAX = 10000
+# Share of each tasking round given to each class of queued feeds. Shares a
+# class can't use go to the others. Override with settings.FEED_TASKING_WEIGHTS.
+FEED_TASKING_WEIGHTS = {
+    'premium': 8,
+    'active': 4,
+    'inactive': 1,
+    'error': 1,
+}
+# Feeds looked at per TaskBrokenFeeds run by each sweep. Sweeps walk the feeds
+# table by id, picking up where the last run stopped and wrapping at the end.
+BROKEN_FEEDS_SWEEP_SIZE = {
+    'refresh': 100,
+    'old': 1000,
+}
+# UpdateFeeds starts no new feeds after this long and tasks the rest of its batch
+# again, so a slow batch can't run into the time limits and drop its tail.
+UPDATE_FEEDS_DEADLINE = 6*60
 
 class TaskFeeds(Task):
     name = 'task-feeds'
 
     def run(self, **kwargs):
-        from apps.rss_feeds.models import Feed        
+        from apps.rss_feeds.models import Feed
         settings.LOG_TO_STREAM = True
         now = datetime.datetime.utcnow()
         start = time.time()
@@ -27,23 +45,29 @@ class TaskFeeds(Task):
         hour_ago = now - datetime.timedelta(hours=1)
         r.zremrangebyscore('fetched_feeds_last_hour', 0, int(hour_ago.strftime('%s')))
         
+        # Take stale feeds off the schedule atomically, so two taskers can't both queue them.
         now_timestamp = int(now.strftime("%s"))
-        queued_feeds = r.zrangebyscore('scheduled_updates', 0, now_timestamp)
-        r.zremrangebyscore('scheduled_updates', 0, now_timestamp)
-        if not queued_feeds:
+        pipe = r.pipeline(transaction=True)
+        pipe.zrangebyscore('scheduled_updates', 0, now_timestamp, withscores=True)
+        pipe.zremrangebyscore('scheduled_updates', 0, now_timestamp)
+        scheduled_feeds, _ = pipe.execute()
+        if not scheduled_feeds:
             logging.debug(" ---> ~SN~FB~BMNo feeds to queue! Exiting...")
             return
-            
-        r.sadd('queued_feeds', *queued_feeds)
+        
+        queued_feeds = [feed_id for feed_id, _ in scheduled_feeds]
+        Feed.queue_feeds(queued_feeds, scores=dict(scheduled_feeds), r=r)
+        pipe = r.pipeline()
+        pipe.zcard('tasked_feeds')
+        pipe.scard('queued_feeds')
+        pipe.zcard('scheduled_updates')
+        counts = pipe.execute()
         logging.debug(" ---> ~SN~FBQueuing ~SB%s~SN stale feeds (~SB%s~SN/~FG%s~FB~SN/%s tasked/queued/scheduled)" % (
-                        len(queued_feeds),
-                        r.zcard('tasked_feeds'),
-                        r.scard('queued_feeds'),
-                        r.zcard('scheduled_updates')))
+                        (len(queued_feeds),) + tuple(counts)))
         
         # Regular feeds
         if tasked_feeds_size < FEED_TASKING_MAX:
-            feeds = r.srandmember('queued_feeds', FEED_TASKING_MAX)
+            feeds = self.pick_feeds(r, FEED_TASKING_MAX, now_timestamp)
             Feed.task_feeds(feeds, verbose=True)
             active_count = len(feeds)
         else:
@@ -57,6 +81,76 @@ class TaskFeeds(Task):
                         r.scard('queued_feeds'),
                         r.zcard('scheduled_updates')))
 
+    def pick_feeds(self, r, budget, now_timestamp):
+        """ Up to `budget` queued feeds, split between QUEUED_FEED_CLASSES by
+            weight and oldest first within each class. Anything left over is
+            filled from queued_feeds at random, which also picks up feeds
+            queued without a class. Each class's lag, how long its oldest feed
+            has been due, is logged and kept in the queued_feeds_lag hash.
+        """
+        from apps.rss_feeds.models import QUEUED_FEED_CLASSES
+        weights = getattr(settings, 'FEED_TASKING_WEIGHTS', FEED_TASKING_WEIGHTS)
+        
+        pipe = r.pipeline()
+        for feed_class in QUEUED_FEED_CLASSES:
+            pipe.zcard('queued_feeds:%s' % feed_class)
+            pipe.zrange('queued_feeds:%s' % feed_class, 0, 0, withscores=True)
+        results = pipe.execute()
+        sizes = dict(zip(QUEUED_FEED_CLASSES, results[0::2]))
+        lags = dict((feed_class, int(now_timestamp - oldest[0][1]) if oldest else 0)
+                    for feed_class, oldest in zip(QUEUED_FEED_CLASSES, results[1::2]))
+        shares = self.weighted_shares(budget, sizes, weights)
+        
+        pipe = r.pipeline()
+        for feed_class in QUEUED_FEED_CLASSES:
+            pipe.zrange('queued_feeds:%s' % feed_class, 0, max(shares[feed_class] - 1, 0))
+        pipe.hmset('queued_feeds_lag', lags)
+        results = pipe.execute()[:-1]
+        
+        feeds = []
+        seen = set()
+        for feed_class, feed_ids in zip(QUEUED_FEED_CLASSES, results):
+            for feed_id in feed_ids[:shares[feed_class]]:
+                if feed_id not in seen:
+                    seen.add(feed_id)
+                    feeds.append(feed_id)
+        if len(feeds) < budget:
+            for feed_id in r.srandmember('queued_feeds', budget - len(feeds)):
+                if feed_id not in seen:
+                    seen.add(feed_id)
+                    feeds.append(feed_id)
+        
+        logging.debug(" ---> ~SN~FBTasking by class: %s" % ', '.join(
+                      "%s ~SB%s~SN/%s (%s min lag)" % (feed_class, shares[feed_class],
+                                                       sizes[feed_class], lags[feed_class] / 60)
+                      for feed_class in QUEUED_FEED_CLASSES))
+        
+        return feeds
+    
+    @staticmethod
+    def weighted_shares(budget, sizes, weights):
+        """ Splits `budget` between classes in proportion to their weights,
+            never giving a class more than it has queued. What a short class
+            can't use is split again between the rest.
+        """
+        shares = dict((feed_class, 0) for feed_class in sizes)
+        remaining = budget
+        open_classes = [c for c in sizes if sizes[c] > 0 and weights.get(c, 0) > 0]
+        while remaining > 0 and open_classes:
+            total_weight = float(sum(weights[c] for c in open_classes))
+            granted = 0
+            for feed_class in open_classes:
+                share = max(1, int(remaining * weights[feed_class] / total_weight))
+                share = min(share, sizes[feed_class] - shares[feed_class], remaining - granted)
+                shares[feed_class] += share
+                granted += share
+            if not granted:
+                break
+            remaining -= granted
+            open_classes = [c for c in open_classes if shares[c] < sizes[c]]
+        
+        return shares
+
 class TaskBrokenFeeds(Task):
     name = 'task-broken-feeds'
     max_retries = 0
@@ -72,12 +166,12 @@ class TaskBrokenFeeds(Task):
         logging.debug(" ---> ~SN~FBQueuing broken feeds...")
         
         # Force refresh feeds
-        refresh_feeds = Feed.objects.filter(
+        refresh_feeds = self.sweep_feeds(r, 'refresh', Feed.objects.filter(
             active=True,
             fetched_once=False,
             active_subscribers__gte=1
-        ).order_by('?')[:100]
-        refresh_count = refresh_feeds.count()
+        ))
+        refresh_count = len(refresh_feeds)
         cp1 = time.time()
         
         logging.debug(" ---> ~SN~FBFound %s active, unfetched broken feeds" % refresh_count)
@@ -99,12 +193,21 @@ class TaskBrokenFeeds(Task):
                         r.zcard('tasked_feeds')))
         cp2 = time.time()
         
+        # Overdue feeds that fell out of scheduled_updates and tasked_feeds
         old = now - datetime.timedelta(days=1)
-        old_feeds = Feed.objects.filter(
+        old_feeds = self.sweep_feeds(r, 'old', Feed.objects.filter(
             next_scheduled_update__lte=old, 
             active_subscribers__gte=1
-        ).order_by('?')[:500]
-        old_count = old_feeds.count()
+        ))
+        pipe = r.pipeline()
+        for feed_id in old_feeds:
+            pipe.zscore('scheduled_updates', feed_id)
+            pipe.zscore('tasked_feeds', feed_id)
+        scores = pipe.execute()
+        old_feeds = [feed_id for feed_id, scheduled, tasked
+                     in zip(old_feeds, scores[0::2], scores[1::2])
+                     if scheduled is None and tasked is None]
+        old_count = len(old_feeds)
         cp3 = time.time()
         
         logging.debug(" ---> ~SN~FBTasking ~SBrefresh:~FC%s~FB inactive:~FC%s~FB old:~FC%s~SN~FB broken feeds... (%.4s/%.4s/%.4s)" % (
@@ -124,6 +227,49 @@ class TaskBrokenFeeds(Task):
                         r.zcard('tasked_feeds'),
                         r.scard('queued_feeds'),
                         r.zcard('scheduled_updates')))
+    
+    def sweep_feeds(self, r, sweep, feeds):
+        """ The next BROKEN_FEEDS_SWEEP_SIZE ids of `feeds` after where this
+            sweep last stopped, walking the primary key index rather than
+            sorting the table by random(). Each sweep's filter has an index of
+            its own (rss_feeds migration 0073). Progress is kept in the
+            broken_feeds_sweep hash, along with how long the last full pass
+            took and how many feeds it found, and logged each run.
+        """
+        from apps.rss_feeds.models import Feed
+        size = BROKEN_FEEDS_SWEEP_SIZE[sweep]
+        cursor, pass_start, swept = r.hmget('broken_feeds_sweep', '%s:cursor' % sweep,
+                                            '%s:start' % sweep, '%s:swept' % sweep)
+        cursor = int(cursor or 0)
+        swept = int(swept or 0)
+        now = int(time.time())
+        pass_start = int(pass_start or now)
+        
+        feed_ids = list(feeds.filter(pk__gt=cursor).order_by('pk').values_list('pk', flat=True)[:size])
+        swept += len(feed_ids)
+        
+        if len(feed_ids) < size:
+            # Reached the end of the table, start the next pass from the top.
+            logging.debug(" ---> ~SN~FBBroken feeds ~SB%s~SN sweep finished a pass: ~SB%s~SN feeds in ~SB%s~SN min" % (
+                            sweep, swept, (now - pass_start) / 60))
+            r.hmset('broken_feeds_sweep', {
+                '%s:cursor' % sweep: 0,
+                '%s:start' % sweep: now,
+                '%s:swept' % sweep: 0,
+                '%s:last_pass_feeds' % sweep: swept,
+                '%s:last_pass_seconds' % sweep: now - pass_start,
+            })
+        else:
+            max_id = Feed.objects.latest('pk').pk
+            logging.debug(" ---> ~SN~FBBroken feeds ~SB%s~SN sweep at ~SB%s%%~SN (feed %s of %s, ~SB%s~SN feeds so far)" % (
+                            sweep, feed_ids[-1] * 100 / max(max_id, 1), feed_ids[-1], max_id, swept))
+            r.hmset('broken_feeds_sweep', {
+                '%s:cursor' % sweep: feed_ids[-1],
+                '%s:start' % sweep: pass_start,
+                '%s:swept' % sweep: swept,
+            })
+        
+        return feed_ids
         
 class UpdateFeeds(Task):
     name = 'update-feeds'
@@ -134,7 +280,7 @@ class UpdateFeeds(Task):
 
     def run(self, feed_pks, **kwargs):
         from apps.rss_feeds.models import Feed
-        from apps.statistics.models import MStatistics
+        from apps.statistics.models import MStatistics, MAnalyticsFetcher
         r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
 
         mongodb_replication_lag = int(MStatistics.get('mongodb_replication_lag', 0))
@@ -157,20 +303,100 @@ class UpdateFeeds(Task):
         
         if not isinstance(feed_pks, list):
             feed_pks = [feed_pks]
-            
-        for feed_pk in feed_pks:
-            feed = Feed.get_by_id(feed_pk)
-            if not feed or feed.pk != int(feed_pk):
-                logging.info(" ---> ~FRRemoving feed_id %s from tasked_feeds queue, points to %s..." % (feed_pk, feed and feed.pk))
-                r.zrem('tasked_feeds', feed_pk)
-            if not feed:
-                continue
+        
+        feeds = [(feed_pk, Feed.get_by_id(feed_pk)) for feed_pk in feed_pks]
+        # Feeds in the batch that share an address reuse one download, see Feed.task_feeds.
+        group_keys = Feed.fetch_group_keys([feed.feed_address for _, feed in feeds if feed], r=r)
+        shared_keys = set(key for key in group_keys if group_keys.count(key) > 1)
+        group_keys = iter(group_keys)
+        
+        deadline = time.time() + UPDATE_FEEDS_DEADLINE
+        unfinished = []
+        try:
+            for position, (feed_pk, feed) in enumerate(feeds):
+                if time.time() > deadline:
+                    unfinished = feeds[position:]
+                    break
+                if not feed or feed.pk != int(feed_pk):
+                    logging.info(" ---> ~FRRemoving feed_id %s from tasked_feeds queue, points to %s..." % (feed_pk, feed and feed.pk))
+                    r.zrem('tasked_feeds', feed_pk)
+                if not feed:
+                    continue
+                group_key = next(group_keys)
+                options['share_fetches'] = group_key in shared_keys
+                # Lets the fetch drop the redirect if the feed stopped redirecting.
+                options['fetch_redirected'] = group_key != Feed.normalized_fetch_address(feed.feed_address)
+                try:
+                    feed.update(**options)
+                except SoftTimeLimitExceeded, e:
+                    feed.save_feed_history(505, 'Timeout', e)
+                    logging.info(" ---> [%-30s] ~BR~FWTime limit hit!~SB~FR Tasking the rest of the batch..." % feed)
+                    unfinished = feeds[position+1:]
+                    break
+                if profiler_activated: profiler.process_celery_finished()
+        finally:
+            # The batch's fetch timings go out together, not a minute later.
+            MAnalyticsFetcher.flush()
+        
+        unfinished = [unfinished_feed.pk for _, unfinished_feed in unfinished if unfinished_feed]
+        if unfinished:
+            logging.info(" ---> ~FRUpdate batch ran long, tasking ~SB%s~SN unfetched feeds again" % len(unfinished))
+            Feed.task_feeds(unfinished, verbose=False)
+
+class FetchPageAndIcon(Task):
+    name = 'fetch-page-and-icon'
+    max_retries = 0
+    ignore_result = True
+    time_limit = 3*60
+    soft_time_limit = 2*60
+
+    def run(self, feed_id, fetch_page=True, fetch_icon=True, force_icon=False, **kwargs):
+        from apps.rss_feeds.models import Feed
+        from apps.rss_feeds.page_importer import PageImporter
+        from apps.rss_feeds.icon_importer import IconImporter
+        from utils.feed_functions import TimeoutError
+        
+        feed = Feed.get_by_id(feed_id)
+        if not feed:
+            return
+        
+        page_data = None
+        if fetch_page:
+            logging.debug(u'   ---> [%-30s] ~FYFetching page: %s' % (feed.log_title[:30], feed.feed_link))
+            start = time.time()
+            try:
+                page_data = PageImporter(feed).fetch_page()
+            except SoftTimeLimitExceeded, e:
+                logging.debug(" ---> [%-30s] ~BR~FWTime limit hit!~SB~FR Moving on to next feed..." % feed)
+                feed.save_feed_history(557, 'Timeout', e)
+                return
+            except TimeoutError, e:
+                logging.debug('   ---> [%-30s] ~FRPage fetch timed out...' % (feed.log_title[:30]))
+                feed.save_page_history(555, 'Timeout', '')
+            except Exception, e:
+                tb = traceback.format_exc()
+                logging.error(tb)
+                feed.save_page_history(550, "Page Error", tb)
+                if (not settings.DEBUG and hasattr(settings, 'RAVEN_CLIENT') and
+                    settings.RAVEN_CLIENT):
+                    settings.RAVEN_CLIENT.captureException()
+            logging.debug(u'   ---> [%-30s] ~FYPage fetched in ~SB%.4ss' % (feed.log_title[:30], time.time() - start))
+        
+        if fetch_icon or page_data:
+            logging.debug(u'   ---> [%-30s] ~FYFetching icon: %s' % (feed.log_title[:30], feed.feed_link))
             try:
-                feed.update(**options)
+                IconImporter(feed, page_data=page_data, force=force_icon).save()
             except SoftTimeLimitExceeded, e:
-                feed.save_feed_history(505, 'Timeout', e)
-                logging.info(" ---> [%-30s] ~BR~FWTime limit hit!~SB~FR Moving on to next feed..." % feed)
-            if profiler_activated: profiler.process_celery_finished()
+                logging.debug(" ---> [%-30s] ~BR~FWTime limit hit!~SB~FR Moving on to next feed..." % feed)
+                feed.save_feed_history(558, 'Timeout', e)
+            except TimeoutError, e:
+                logging.debug('   ---> [%-30s] ~FRIcon fetch timed out...' % (feed.log_title[:30]))
+                feed.save_page_history(556, 'Timeout', '')
+            except Exception, e:
+                logging.error(traceback.format_exc())
+                if (not settings.DEBUG and hasattr(settings, 'RAVEN_CLIENT') and
+                    settings.RAVEN_CLIENT):
+                    settings.RAVEN_CLIENT.captureException()
 
 class NewFeeds(Task):
     name = 'new-feeds'
@@ -1,4 +1,8 @@
+import os
+import time
+import pickle
 import redis
+import datetime
 from utils import json_functions as json
 from django.test.client import Client
 from django.test import TestCase
@@ -7,6 +11,11 @@ from django.core.urlresolvers import reverse
 from django.conf import settings
 from apps.rss_feeds.models import Feed, MStory
 from mongoengine.connection import connect, disconnect
+from utils.story_functions import simhash, simhash_distance
+from utils import feedparser
+from utils import fast_feedparser
+from apps.rss_feeds.icon_importer import IconImporter
+from PIL import Image
 
 
 class FeedTest(TestCase):
@@ -239,5 +248,272 @@ class FeedTest(TestCase):
         # Test: 1 changed char in title
         self.assertEquals(len(feed['stories']), 6)
 
+    def test_fetch_pipeline(self):
+        from utils.feed_fetcher import Dispatcher, FetchPipeline
+        management.call_command('loaddata', 'gawker1.json', verbosity=0)
+        feed = Feed.objects.get(feed_link__contains='gawker')
+        feed.feed_address = feed.feed_address.replace("%(NEWSBLUR_DIR)s", settings.NEWSBLUR_DIR)
+        feed.save(update_fields=['feed_address'])
+        
+        options = dict(verbose=False, timeout=10, single_threaded=False, force=False,
+                       compute_scores=False, updates_off=False, schedule_next_update=True,
+                       share_fetches=True)
+        pipeline = FetchPipeline(Dispatcher(options, 1), io_workers=1, cpu_workers=1)
+        pipeline.start = time.time()
+        
+        # Both stages in this process, with the download pickled as the queue would.
+        download = pipeline.download_feed(feed.pk)
+        self.assertTrue(isinstance(download, dict))
+        pipeline.parse_download(feed.pk, pickle.loads(pickle.dumps(download)))
+        
+        self.assertEquals(MStory.objects(story_feed_id=feed.pk).count(), 38)
+        self.assertEquals(pipeline.processed.value, 1)
+        self.assertTrue(Feed.get_by_id(feed.pk).next_scheduled_update)
+
+    def test_feed_body_fingerprint(self):
+        body = "<rss><channel><lastBuildDate>%s</lastBuildDate><!-- %s --><item><title>%s</title></item></channel></rss>"
+        fingerprint = Feed.fingerprint_feed_body(body % ('Mon', '0.12s', 'Story'))
+
+        self.assertEquals(Feed.fingerprint_feed_body(body % ('Tue', '0.34s', 'Story')), fingerprint)
+        self.assertNotEquals(Feed.fingerprint_feed_body(body % ('Mon', '0.12s', 'Story 2')), fingerprint)
+        self.assertNotEquals(Feed.fingerprint_feed_body(body % ('Tue', '0.12s', 'Story'), normalize=False),
+                             fingerprint)
+
+    def test_story_simhash(self):
+        words = ["word%s" % i for i in range(300)]
+        story = simhash(u"<p>%s</p>" % u" ".join(words))
+        edited = simhash(u"<p>%s <b>new</b></p>" % u" ".join(words[:299]))
+        different = simhash(u"<p>%s</p>" % u" ".join(reversed(words)))
+
+        self.assertTrue(simhash_distance(story, edited) < 8)
+        self.assertTrue(simhash_distance(story, different) > 16)
+        self.assertEquals(simhash(u"<img src='a.gif'>"), None)
+
+    def test_story_simhash_backfill(self):
+        feed = Feed.objects.get(pk=1)
+        story = MStory(story_feed_id=feed.pk, story_date=datetime.datetime.now(),
+                       story_title="Older story", story_guid="http://example.com/older",
+                       story_content=u"<p>%s</p>" % u" ".join("word%s" % i for i in range(300)))
+        story.save()
+        fingerprint = story.story_content_simhash
+        MStory.objects(id=story.id).update_one(unset__story_content_simhash=1)
+        
+        # Stories stored before fingerprints get theirs the first time they're indexed.
+        story = MStory.objects.get(id=story.id)
+        self.assertEquals(story.story_content_simhash, None)
+        feed._index_existing_stories({story.story_hash: story}, [])
+        self.assertEquals(MStory.objects.get(id=story.id).story_content_simhash, fingerprint)
+
+    def test_icon_color(self):
+        image = Image.new('RGBA', (64, 64), (255, 255, 255, 255))
+        image.paste((200, 30, 40, 255), (0, 0, 40, 64))
+        image.paste((0, 0, 0, 255), (40, 0, 64, 64))
+        self.assertEquals(IconImporter.determine_dominant_color_in_image(image), 'c81e28')
+        
+        transparent = Image.new('RGBA', (16, 16), (0, 0, 0, 0))
+        transparent.paste((20, 120, 220, 255), (4, 4, 12, 12))
+        self.assertEquals(IconImporter.determine_dominant_color_in_image(transparent), '1478dc')
+
+    def test_normalized_fetch_address(self):
+        normalized = Feed.normalized_fetch_address
+        self.assertEquals(normalized('http://www.Example.com/feed/'), 'example.com/feed')
+        self.assertEquals(normalized('https://example.com:443/feed#top'), 'example.com/feed')
+        self.assertEquals(normalized('http://example.com/feed?format=rss'), 'example.com/feed?format=rss')
+        self.assertNotEquals(normalized('http://example.com/feed'), normalized('http://example.com/other'))
+
+    def test_predict_minutes(self):
+        hours = [0] * 24
+        hours[9] = 100
+        days = [0, 20, 20, 20, 20, 20, 0]
+        monday = datetime.datetime(2017, 3, 6)
+        
+        # Uniform publishing keeps the usual interval.
+        self.assertEquals(Feed.predict_minutes([5] * 24, [5] * 7, 60, monday.replace(hour=3)), 60)
+        # Quiet hours stretch up to the cap, the publishing hour pulls fetches in.
+        self.assertEquals(Feed.predict_minutes(hours, days, 60, monday - datetime.timedelta(hours=12),
+                                               min_minutes=15, max_minutes=240), 240)
+        self.assertTrue(Feed.predict_minutes(hours, days, 60, monday.replace(hour=3),
+                                             min_minutes=15, max_minutes=240) > 120)
+        self.assertEquals(Feed.predict_minutes(hours, days, 60, monday.replace(hour=9, minute=10),
+                                               min_minutes=15, max_minutes=240), 15)
+        
+        # Long intervals can stretch as well as shrink.
+        self.assertEquals(Feed.prediction_bounds(60), (15, 240))
+        self.assertEquals(Feed.prediction_bounds(120), (30, 360))
+        self.assertEquals(Feed.prediction_bounds(720), (180, 1440))
+        self.assertEquals(Feed.prediction_bounds(2880), (720, 2880 + 720))
+
+    def test_weighted_shares(self):
+        from apps.rss_feeds.tasks import TaskFeeds, FEED_TASKING_WEIGHTS
+        shares = TaskFeeds.weighted_shares
+        sizes = dict(premium=100, active=100, inactive=100, error=100)
+        
+        self.assertEquals(shares(14, sizes, FEED_TASKING_WEIGHTS),
+                          dict(premium=8, active=4, inactive=1, error=1))
+        # What a short class can't use goes to the others.
+        sizes = dict(premium=2, active=100, inactive=100, error=0)
+        result = shares(20, sizes, FEED_TASKING_WEIGHTS)
+        self.assertEquals(result['premium'], 2)
+        self.assertEquals(result['error'], 0)
+        self.assertEquals(sum(result.values()), 20)
+        self.assertTrue(result['active'] > result['inactive'] > 0)
+        # Never more than is queued.
+        self.assertEquals(sum(shares(1000, sizes, FEED_TASKING_WEIGHTS).values()), 202)
+
     def test_all_feeds(self):
         pass
+
+
+class FastFeedparserTest(TestCase):
+    
+    RSS = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/"
+     xmlns:content="http://purl.org/rss/1.0/modules/content/">
+<channel>
+  <title>Example</title>
+  <link>http://example.com/</link>
+  <description>An example feed</description>
+  <item>
+    <title>First story</title>
+    <link>http://example.com/1</link>
+    <guid isPermaLink="false">story-1</guid>
+    <dc:creator>Jane Doe</dc:creator>
+    <pubDate>Mon, 06 Mar 2017 09:30:00 GMT</pubDate>
+    <category>news</category>
+    <category domain="http://example.com/tags">tech</category>
+    <description>Short summary</description>
+    <content:encoded><![CDATA[<p>Full <b>story</b> <a href="http://example.com/more">here</a><script>x()</script></p>]]></content:encoded>
+    <enclosure url="http://example.com/1.mp3" type="audio/mpeg" length="1234" />
+  </item>
+  <item>
+    <title>Second story</title>
+    <guid>http://example.com/2</guid>
+    <author><name>John Roe</name><title/></author>
+    <pubDate>Tue, 07 Mar 2017 10:00:00 +0100</pubDate>
+    <description>&lt;p&gt;Escaped &lt;i&gt;markup&lt;/i&gt;&lt;/p&gt;</description>
+  </item>
+</channel>
+</rss>"""
+
+    ATOM = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Example Atom</title>
+  <link rel="alternate" type="text/html" href="http://example.com/"/>
+  <link rel="self" href="http://example.com/atom.xml"/>
+  <id>urn:example</id>
+  <updated>2017-03-06T10:00:00Z</updated>
+  <entry>
+    <title>First entry</title>
+    <link rel="alternate" type="text/html" href="http://example.com/a1"/>
+    <link rel="enclosure" type="video/mp4" length="99" href="http://example.com/a1.mp4"/>
+    <id>urn:example:1</id>
+    <author><name>John Roe</name><email>john@example.com</email></author>
+    <published>2017-03-06T09:30:00Z</published>
+    <updated>2017-03-06T10:00:00+01:00</updated>
+    <category term="science" scheme="http://example.com/cats" label="Science"/>
+    <summary>Plain summary</summary>
+    <content type="html">&lt;p&gt;Atom &lt;b&gt;content&lt;/b&gt;&lt;/p&gt;</content>
+  </entry>
+  <entry>
+    <title>Second entry</title>
+    <link href="http://example.com/a2"/>
+    <id>urn:example:2</id>
+    <author><name>Jane Doe</name></author>
+    <updated>2017-03-07T08:00:00Z</updated>
+    <summary type="html">&lt;p&gt;Only a summary&lt;/p&gt;</summary>
+  </entry>
+</feed>"""
+
+    RDF = """<?xml version="1.0" encoding="utf-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns="http://purl.org/rss/1.0/">
+  <channel rdf:about="http://example.com/">
+    <title>Example RDF</title>
+    <link>http://example.com/</link>
+    <description>An RSS 1.0 feed</description>
+  </channel>
+  <item rdf:about="http://example.com/1">
+    <title>First story</title>
+    <link>http://example.com/1</link>
+  </item>
+</rdf:RDF>"""
+
+    @staticmethod
+    def entry_fields(entry):
+        content = entry.get('content') and entry['content'][0]['value'].strip()
+        return dict(
+            title=entry.get('title'),
+            link=entry.get('link'),
+            id=entry.get('id'),
+            author=entry.get('author'),
+            published=entry.get('published_parsed'),
+            updated=entry.get('updated_parsed'),
+            tags=[(t['term'], t.get('scheme'), t.get('label')) for t in entry.get('tags', [])],
+            content=content,
+            summary=(entry.get('summary') or u'').strip(),
+            enclosures=[(l['href'], l.get('type'), l.get('length')) for l in entry.get('links', [])
+                        if l.get('rel') == u'enclosure'],
+        )
+    
+    def assertParsesLikeFeedparser(self, data, version):
+        fast = fast_feedparser.parse(data)
+        slow = feedparser.parse(data)
+        
+        self.assertEquals(fast.version, version)
+        self.assertEquals(fast.feed.get('title'), slow.feed.get('title'))
+        self.assertEquals(fast.feed.get('link'), slow.feed.get('link'))
+        self.assertEquals(len(fast.entries), min(len(slow.entries), 100))
+        for fast_entry, slow_entry in zip(fast.entries, slow.entries):
+            fast_feedparser.sanitize_entry(fast_entry)
+            self.assertEquals(self.entry_fields(fast_entry), self.entry_fields(slow_entry))
+        
+        return fast
+    
+    def fixture(self, filename):
+        path = os.path.join(os.path.dirname(__file__), 'fixtures', filename)
+        with open(path) as f:
+            return f.read()
+    
+    def test_rss(self):
+        fast = self.assertParsesLikeFeedparser(self.RSS, u'rss20')
+        entry = fast.entries[0]
+        
+        self.assertEquals(entry.author, u'Jane Doe')
+        self.assertEquals([t.term for t in entry.tags], [u'news', u'tech'])
+        self.assertEquals(entry.links[-1].href, u'http://example.com/1.mp3')
+        self.assertTrue('<script>' not in entry.content[0].value)
+        # A permalink guid stands in for a missing link.
+        self.assertEquals(fast.entries[1].link, u'http://example.com/2')
+        self.assertEquals(fast.entries[1].author, u'John Roe')
+    
+    def test_atom(self):
+        fast = self.assertParsesLikeFeedparser(self.ATOM, u'atom10')
+        
+        self.assertEquals(fast.entries[0].author, u'John Roe (john@example.com)')
+        self.assertEquals(fast.entries[0].published_parsed[:5], (2017, 3, 6, 9, 30))
+        self.assertEquals(fast.entries[1].get('published_parsed'), None)
+    
+    def test_fixtures(self):
+        self.assertParsesLikeFeedparser(self.fixture('gawker1.xml'), u'rss20')
+        fast = self.assertParsesLikeFeedparser(self.fixture('daringfireball.xml'), u'atom10')
+        # Entries with only content get it as their summary too.
+        self.assertEquals(fast.entries[0].summary, fast.entries[0].content[0].value)
+    
+    def test_max_entries(self):
+        fast = fast_feedparser.parse(self.fixture('daringfireball.xml'), max_entries=5)
+        self.assertEquals(len(fast.entries), 5)
+    
+    def test_falls_back_to_feedparser(self):
+        malformed = self.RSS.replace('</item>', '', 1)
+        undeclared_entity = self.RSS.replace('First story', 'Caf&eacute; story')
+        
+        self.assertEquals(fast_feedparser.parse(malformed), None)
+        self.assertEquals(fast_feedparser.parse(undeclared_entity), None)
+        self.assertEquals(fast_feedparser.parse(self.RDF), None)
+        # Its items nest a `description` inside an `og` block.
+        self.assertEquals(fast_feedparser.parse(self.fixture('google1.xml')), None)
+        
+        # Everything the fast path turns down still parses the slow way.
+        self.assertEquals(len(feedparser.parse(undeclared_entity).entries), 2)
+        rdf = feedparser.parse(self.RDF)
+        self.assertEquals(rdf.version, u'rss10')
+        self.assertEquals(rdf.entries[0].link, u'http://example.com/1')
@@ -72,13 +72,9 @@ def feed_favicon_etag(request, feed_id):
     
 @condition(etag_func=feed_favicon_etag)
 def load_feed_favicon(request, feed_id):
-    not_found = False
-    try:
-        feed_icon = MFeedIcon.objects.get(feed_id=feed_id)
-    except MFeedIcon.DoesNotExist:
-        not_found = True
+    feed_icon = MFeedIcon.feed_icons([int(feed_id)]).get(int(feed_id))
         
-    if not_found or not feed_icon.data:
+    if not feed_icon or not feed_icon.data:
         return HttpResponseRedirect(settings.MEDIA_URL + 'img/icons/circular/world.png')
         
     icon_data = feed_icon.data.decode('base64')
@@ -136,7 +132,7 @@ def feed_autocomplete(request):
     feeds = sorted(feeds, key=lambda f: -1 * f['num_subscribers'])
     
     feed_ids = [f['id'] for f in feeds]
-    feed_icons = dict((icon.feed_id, icon) for icon in MFeedIcon.objects.filter(feed_id__in=feed_ids))
+    feed_icons = MFeedIcon.feed_icons(feed_ids)
     
     for feed in feeds:
         if feed['id'] in feed_icons:
@@ -1,8 +1,12 @@
 import datetime
+import time
+import atexit
 import mongoengine as mongo
+import pymongo
 import urllib2
 import redis
 import dateutil
+from collections import defaultdict
 from django.conf import settings
 from apps.social.models import MSharedStory
 from apps.profile.models import Profile
@@ -303,31 +307,43 @@ class MFeedback(mongo.Document):
 
 
 class MAnalyticsFetcher(mongo.Document):
-    date = mongo.DateTimeField(default=datetime.datetime.now)
-    feed_id = mongo.IntField()
-    feed_fetch = mongo.FloatField()
-    feed_process = mongo.FloatField()
-    page = mongo.FloatField()
-    icon = mongo.FloatField()
-    total = mongo.FloatField()
+    """ Feed fetch timings and status codes, one document per server per minute.
+        Fetchers buffer their fetches in memory with `add` and write them here
+        with `flush`, about once a minute.
+    """
+    date = mongo.DateTimeField()
     server = mongo.StringField()
-    feed_code = mongo.IntField()
+    fetches = mongo.IntField(default=0)
+    feed_codes = mongo.DictField()
+    durations = mongo.DictField()
     
     meta = {
         'db_alias': 'nbanalytics',
-        'collection': 'feed_fetches',
+        'collection': 'feed_fetch_minutes',
         'allow_inheritance': False,
-        'indexes': ['date', 'feed_id', 'server', 'feed_code'],
+        'indexes': ['date', 'server'],
         'ordering': ['date'],
     }
     
+    STAGES = ['feed_fetch', 'feed_process', 'page', 'icon', 'total']
+    # Upper bounds of the duration histogram buckets, in milliseconds.
+    HISTOGRAM_BUCKETS = [100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+    FLUSH_INTERVAL = 60
+    
+    buffered = {}
+    last_flush = time.time()
+    
     def __unicode__(self):
-        return "%s: %.4s+%.4s+%.4s+%.4s = %.4ss" % (self.feed_id, self.feed_fetch,
-                                                    self.feed_process,
-                                                    self.page, 
-                                                    self.icon,
-                                                    self.total)
-        
+        return "%s %s: %s fetches" % (self.server, self.date, self.fetches)
+    
+    @classmethod
+    def histogram_bucket(cls, duration):
+        milliseconds = duration * 1000
+        for bucket in cls.HISTOGRAM_BUCKETS:
+            if milliseconds <= bucket:
+                return str(bucket)
+        return 'inf'
+    
     @classmethod
     def add(cls, feed_id, feed_fetch, feed_process, 
             page, icon, total, feed_code):
@@ -343,14 +359,78 @@ class MAnalyticsFetcher(mongo.Document):
         if feed_process and feed_fetch:
             feed_process -= feed_fetch
         
-        cls.objects.create(feed_id=feed_id, feed_fetch=feed_fetch,
-                           feed_process=feed_process, 
-                           page=page, icon=icon, total=total,
-                           server=server_name, feed_code=feed_code)
+        minute = datetime.datetime.now().replace(second=0, microsecond=0)
+        increments = cls.buffered.setdefault(minute, defaultdict(int))
+        increments['fetches'] += 1
+        increments['feed_codes.%s' % feed_code] += 1
+        durations = dict(feed_fetch=feed_fetch, feed_process=feed_process,
+                         page=page, icon=icon, total=total)
+        for stage, duration in durations.items():
+            if duration is None:
+                continue
+            increments['durations.%s.count' % stage] += 1
+            increments['durations.%s.sum' % stage] += duration
+            increments['durations.%s.histogram.%s' % (stage, cls.histogram_bucket(duration))] += 1
+        
+        if time.time() - cls.last_flush >= cls.FLUSH_INTERVAL:
+            cls.flush()
     
     @classmethod
-    def calculate_stats(cls, stats):
-        return cls.aggregate(**stats)
+    def flush(cls):
+        """ Writes every buffered minute in a single bulk write. """
+        buffered = cls.buffered
+        cls.buffered = {}
+        cls.last_flush = time.time()
+        if not buffered:
+            return
+        
+        server_name = settings.SERVER_NAME
+        operations = [pymongo.UpdateOne({'date': minute, 'server': server_name}, 
+                                        {'$inc': dict(increments)}, upsert=True)
+                      for minute, increments in buffered.items()]
+        try:
+            cls._get_collection().bulk_write(operations, ordered=False)
+        except pymongo.errors.PyMongoError, e:
+            logging.debug(" ***> ~FRCouldn't write fetcher analytics: %s" % e)
+        RStats.add('feed_fetch', count=int(sum(i['fetches'] for i in buffered.values())))
+    
+    @classmethod
+    def summarize(cls, minutes=5):
+        """ Fetch counts, status codes and average stage durations for the last
+            few minutes, overall and per server.
+        """
+        since = datetime.datetime.now() - datetime.timedelta(minutes=minutes)
+        summary = {
+            'fetches': 0,
+            'feed_codes': defaultdict(int),
+            'servers': defaultdict(lambda: defaultdict(float)),
+            'durations': dict((stage, 0) for stage in cls.STAGES),
+        }
+        stage_totals = defaultdict(lambda: defaultdict(float))
+        
+        for aggregate in cls.objects(date__gte=since):
+            summary['fetches'] += aggregate.fetches
+            for feed_code, count in aggregate.feed_codes.items():
+                summary['feed_codes'][feed_code] += count
+            server = summary['servers'][aggregate.server]
+            server['fetches'] += aggregate.fetches
+            for stage, duration in aggregate.durations.items():
+                stage_totals[stage]['sum'] += duration.get('sum', 0)
+                stage_totals[stage]['count'] += duration.get('count', 0)
+                if stage == 'total':
+                    server['total_sum'] += duration.get('sum', 0)
+                    server['total_count'] += duration.get('count', 0)
+        
+        for stage, totals in stage_totals.items():
+            if totals['count']:
+                summary['durations'][stage] = totals['sum'] / totals['count']
+        for server in summary['servers'].values():
+            server['total'] = server['total_sum'] / server['total_count'] if server['total_count'] else 0
+        
+        return summary
+
+# Fetchers that handle one feed per task only flush on the interval, or here.
+atexit.register(MAnalyticsFetcher.flush)
 
 
 class MAnalyticsLoader(mongo.Document):
@@ -4919,10 +4919,13 @@
 
                 this.socket.removeAllListeners('feed:story:new');
                 this.socket.on('feed:story:new', _.bind(function(feed_id, message) {
-                    var story_hash = message.split(',')[0];
-                    var timestamp = message.split(',')[1];
-                    // NEWSBLUR.log(['Real-time new story', feed_id, story_hash, timestamp]);
-                    NEWSBLUR.app.dashboard_river.new_story(story_hash, timestamp);
+                    // Stories fetched together arrive as `hash,timestamp;hash,timestamp`
+                    _.each(message.split(';'), function(story) {
+                        var story_hash = story.split(',')[0];
+                        var timestamp = story.split(',')[1];
+                        // NEWSBLUR.log(['Real-time new story', feed_id, story_hash, timestamp]);
+                        NEWSBLUR.app.dashboard_river.new_story(story_hash, timestamp);
+                    });
                 }, this));
 
                 this.socket.removeAllListeners(NEWSBLUR.Globals.username);
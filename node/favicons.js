@@ -1,6 +1,6 @@
 // Generated by CoffeeScript 1.8.0
 (function() {
-  var DEV, MONGODB_PORT, MONGODB_SERVER, app, mongo, server, url;
+  var DEV, MONGODB_PORT, MONGODB_SERVER, app, mongo, redirect_to_default, send_icon, server, url;
 
   app = require('express')();
 
@@ -34,10 +34,29 @@
   mongo.MongoClient.connect(url, (function(_this) {
     return function(err, db) {
       console.log(" ---> Connected to " + (db != null ? db.serverConfig.s.host : void 0) + ":" + (db != null ? db.serverConfig.s.port : void 0) + " / " + err);
-      return _this.collection = db != null ? db.collection("feed_icons") : void 0;
+      _this.collection = db != null ? db.collection("feed_icons") : void 0;
+      return _this.icon_data = db != null ? db.collection("icon_data") : void 0;
     };
   })(this));
 
+  send_icon = function(res, feed_id, etag, color, data) {
+    var body;
+    console.log(" ---> Req: " + feed_id + ", etag: " + etag + "/" + color + " ");
+    res.header('etag', color);
+    body = new Buffer(data, 'base64');
+    res.set("Content-Type", "image/png");
+    return res.status(200).send(body);
+  };
+
+  redirect_to_default = function(res, feed_id, etag, docs, err) {
+    console.log((" ---> Redirect: " + feed_id + ", etag: " + etag + "/" + (docs != null ? docs.color : void 0) + " ") + (err ? "(err: " + err + ")" : ""));
+    if (DEV) {
+      return res.redirect('/media/img/icons/circular/world.png');
+    } else {
+      return res.redirect('https://www.newsblur.com/media/img/icons/circular/world.png');
+    }
+  };
+
   app.get(/\/rss_feeds\/icon\/(\d+)\/?/, (function(_this) {
     return function(req, res) {
       var etag, feed_id;
@@ -47,23 +66,23 @@
       return _this.collection.findOne({
         _id: feed_id
       }, function(err, docs) {
-        var body;
         if (!err && etag && docs && (docs != null ? docs.color : void 0) === etag) {
           console.log((" ---> Cached: " + feed_id + ", etag: " + etag + "/" + (docs != null ? docs.color : void 0) + " ") + (err ? "(err: " + err + ")" : ""));
           return res.sendStatus(304);
         } else if (!err && docs && docs.data) {
-          console.log((" ---> Req: " + feed_id + ", etag: " + etag + "/" + (docs != null ? docs.color : void 0) + " ") + (err ? "(err: " + err + ")" : ""));
-          res.header('etag', docs.color);
-          body = new Buffer(docs.data, 'base64');
-          res.set("Content-Type", "image/png");
-          return res.status(200).send(body);
+          return send_icon(res, feed_id, etag, docs.color, docs.data);
+        } else if (!err && docs && docs.icon_hash) {
+          return _this.icon_data.findOne({
+            _id: docs.icon_hash
+          }, function(err, icon) {
+            if (!err && icon && icon.data) {
+              return send_icon(res, feed_id, etag, docs.color, icon.data);
+            } else {
+              return redirect_to_default(res, feed_id, etag, docs, err);
+            }
+          });
         } else {
-          console.log((" ---> Redirect: " + feed_id + ", etag: " + etag + "/" + (docs != null ? docs.color : void 0) + " ") + (err ? "(err: " + err + ")" : ""));
-          if (DEV) {
-            return res.redirect('/media/img/icons/circular/world.png');
-          } else {
-            return res.redirect('https://www.newsblur.com/media/img/icons/circular/world.png');
-          }
+          return redirect_to_default(res, feed_id, etag, docs, err);
         }
       });
     };
@@ -370,6 +370,10 @@ CELERY_ROUTES = {
         "queue": "update_feeds",
         "binding_key": "update_feeds"
     },
+    "fetch-page-and-icon": {
+        "queue": "page_icons",
+        "binding_key": "page_icons"
+    },
     "beat-tasks": {
         "queue": "beat_tasks",
         "binding_key": "beat_tasks"
@@ -404,6 +408,11 @@ CELERY_QUEUES = {
         "exchange_type": "direct",
         "binding_key": "update_feeds"
     },
+    "page_icons": {
+        "exchange": "page_icons",
+        "exchange_type": "direct",
+        "binding_key": "page_icons"
+    },
     "beat_tasks": {
         "exchange": "beat_tasks",
         "exchange_type": "direct",
@@ -0,0 +1,179 @@
+import os
+import time
+import socket
+import threading
+import collections
+import dns.resolver
+import dns.exception
+from utils import log as logging
+
+# Hostnames remembered per process.
+DNS_CACHE_MAX_HOSTS = 4096
+# Answers are kept for their record's TTL, clamped to this range.
+DNS_CACHE_MIN_TTL = 60
+DNS_CACHE_MAX_TTL = 60 * 60
+# Hostnames that don't exist are remembered for this long.
+DNS_CACHE_NEGATIVE_TTL = 10 * 60
+# Seconds to wait on the resolver before falling back to the system's.
+DNS_CACHE_LIFETIME = 5
+
+_system_getaddrinfo = socket.getaddrinfo
+
+
+class DNSCache(object):
+    """ Process-wide cache of A/AAAA lookups for feed, page and icon fetches.
+        Answers live for their TTL and the least recently used hosts are
+        evicted once the cache is full. NXDOMAIN is cached too, so feeds on
+        dead domains fail right away instead of waiting on the resolver.
+
+        Only lookups made inside `resolving()` go through the cache, which
+        `utils.http_pool` wraps around every request. Everything else, like
+        database and redis hosts from /etc/hosts, uses the system resolver.
+    """
+
+    def __init__(self, max_hosts=DNS_CACHE_MAX_HOSTS):
+        self.max_hosts = max_hosts
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.hosts = collections.OrderedDict()
+        self.resolver = dns.resolver.Resolver()
+        self.resolver.lifetime = DNS_CACHE_LIFETIME
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.fallbacks = 0
+
+    def install(self):
+        if socket.getaddrinfo is not self.getaddrinfo:
+            socket.getaddrinfo = self.getaddrinfo
+
+    def resolving(self):
+        return _Resolving(self.local)
+
+    @staticmethod
+    def is_cacheable(host):
+        if not host or not isinstance(host, basestring) or '.' not in host:
+            return False
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                socket.inet_pton(family, host)
+                return False
+            except (socket.error, ValueError):
+                pass
+        return True
+
+    def getaddrinfo(self, host, port, family=0, socktype=0, proto=0, flags=0):
+        if not getattr(self.local, 'active', False) or not self.is_cacheable(host):
+            return _system_getaddrinfo(host, port, family, socktype, proto, flags)
+
+        addresses = self.lookup(host.lower().rstrip('.'))
+        if addresses is None:
+            return _system_getaddrinfo(host, port, family, socktype, proto, flags)
+        if not addresses:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+
+        results = []
+        for address in addresses:
+            try:
+                results.extend(_system_getaddrinfo(address, port, family, socktype, proto,
+                                                   flags | socket.AI_NUMERICHOST))
+            except socket.gaierror:
+                # An IPv6 address on an IPv4 only request, for instance.
+                continue
+        if not results:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+
+        return results
+
+    def lookup(self, host):
+        """ Returns the host's addresses, an empty list if it doesn't exist,
+            or None when the resolver can't say and the system should try.
+        """
+        now = time.time()
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked fetcher workers keep their own cache and sockets.
+                self.reset()
+            if host in self.hosts:
+                expires, addresses = self.hosts.pop(host)
+                if expires > now:
+                    self.hosts[host] = (expires, addresses)
+                    if addresses:
+                        self.hits += 1
+                    else:
+                        self.negative_hits += 1
+                    return addresses
+            self.misses += 1
+
+        addresses, ttl = self.resolve(host)
+        if addresses is None:
+            with self.lock:
+                self.fallbacks += 1
+            return
+
+        with self.lock:
+            self.hosts[host] = (now + ttl, addresses)
+            while len(self.hosts) > self.max_hosts:
+                self.hosts.popitem(last=False)
+
+        return addresses
+
+    def resolve(self, host):
+        addresses = []
+        ttls = []
+        for rdtype in ('A', 'AAAA'):
+            try:
+                answer = self.resolver.query(host, rdtype)
+            except dns.resolver.NXDOMAIN:
+                return [], DNS_CACHE_NEGATIVE_TTL
+            except dns.resolver.NoAnswer:
+                continue
+            except (dns.exception.DNSException, socket.error):
+                return None, None
+            addresses.extend(rdata.address for rdata in answer)
+            ttls.append(answer.rrset.ttl)
+
+        if not addresses:
+            return [], DNS_CACHE_NEGATIVE_TTL
+
+        ttl = max(DNS_CACHE_MIN_TTL, min(min(ttls), DNS_CACHE_MAX_TTL))
+        return addresses, ttl
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            'hosts': len(self.hosts),
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'fallbacks': self.fallbacks,
+            'hit_rate': float(self.hits + self.negative_hits) / lookups if lookups else 0,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        logging.debug("   ---> ~FBDNS cache: ~SB%s~SN hosts, ~SB%s~SN hits, ~SB%s~SN NXDOMAIN hits, "
+                      "~SB%s~SN misses, ~SB%s~SN fallbacks (~SB%.1f%%~SN hit rate)" % (
+                      stats['hosts'], stats['hits'], stats['negative_hits'],
+                      stats['misses'], stats['fallbacks'], stats['hit_rate'] * 100))
+
+
+class _Resolving(object):
+
+    def __init__(self, local):
+        self.local = local
+
+    def __enter__(self):
+        self.previous = getattr(self.local, 'active', False)
+        self.local.active = True
+
+    def __exit__(self, *exc_info):
+        self.local.active = self.previous
+
+
+dns_cache = DNSCache()
+dns_cache.install()
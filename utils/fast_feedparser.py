@@ -0,0 +1,377 @@
+"""
+Streaming fast path for well-formed RSS 2.0 and Atom 1.0 feeds.
+
+Reads the document incrementally with lxml and stops after `max_entries`
+entries, so giant feeds don't pay to parse stories we would throw away. The
+result mimics what `feedparser.parse` returns for the fields ProcessFeed and
+`pre_process_story` read. Anything else, like RSS 1.0, Atom 0.3, or input
+that isn't well-formed XML, returns None and the caller falls back to the
+vendored feedparser.
+
+Entry HTML isn't sanitized during parsing. ProcessFeed calls
+`sanitize_entry` only for entries it is going to store.
+"""
+import hashlib
+import urlparse
+from StringIO import StringIO
+from lxml import etree
+from utils import feedparser
+from utils.feedparser import FeedParserDict
+
+ATOM_NS = 'http://www.w3.org/2005/Atom'
+CONTENT_NS = 'http://purl.org/rss/1.0/modules/content/'
+DC_NS = 'http://purl.org/dc/elements/1.1/'
+MEDIA_NS = 'http://search.yahoo.com/mrss/'
+
+RSS_ITEM = 'item'
+ATOM_ENTRY = '{%s}entry' % ATOM_NS
+
+HTML_TYPES = (u'text/html', u'application/xhtml+xml')
+
+# Elements feedparser reads as entry fields wherever they're nested, so an
+# unknown element wrapping one of them (like an `og` block with its own
+# `description`) changes feedparser's result in ways not worth copying.
+NESTED_FIELD_NAMESPACES = (None, ATOM_NS, CONTENT_NS, DC_NS)
+NESTED_FIELD_NAMES = set(['title', 'link', 'id', 'guid', 'description', 'summary', 'content',
+                          'encoded', 'author', 'creator', 'pubDate', 'published', 'updated',
+                          'date', 'category', 'subject'])
+
+
+class NotStreamable(Exception):
+    pass
+
+
+def parse(data, response_headers=None, max_entries=100):
+    """ Returns a FeedParserDict, or None when the feed should go through
+        feedparser instead.
+    """
+    if not data or not isinstance(data, str):
+        return
+
+    headers = dict((k.lower(), v) for k, v in (response_headers or {}).items())
+    base = headers.get('content-location', u'')
+    root = None
+    entries = []
+    context = etree.iterparse(StringIO(data), events=('start', 'end'),
+                              resolve_entities=False, no_network=True,
+                              huge_tree=False)
+    try:
+        for event, elem in context:
+            if root is None:
+                root = elem
+                if root.tag == 'rss':
+                    version, entry_tag, parse_entry = u'rss20', RSS_ITEM, _parse_rss_item
+                elif root.tag == '{%s}feed' % ATOM_NS:
+                    version, entry_tag, parse_entry = u'atom10', ATOM_ENTRY, _parse_atom_entry
+                else:
+                    return
+                continue
+            if event != 'end' or elem.tag != entry_tag:
+                continue
+            entries.append(parse_entry(elem, base))
+            elem.clear()
+            if len(entries) >= max_entries:
+                break
+    except (etree.XMLSyntaxError, ValueError, NotStreamable):
+        return
+
+    if root is None or not entries:
+        return
+
+    if version == u'rss20':
+        channel = root.find('channel')
+        if channel is None:
+            return
+        feed = _parse_rss_channel(channel, base)
+    else:
+        feed = _parse_atom_feed(root, base)
+
+    result = FeedParserDict()
+    result['feed'] = feed
+    result['entries'] = entries
+    result['bozo'] = 0
+    result['encoding'] = (root.getroottree().docinfo.encoding or u'utf-8').lower()
+    result['version'] = version
+    result['namespaces'] = {}
+    result['streamed'] = True
+    if response_headers:
+        result['headers'] = response_headers
+    if headers.get('etag'):
+        result['etag'] = headers['etag']
+    if headers.get('last-modified'):
+        result['modified'] = headers['last-modified']
+        result['modified_parsed'] = feedparser._parse_date(headers['last-modified'])
+
+    return result
+
+
+def sanitize_entry(entry):
+    """ Resolves relative links and strips dangerous markup from an entry's
+        HTML, the same way feedparser does while parsing. Safe to call twice.
+    """
+    if entry.get('sanitized'):
+        return entry
+    details = list(entry.get('content', []))
+    if 'summary_detail' in entry:
+        details.append(entry['summary_detail'])
+    for detail in details:
+        if detail.get('type') not in HTML_TYPES or not detail.get('value'):
+            continue
+        value = detail['value']
+        if feedparser.RESOLVE_RELATIVE_URIS and detail.get('base'):
+            value = feedparser._resolveRelativeURIs(value, detail['base'], 'utf-8', detail['type'])
+        if feedparser.SANITIZE_HTML:
+            value = feedparser._sanitizeHTML(value, 'utf-8', detail['type'])
+        if not isinstance(value, unicode):
+            value = value.decode('utf-8', 'ignore')
+        detail['value'] = value
+    if 'summary_detail' in entry:
+        entry['summary'] = entry['summary_detail']['value']
+    elif 'summary' in entry:
+        # Copied from the content, see _add_content.
+        entry['summary'] = entry['content'][0]['value']
+    entry['sanitized'] = True
+
+    return entry
+
+
+def _text(elem):
+    if elem is None:
+        return u''
+    if not len(elem):
+        return _clean(elem.text or u'')
+    # Unescaped markup inside a text element, keep it as HTML.
+    inner = (elem.text or u'') + u''.join(etree.tostring(child, encoding=unicode) for child in elem)
+    return _clean(inner)
+
+
+def _person(elem):
+    # An RSS author can carry Atom-style children, only the name is wanted.
+    for child in elem:
+        if isinstance(child.tag, basestring) and etree.QName(child).localname == 'name':
+            return _text(child)
+    return _clean(elem.text or u'')
+
+
+def _xhtml(elem):
+    div = elem.find('{http://www.w3.org/1999/xhtml}div')
+    if div is None:
+        return _text(elem)
+    return _text(div)
+
+
+def _clean(value):
+    if not isinstance(value, unicode):
+        value = value.decode('utf-8', 'ignore')
+    return value.translate(feedparser._cp1252).strip()
+
+
+def _base(elem, base):
+    xml_base = elem.get('{http://www.w3.org/XML/1998/namespace}base')
+    if xml_base:
+        return urlparse.urljoin(base, xml_base)
+    return base
+
+
+def _url(base, href):
+    href = (href or u'').strip()
+    if not base or not href:
+        return href
+    try:
+        return urlparse.urljoin(base, href)
+    except ValueError:
+        return href
+
+
+def _date(value):
+    return feedparser._parse_date(value) if value else None
+
+
+def _detail(value, _type, base):
+    return FeedParserDict(type=_type, value=value, base=base, language=None)
+
+
+def _atom_type(elem):
+    _type = elem.get('type', u'text')
+    return {u'text': u'text/plain', u'html': u'text/html', u'xhtml': u'application/xhtml+xml'}.get(_type, _type)
+
+
+def _atom_link(elem, base):
+    rel = elem.get('rel', u'alternate')
+    default_type = u'application/atom+xml' if rel == u'self' else u'text/html'
+    link = FeedParserDict(rel=rel, type=elem.get('type', default_type),
+                          href=_url(base, elem.get('href')))
+    if elem.get('length'):
+        link['length'] = elem.get('length')
+    return link
+
+
+def _atom_author(elem):
+    name = _text(elem.find('{%s}name' % ATOM_NS))
+    email = _text(elem.find('{%s}email' % ATOM_NS))
+    if name and email:
+        return u'%s (%s)' % (name, email)
+    return name or email
+
+
+def _add_summary(entry, detail):
+    # Like feedparser, a summary that follows the content is kept as more content.
+    if 'content' in entry:
+        entry['content'].append(detail)
+    else:
+        entry['summary_detail'] = detail
+        entry['summary'] = detail['value']
+
+
+def _add_content(entry, detail, copy_to_summary=True):
+    entry.setdefault('content', []).append(detail)
+    # feedparser fills in a missing summary from the content.
+    if copy_to_summary and 'summary' not in entry:
+        entry['summary'] = detail['value']
+
+
+def _check_nested_fields(elem):
+    for descendant in elem.iterdescendants():
+        if not isinstance(descendant.tag, basestring):
+            continue
+        qname = etree.QName(descendant)
+        if qname.namespace in NESTED_FIELD_NAMESPACES and qname.localname in NESTED_FIELD_NAMES:
+            raise NotStreamable(qname.text)
+
+
+def _digest(elem):
+    return hashlib.sha1(etree.tostring(elem)).hexdigest()
+
+
+def _parse_rss_channel(channel, base):
+    feed = FeedParserDict(links=[])
+    for child in channel:
+        if child.tag == 'title':
+            feed['title'] = _text(child)
+        elif child.tag == 'link':
+            feed['link'] = _url(base, _text(child))
+            feed['links'].append(FeedParserDict(rel=u'alternate', type=u'text/html', href=feed['link']))
+        elif child.tag == 'description':
+            feed['subtitle'] = _text(child)
+        elif child.tag == '{%s}link' % ATOM_NS:
+            feed['links'].append(_atom_link(child, base))
+    return feed
+
+
+def _parse_atom_feed(root, base):
+    base = _base(root, base)
+    feed = FeedParserDict(links=[])
+    for child in root:
+        if child.tag == '{%s}title' % ATOM_NS:
+            feed['title'] = _text(child)
+        elif child.tag == '{%s}subtitle' % ATOM_NS:
+            feed['subtitle'] = _text(child)
+        elif child.tag == '{%s}id' % ATOM_NS:
+            feed['id'] = _text(child)
+        elif child.tag == '{%s}link' % ATOM_NS:
+            link = _atom_link(child, base)
+            feed['links'].append(link)
+            if link['rel'] == u'alternate' and 'link' not in feed:
+                feed['link'] = link['href']
+    return feed
+
+
+def _parse_media(entry, child):
+    media = FeedParserDict(child.attrib)
+    if child.tag == '{%s}content' % MEDIA_NS:
+        entry.setdefault('media_content', []).append(media)
+    elif child.tag == '{%s}thumbnail' % MEDIA_NS:
+        entry.setdefault('media_thumbnail', []).append(media)
+
+
+def _parse_rss_item(item, base):
+    entry = FeedParserDict(links=[], digest=_digest(item))
+    guid = None
+    for child in item:
+        tag = child.tag
+        if tag == 'title':
+            entry['title'] = _text(child)
+        elif tag == 'link':
+            entry['link'] = _url(base, _text(child))
+            entry['links'].append(FeedParserDict(rel=u'alternate', type=u'text/html', href=entry['link']))
+        elif tag == 'guid':
+            guid = child
+            entry['id'] = _text(child)
+        elif tag == 'description':
+            _add_summary(entry, _detail(_text(child), u'text/html', base))
+        elif tag == '{%s}encoded' % CONTENT_NS:
+            _add_content(entry, _detail(_text(child), u'text/html', base))
+        elif tag == 'author' or tag == '{%s}creator' % DC_NS:
+            entry['author'] = _person(child)
+        elif tag == 'pubDate':
+            entry['published'] = _text(child)
+            entry['published_parsed'] = _date(entry['published'])
+        elif tag == '{%s}date' % DC_NS:
+            entry['updated'] = _text(child)
+            entry['updated_parsed'] = _date(entry['updated'])
+        elif tag == 'category':
+            term = _text(child)
+            if term:
+                entry.setdefault('tags', []).append(FeedParserDict(term=term, scheme=child.get('domain'),
+                                                                   label=None))
+        elif tag == 'enclosure':
+            entry['links'].append(FeedParserDict(rel=u'enclosure', href=_url(base, child.get('url')),
+                                                 type=child.get('type', u''),
+                                                 length=child.get('length', u'')))
+        elif isinstance(tag, basestring) and tag.startswith('{%s}' % MEDIA_NS):
+            _parse_media(entry, child)
+        elif len(child):
+            _check_nested_fields(child)
+
+    # An RSS guid is the permalink unless it says otherwise.
+    if (guid is not None and 'link' not in entry and entry.get('id') and
+        guid.get('isPermaLink', 'true').lower() != 'false'):
+        entry['link'] = entry['id']
+
+    return entry
+
+
+def _parse_atom_entry(elem, base):
+    base = _base(elem, base)
+    entry = FeedParserDict(links=[], digest=_digest(elem))
+    for child in elem:
+        tag = child.tag
+        if tag == '{%s}title' % ATOM_NS:
+            entry['title'] = _text(child)
+        elif tag == '{%s}link' % ATOM_NS:
+            link = _atom_link(child, base)
+            entry['links'].append(link)
+            if link['rel'] == u'alternate' and 'link' not in entry:
+                entry['link'] = link['href']
+        elif tag == '{%s}id' % ATOM_NS:
+            entry['id'] = _text(child)
+        elif tag in ('{%s}summary' % ATOM_NS, '{%s}content' % ATOM_NS):
+            _type = _atom_type(child)
+            copy_to_summary = _type == u'text/plain' or _type in HTML_TYPES
+            value = _xhtml(child) if _type == u'application/xhtml+xml' else _text(child)
+            if _type == u'application/xhtml+xml':
+                _type = u'text/html'
+            detail = _detail(value, _type, _base(child, base))
+            if tag == '{%s}summary' % ATOM_NS:
+                _add_summary(entry, detail)
+            else:
+                _add_content(entry, detail, copy_to_summary)
+        elif tag == '{%s}author' % ATOM_NS:
+            entry['author'] = _atom_author(child)
+        elif tag == '{%s}published' % ATOM_NS:
+            entry['published'] = _text(child)
+            entry['published_parsed'] = _date(entry['published'])
+        elif tag == '{%s}updated' % ATOM_NS:
+            entry['updated'] = _text(child)
+            entry['updated_parsed'] = _date(entry['updated'])
+        elif tag == '{%s}category' % ATOM_NS:
+            if child.get('term'):
+                entry.setdefault('tags', []).append(FeedParserDict(term=child.get('term'),
+                                                                   scheme=child.get('scheme'),
+                                                                   label=child.get('label')))
+        elif isinstance(tag, basestring) and tag.startswith('{%s}' % MEDIA_NS):
+            _parse_media(entry, child)
+        elif len(child) and tag != '{%s}source' % ATOM_NS:
+            _check_nested_fields(child)
+
+    return entry
@@ -1,31 +1,37 @@
+import sys
 import time
 import datetime
 import traceback
 import multiprocessing
+import threading
+import collections
 import urllib2
 import xml.sax
 import redis
 import random
-import pymongo
 import re
 import requests
 import dateutil.parser
 import isodate
 import urlparse
+from multiprocessing.pool import ThreadPool
+from requests.structures import CaseInsensitiveDict
 from django.conf import settings
-from django.db import IntegrityError
-from django.core.cache import cache
+from django.db import IntegrityError, connection
 from apps.reader.models import UserSubscription
+from apps.reader.tasks import ComputeFeedScores
 from apps.rss_feeds.models import Feed, MStory
-from apps.rss_feeds.page_importer import PageImporter
-from apps.rss_feeds.icon_importer import IconImporter
 from apps.notifications.tasks import QueueNotifications, MUserFeedNotification
 from apps.push.models import PushSubscription
 from apps.statistics.models import MAnalyticsFetcher, MStatistics
 from utils import feedparser
+from utils import fast_feedparser
 from utils.story_functions import pre_process_story, strip_tags, linkify
 from utils import log as logging
-from utils.feed_functions import timelimit, TimeoutError
+from utils import http_pool
+from utils.dns_cache import dns_cache
+from utils.host_throttle import HostThrottle, is_throttling_status
+from utils.feed_functions import timelimit, TimeoutError, chunks
 from qurl import qurl
 from BeautifulSoup import BeautifulSoup
 from django.utils import feedgenerator
@@ -43,27 +49,79 @@ from utils.json_fetcher import JSONFetcher
 # http://feedjack.googlecode.com
 
 FEED_OK, FEED_SAME, FEED_ERRPARSE, FEED_ERRHTTP, FEED_ERREXC = range(5)
+
+# A download is reused by feeds in its fetch group for this long.
+SHARED_FETCH_SECONDS = 5 * 60
+# Downloads larger than this aren't kept around for other feeds.
+SHARED_FETCH_MAX_BYTES = 2 * 1024 * 1024
+
+
+class SharedFetches:
+    """ Feed downloads kept briefly in this process, keyed by every normalized
+        address the download went through on its way to the final url. Feeds
+        that point at the same address under trivially different urls, or
+        that redirect to the same place, are tasked together (see
+        `Feed.fetch_group_keys`), and a feed whose own address is one of those
+        keys is handed the download so the publisher is only asked once.
+    """
+    def __init__(self, max_age=SHARED_FETCH_SECONDS, max_entries=32):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.responses = collections.OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, *keys):
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                if key in self.responses:
+                    fetched, response = self.responses[key]
+                    if now - fetched <= self.max_age:
+                        return response
+    
+    def put(self, keys, response):
+        now = time.time()
+        with self.lock:
+            for key in set(k for k in keys if k):
+                self.responses.pop(key, None)
+                self.responses[key] = (now, response)
+            while len(self.responses) > self.max_entries:
+                self.responses.popitem(last=False)
+
+shared_fetches = SharedFetches()
+
+
+class DownloadedResponse:
+    """ Stands in for a requests Response in the parse stage of a pipeline,
+        rebuilt from the status, url, headers and body the download stage
+        handed over.
+    """
+    def __init__(self, status_code, url, headers, content):
+        self.status_code = status_code
+        self.url = url
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.history = []
     
     
 class FetchFeed:
-    def __init__(self, feed_id, options):
-        self.feed = Feed.get_by_id(feed_id)
+    def __init__(self, feed_id, options, feed=None):
+        self.feed = feed or Feed.get_by_id(feed_id)
         self.options = options
         self.fpf = None
         self.raw_feed = None
+        self.fingerprint = None
+        self.request_params = None
+        self.response = None
+        self.download_error = None
+        self.download_duration = 0
     
-    @timelimit(30)
-    def fetch(self):
-        """ 
-        Uses requests to download the feed, parsing it in feedparser. Will be storified later.
+    def conditional_request(self):
+        """ Address and cache validators for this fetch. Decided once per
+            FetchFeed, so a download and its later parse agree on them.
         """
-        start = time.time()
-        identity = self.get_identity()
-        log_msg = u'%2s ---> [%-30s] ~FYFetching feed (~FB%d~FY), last update: %s' % (identity,
-                                                            self.feed.log_title[:30],
-                                                            self.feed.id,
-                                                            datetime.datetime.now() - self.feed.last_update)
-        logging.debug(log_msg)
+        if self.request_params:
+            return self.request_params
         
         etag = self.feed.etag
         modified = self.feed.last_modified.utctimetuple()[:7] if self.feed.last_modified else None
@@ -80,6 +138,131 @@ class FetchFeed:
             modified = None
             etag = None
         
+        self.request_params = address, etag, modified
+        return self.request_params
+    
+    def fetches_from_api(self, address):
+        return ('youtube.com' in address or
+                re.match(r'(https?)?://twitter.com/\w+/?$', qurl(address, remove=['_'])) or
+                re.match(r'(.*?)facebook.com/\w+/?$', qurl(address, remove=['_'])))
+    
+    @timelimit(30)
+    def download(self):
+        """ Downloads the raw feed without parsing it, for `fetch` to pick up
+            later, possibly in another process. Fat pings and feeds fetched
+            through an API are left entirely to `fetch`.
+        """
+        start = time.time()
+        address, etag, modified = self.conditional_request()
+        if self.options.get('fpf') or self.fetches_from_api(address):
+            return
+        
+        try:
+            self.response = self.shared_http_get(address, etag, modified)
+        except Exception, e:
+            self.download_error = e
+        self.download_duration = time.time() - start
+        
+        return self.response
+    
+    def download_result(self):
+        """ The outcome of `download` as plain values, cheap to pickle over to
+            a parse process and picked back up there with `use_download`.
+        """
+        error = self.download_error
+        if error and not isinstance(error, TimeoutError):
+            # Exceptions with live requests attached don't pickle.
+            error = Exception(repr(error)[:200])
+        result = dict(request_params=self.request_params, error=error,
+                      duration=self.download_duration, force=self.options.get('force'))
+        if self.response is not None:
+            result.update(status_code=self.response.status_code, url=self.response.url,
+                          headers=dict(self.response.headers), content=self.response.content)
+        return result
+    
+    def use_download(self, download):
+        """ Makes `fetch` parse a download made by another process instead of
+            making its own request.
+        """
+        self.request_params = download['request_params']
+        self.download_error = download['error']
+        self.download_duration = download['duration']
+        if download['force']:
+            self.options = dict(self.options, force=True)
+        if download.get('status_code'):
+            self.response = DownloadedResponse(download['status_code'], download['url'],
+                                               download['headers'], download['content'])
+        return self
+    
+    def http_get(self, address, etag, modified):
+        headers = self.feed.fetch_headers()
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            # format into an RFC 1123-compliant timestamp. We can't use
+            # time.strftime() since the %a and %b directives can be affected
+            # by the current locale, but RFC 2616 states that dates must be
+            # in English.
+            short_weekdays = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+            months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+            modified_header = '%s, %02d %s %04d %02d:%02d:%02d GMT' % (short_weekdays[modified[6]], modified[2], months[modified[1] - 1], modified[0], modified[3], modified[4], modified[5])
+            headers['If-Modified-Since'] = modified_header
+        if etag or modified:
+            headers['A-IM'] = 'feed'
+        raw_feed = http_pool.get(address, headers=headers)
+        HostThrottle().record(address, raw_feed.status_code,
+                              retry_after=raw_feed.headers.get('Retry-After'))
+        if raw_feed.status_code >= 400 and not is_throttling_status(raw_feed.status_code):
+            logging.debug("   ***> [%-30s] ~FRFeed fetch was %s status code, trying fake user agent: %s" % (self.feed.log_title[:30], raw_feed.status_code, raw_feed.headers))
+            raw_feed = http_pool.get(self.feed.feed_address, headers=self.feed.fetch_headers(fake=True))
+        if raw_feed.history and raw_feed.status_code < 400:
+            Feed.record_fetch_redirect(self.feed.feed_address, raw_feed.url)
+        elif raw_feed.status_code < 400 and self.options.get('fetch_redirected'):
+            # No longer redirects, stop grouping it with where it used to go.
+            Feed.clear_fetch_redirect(self.feed.feed_address)
+        
+        return raw_feed
+    
+    def shared_http_get(self, address, etag, modified):
+        """ Same as `http_get`, but when the task was given a fetch group,
+            reuses another feed's download that started at or was redirected
+            through this feed's own address. Recorded redirects are never
+            trusted here, they can be a week out of date.
+        """
+        if not self.options.get('share_fetches') or address != self.feed.feed_address:
+            # Forced fetches add a cache buster and always go out.
+            return self.http_get(address, etag, modified)
+        
+        normalized = Feed.normalized_fetch_address(address)
+        raw_feed = shared_fetches.get(normalized)
+        if raw_feed is not None:
+            logging.debug(u'   ---> [%-30s] ~FBReusing download of ~SB%s~SN from its fetch group' % (
+                          self.feed.log_title[:30], raw_feed.url))
+            return raw_feed
+        
+        raw_feed = self.http_get(address, etag, modified)
+        if (raw_feed.status_code == 200 and raw_feed.content and
+            len(raw_feed.content) <= SHARED_FETCH_MAX_BYTES):
+            chain = [address] + [response.url for response in raw_feed.history] + [raw_feed.url]
+            shared_fetches.put([Feed.normalized_fetch_address(url) for url in chain], raw_feed)
+        
+        return raw_feed
+    
+    @timelimit(30)
+    def fetch(self):
+        """ 
+        Uses requests to download the feed, parsing it in feedparser. Will be storified later.
+        """
+        start = time.time()
+        identity = self.get_identity()
+        log_msg = u'%2s ---> [%-30s] ~FYFetching feed (~FB%d~FY), last update: %s' % (identity,
+                                                            self.feed.log_title[:30],
+                                                            self.feed.id,
+                                                            datetime.datetime.now() - self.feed.last_update)
+        logging.debug(log_msg)
+        
+        address, etag, modified = self.conditional_request()
+        
         if self.options.get('feed_xml'):
             logging.debug(u'   ---> [%-30s] ~FM~BKFeed has been fat pinged. Ignoring fat: %s' % (
                           self.feed.log_title[:30], len(self.options.get('feed_xml'))))
@@ -115,26 +298,13 @@ class FetchFeed:
                 return FEED_ERRHTTP, None
             self.fpf = feedparser.parse(facebook_feed)
         
+        if isinstance(self.download_error, TimeoutError):
+            raise self.download_error
         if not self.fpf:
             try:
-                headers = self.feed.fetch_headers()
-                if etag:
-                    headers['If-None-Match'] = etag
-                if modified:
-                    # format into an RFC 1123-compliant timestamp. We can't use
-                    # time.strftime() since the %a and %b directives can be affected
-                    # by the current locale, but RFC 2616 states that dates must be
-                    # in English.
-                    short_weekdays = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
-                    months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-                    modified_header = '%s, %02d %s %04d %02d:%02d:%02d GMT' % (short_weekdays[modified[6]], modified[2], months[modified[1] - 1], modified[0], modified[3], modified[4], modified[5])
-                    headers['If-Modified-Since'] = modified_header
-                if etag or modified:
-                    headers['A-IM'] = 'feed'
-                raw_feed = requests.get(address, headers=headers)
-                if raw_feed.status_code >= 400:
-                    logging.debug("   ***> [%-30s] ~FRFeed fetch was %s status code, trying fake user agent: %s" % (self.feed.log_title[:30], raw_feed.status_code, raw_feed.headers))
-                    raw_feed = requests.get(self.feed.feed_address, headers=self.feed.fetch_headers(fake=True))
+                if self.download_error:
+                    raise self.download_error
+                raw_feed = self.response or self.shared_http_get(address, etag, modified)
                 
                 if raw_feed.content and 'application/json' in raw_feed.headers.get('Content-Type', ""):
                     # JSON Feed
@@ -145,11 +315,23 @@ class FetchFeed:
                         return FEED_ERRHTTP, None
                     self.fpf = feedparser.parse(json_feed)
                 elif raw_feed.content and raw_feed.status_code < 400:
+                    self.fingerprint = Feed.fingerprint_feed_body(raw_feed.content,
+                        normalize=getattr(settings, 'NORMALIZE_FEED_FINGERPRINTS', True))
+                    if (not self.options.get('force') and 
+                        self.fingerprint == self.feed.body_fingerprint):
+                        logging.debug(u'   ---> [%-30s] ~FYFeed body unchanged, skipping parse: ~FM%.4ss' % (
+                                      self.feed.log_title[:30], time.time() - start))
+                        return FEED_SAME, None
                     response_headers = raw_feed.headers
                     response_headers['Content-Location'] = raw_feed.url
                     self.raw_feed = smart_unicode(raw_feed.content)
-                    self.fpf = feedparser.parse(self.raw_feed,
-                                                response_headers=response_headers)
+                    if getattr(settings, 'STREAM_FEED_PARSING', True):
+                        self.fpf = fast_feedparser.parse(raw_feed.content,
+                                                         response_headers=response_headers,
+                                                         max_entries=100)
+                    if not self.fpf:
+                        self.fpf = feedparser.parse(self.raw_feed,
+                                                    response_headers=response_headers)
                     if self.options.get('debug', False):
                         logging.debug(" ---> [%-30s] ~FBFeed fetch status %s: %s length / %s" % (self.feed.log_title[:30], raw_feed.status_code, len(smart_unicode(raw_feed.content)), raw_feed.headers))
             except Exception, e:
@@ -342,14 +524,16 @@ class FetchFeed:
         
         
 class ProcessFeed:
-    def __init__(self, feed_id, fpf, options, raw_feed=None):
+    def __init__(self, feed_id, fpf, options, raw_feed=None, feed=None):
         self.feed_id = feed_id
         self.options = options
         self.fpf = fpf
         self.raw_feed = raw_feed
+        self.feed = feed
     
     def refresh_feed(self):
-        self.feed = Feed.get_by_id(self.feed_id)
+        if not self.feed:
+            self.feed = Feed.get_by_id(self.feed_id)
         if self.feed_id != self.feed.pk:
             logging.debug(" ***> Feed has changed: from %s to %s" % (self.feed_id, self.feed.pk))
             self.feed_id = self.feed.pk
@@ -499,11 +683,24 @@ class ProcessFeed:
         single_permalink = len(permalinks_seen) == 1
         replace_permalinks = single_permalink and permalink_difference
         
+        # Streamed entries are unsanitized. Skip the ones already processed
+        # unchanged last time, and sanitize only what's left.
+        streamed = self.fpf.get('streamed')
+        processed_digests = set()
+        unchanged_entries = 0
+        if streamed and not self.options['force']:
+            processed_digests = self.feed.processed_entry_digests
+        
         # Compare new stories to existing stories, adding and updating
         start_date = datetime.datetime.utcnow()
         story_hashes = []
         stories = []
         for entry in self.fpf.entries:
+            if streamed:
+                if entry['digest'] in processed_digests:
+                    unchanged_entries += 1
+                    continue
+                fast_feedparser.sanitize_entry(entry)
             story = pre_process_story(entry, self.fpf.encoding)
             if not story['title'] and not story['story_content']: continue
             if story.get('published') < start_date:
@@ -552,6 +749,7 @@ class ProcessFeed:
         ret_values = self.feed.add_update_stories(stories, existing_stories,
                                                   verbose=self.options['verbose'],
                                                   updates_off=self.options['updates_off'])
+        ret_values['same'] += unchanged_entries
 
         # PubSubHubbub
         if (hasattr(self.fpf, 'feed') and 
@@ -608,6 +806,9 @@ class ProcessFeed:
             if MStatistics.get('raw_feed', None) == self.feed.pk:
                 self.feed.save_raw_feed(self.raw_feed, fetch_date)
         self.feed.save_feed_history(200, "OK", date=fetch_date)
+        # add_update_stories caps updates per fetch, leave the rest for next time
+        if streamed and ret_values['updated'] < 3:
+            self.feed.set_processed_entry_digests([e['digest'] for e in self.fpf.entries])
 
         if self.options['verbose']:
             logging.debug(u'   ---> [%-30s] ~FBTIME: feed parse in ~FM%.4ss' % (
@@ -615,7 +816,283 @@ class ProcessFeed:
         
         return FEED_OK, ret_values
 
+
+class FeedFetchSession:
+    """ Holds a feed for the length of a single fetch. The feed is loaded once,
+        and every `Feed.save` made while the session is open only marks fields
+        as dirty. `close` writes them all in a single UPDATE and, when queries
+        are being logged, counts the SQL statements the fetch issued, along with
+        Mongo and Redis commands when the raw log middlewares are instrumenting
+        them. Otherwise the counts stay None.
+    """
+    def __init__(self, feed_id, feed=None):
+        self.feed_id = feed_id
+        self.logging_queries = bool(connection.use_debug_cursor or settings.DEBUG)
+        self.queries_start = len(connection.queries)
+        self.sql_count = None
+        self.mongo_count = None
+        self.redis_count = None
+        self.attach(feed or Feed.get_by_id(feed_id))
+    
+    def attach(self, feed):
+        self.feed = feed
+        self.dirty_fields = set()
+        if feed:
+            feed.fetch_session = self
+            self.snapshot = self.field_values(feed)
+        return feed
+    
+    @staticmethod
+    def field_values(feed):
+        return dict((field.attname, getattr(feed, field.attname))
+                    for field in Feed._meta.local_fields if not field.primary_key)
+    
+    def defer_save(self, update_fields=None):
+        if update_fields is None:
+            # A full save, write whatever has changed since the feed was loaded
+            values = self.field_values(self.feed)
+            update_fields = [name for name, value in values.items()
+                             if value != self.snapshot[name]]
+        self.dirty_fields.update(update_fields)
+    
+    def flush(self):
+        feed = self.feed
+        if not feed:
+            return
+        feed.fetch_session = None
+        if not self.dirty_fields:
+            return feed
+        update_fields = self.dirty_fields
+        if update_fields & set(['feed_address', 'feed_link']):
+            update_fields.add('hash_address_and_link')
+        self.dirty_fields = set()
+        # Saving can merge the feed into a duplicate, or find it deleted.
+        return feed.save(update_fields=list(update_fields)) or feed
+    
+    def reload(self):
+        """ Writes what was saved so far and starts over from a fresh copy of
+            the feed, dropping changes that were never saved.
+        """
+        self.flush()
+        return self.attach(Feed.get_by_id(self.feed_id))
+    
+    def close(self):
+        try:
+            self.feed = self.flush()
+        finally:
+            self.count_queries()
+        return self.feed
+    
+    def discard(self):
+        """ Closes the session without writing anything, for a feed that's gone.
+        """
+        if self.feed:
+            self.feed.fetch_session = None
+        self.dirty_fields = set()
+        self.count_queries()
+    
+    def count_queries(self):
+        if not self.logging_queries:
+            return
+        queries = connection.queries[self.queries_start:]
+        self.mongo_count = len([query for query in queries if query.get('mongo')])
+        self.redis_count = len([query for query in queries if query.get('redis')])
+        self.sql_count = len(queries) - self.mongo_count - self.redis_count
+
+
+class ConcurrentFetcher:
+    """ Keeps up to `concurrency` feed downloads in flight for a single worker
+        process. Feeds are loaded and checked for skipping in the worker's own
+        thread, then only the network-bound `FetchFeed.fetch` runs on the thread
+        pool. Results are handed back in queue order, along with the loaded
+        feed, so processing stays serial and the feed isn't loaded twice.
+    """
+    def __init__(self, dispatcher, feed_queue, concurrency):
+        self.dispatcher = dispatcher
+        self.options = dispatcher.options
+        self.concurrency = concurrency
+        self.pending = collections.deque(feed_queue)
+        self.fetches = collections.deque()
+        self.in_flight = 0
+        self.pool = ThreadPool(concurrency)
+        self.fill()
+
+    def fill(self):
+        while self.pending and self.in_flight < self.concurrency:
+            feed_id = self.pending.popleft()
+            feed = Feed.get_by_id(feed_id)
+            if not feed or self.dispatcher.skip_feed(feed):
+                self.fetches.append((feed_id, feed, None))
+                continue
+            admitted, host_token = self.dispatcher.admit_feed(feed)
+            if not admitted:
+                self.fetches.append((feed_id, feed, None))
+                continue
+            ffeed = FetchFeed(feed_id, self.options, feed=feed)
+            self.fetches.append((feed_id, feed, self.pool.apply_async(self.fetch_feed,
+                                                                      (ffeed, host_token))))
+            self.in_flight += 1
+
+    def fetch_feed(self, ffeed, host_token):
+        start = time.time()
+        address = ffeed.feed.feed_address
+        ffeed.fetch_exc_info = None
+        try:
+            ffeed.ret_feed, ffeed.fetched_feed = ffeed.fetch()
+        except Exception:
+            # Raised again by the Dispatcher, which records it against the feed.
+            ffeed.fetch_exc_info = sys.exc_info()
+        finally:
+            ffeed.fetch_duration = time.time() - start
+            self.dispatcher.host_throttle.release(address, host_token)
+            # Twitter and Facebook fetchers read from Postgres on this thread.
+            connection.close()
+        return ffeed
+
+    def fetched(self, feed_id):
+        """ Blocks until the feed's download has finished. Returns the feed as
+            it was loaded and its FetchFeed, which is None if the feed is gone
+            or was skipped or deferred. A download's exception is kept on the
+            FetchFeed as `fetch_exc_info`.
+        """
+        if not self.fetches:
+            self.fill()
+        fetched_feed_id, feed, result = self.fetches.popleft()
+        while fetched_feed_id != feed_id:
+            # An earlier feed errored before collecting its download. Drop it.
+            if result:
+                result.wait()
+                self.in_flight -= 1
+            self.fill()
+            fetched_feed_id, feed, result = self.fetches.popleft()
+        if not result:
+            return feed, None
+        try:
+            return feed, result.get()
+        finally:
+            self.in_flight -= 1
+            self.fill()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class FetchPipeline:
+    """ Runs feeds through two stages sized independently. Downloads happen
+        on `io_workers` threads in this process, and parsing, story diffing
+        and everything after it happen in `cpu_workers` processes. The stages
+        share a bounded queue, so downloads block once parsing falls behind.
+        Queue depth and per-stage throughput are logged every `report_every`
+        seconds.
+    """
+    def __init__(self, dispatcher, io_workers, cpu_workers=None, queue_size=None,
+                 report_every=30):
+        self.dispatcher = dispatcher
+        self.options = dispatcher.options
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers or multiprocessing.cpu_count()
+        self.queue_size = queue_size or self.cpu_workers * 4
+        self.report_every = report_every
+        self.downloaded = 0
+        self.processed = multiprocessing.Value('i', 0)
+        self.lock = threading.Lock()
+    
+    def run(self, feed_ids):
+        self.start = time.time()
+        self.parse_queue = multiprocessing.Queue(maxsize=self.queue_size)
+        # Forked workers must not share this process's Postgres connection.
+        connection.close()
+        workers = [multiprocessing.Process(target=self.parse_worker)
+                   for _ in range(self.cpu_workers)]
+        for worker in workers:
+            worker.start()
+        
+        done = threading.Event()
+        reporter = threading.Thread(target=self.report_stats, args=(done,))
+        reporter.daemon = True
+        reporter.start()
         
+        pool = ThreadPool(self.io_workers)
+        pool.map(self.queue_download, feed_ids, chunksize=1)
+        pool.close()
+        pool.join()
+        
+        for _ in workers:
+            self.parse_queue.put(None)
+        for worker in workers:
+            worker.join()
+        done.set()
+        self.log_stats()
+    
+    def download_feed(self, feed_id):
+        """ Returns the feed's `FetchFeed.download_result`, or None if it was
+            skipped or deferred.
+        """
+        try:
+            feed = Feed.get_by_id(feed_id)
+            if not feed or self.dispatcher.skip_feed(feed):
+                return
+            admitted, host_token = self.dispatcher.admit_feed(feed)
+            if not admitted:
+                return
+            address = feed.feed_address
+            ffeed = FetchFeed(feed_id, self.options, feed=feed)
+            try:
+                ffeed.download()
+            except TimeoutError, e:
+                ffeed.download_error = e
+            finally:
+                self.dispatcher.host_throttle.release(address, host_token)
+            return ffeed.download_result()
+        except Exception, e:
+            logging.debug('   ***> [%-30s] ~FRFeed download failed in pipeline: %s' % (feed_id, e))
+        finally:
+            connection.close()
+    
+    def queue_download(self, feed_id):
+        download = self.download_feed(feed_id)
+        if download is None:
+            return
+        
+        # Blocks while the parse stage is full.
+        self.parse_queue.put((feed_id, download))
+        with self.lock:
+            self.downloaded += 1
+    
+    def parse_download(self, feed_id, download):
+        try:
+            self.dispatcher.process_feed_wrapper([feed_id], downloaded={feed_id: download})
+        except Exception, e:
+            logging.debug('   ***> [%-30s] ~FRFeed processing failed in pipeline: %s' % (feed_id, e))
+        with self.processed.get_lock():
+            self.processed.value += 1
+    
+    def parse_worker(self):
+        while True:
+            item = self.parse_queue.get()
+            if item is None:
+                break
+            self.parse_download(*item)
+        MAnalyticsFetcher.flush()
+    
+    def report_stats(self, done):
+        while not done.wait(self.report_every):
+            self.log_stats()
+    
+    def log_stats(self):
+        elapsed = max(time.time() - self.start, 1)
+        try:
+            queue_depth = self.parse_queue.qsize()
+        except NotImplementedError:
+            queue_depth = '?'
+        logging.debug('   ---> ~FBPipeline: ~SB%s~SN/%s queued for parsing, downloaded ~SB%s~SN '
+                      '(%.2f/s on %s threads), processed ~SB%s~SN (%.2f/s on %s processes)' % (
+                      queue_depth, self.queue_size,
+                      self.downloaded, self.downloaded / elapsed, self.io_workers,
+                      self.processed.value, self.processed.value / elapsed, self.cpu_workers))
+
+
 class Dispatcher:
     def __init__(self, options, num_threads):
         self.options = options
@@ -635,12 +1112,71 @@ class Dispatcher:
         self.num_threads = num_threads
         self.time_start = datetime.datetime.utcnow()
         self.workers = []
+        self.host_throttle = HostThrottle()
+        self.deferred_feeds = set()
+        # Per-feed timings and query counts, kept when `record_stats` is set.
+        self.fetch_stats = []
 
-    def refresh_feed(self, feed_id):
-        """Update feed, since it may have changed"""
-        return Feed.get_by_id(feed_id)
+    def finish_fetch_session(self, session):
+        feed = session.feed
+        if (feed and self.options.get('schedule_next_update') and
+            session.feed_id not in self.deferred_feeds):
+            feed.last_update = datetime.datetime.utcnow()
+            feed.set_next_scheduled_update()
         
-    def process_feed_wrapper(self, feed_queue):
+        return session.close()
+    
+    def skip_feed(self, feed):
+        skip = False
+        if self.options.get('fake'):
+            skip = True
+            weight = "-"
+            quick = "-"
+            rand = "-"
+        elif (self.options.get('quick') and not self.options['force'] and 
+              feed.known_good and feed.fetched_once and not feed.is_push):
+            weight = feed.stories_last_month * feed.num_subscribers
+            random_weight = random.randint(1, max(weight, 1))
+            quick = float(self.options.get('quick', 0))
+            rand = random.random()
+            if random_weight < 1000 and rand < quick:
+                skip = True
+        elif False and feed.feed_address.startswith("http://news.google.com/news"):
+            skip = True
+            weight = "-"
+            quick = "-"
+            rand = "-"
+        if skip:
+            logging.debug('   ---> [%-30s] ~BGFaking fetch, skipping (%s/month, %s subs, %s < %s)...' % (
+                feed.log_title[:30],
+                weight,
+                feed.num_subscribers,
+                rand, quick))
+        
+        return skip
+    
+    def admit_feed(self, feed):
+        """ Asks the feed's host for a fetch slot. Returns (admitted, host_token),
+            and the token is handed back to `host_throttle.release` after the
+            fetch. Feeds refused by a busy or failing host are deferred without
+            counting against the feed's error history.
+        """
+        if (self.options.get('force') or self.options.get('fpf') or
+            self.options.get('unthrottled')):
+            return True, None
+        
+        host_token, defer = self.host_throttle.admit(feed.feed_address)
+        if not defer:
+            return True, host_token
+        
+        logging.debug('   ---> [%-30s] ~FBHost is busy or failing, ~SBdeferring fetch~SN for %s min' % (
+                      feed.log_title[:30], defer / 60))
+        feed.defer_fetch(defer)
+        self.deferred_feeds.add(feed.pk)
+        
+        return False, None
+        
+    def process_feed_wrapper(self, feed_queue, downloaded=None):
         delta = None
         current_process = multiprocessing.current_process()
         identity = "X"
@@ -648,57 +1184,86 @@ class Dispatcher:
         
         if current_process._identity:
             identity = current_process._identity[0]
-            
+        
+        concurrent_fetcher = None
+        concurrency = int(self.options.get('concurrency') or 1)
+        if concurrency > 1 and len(feed_queue) > 1:
+            concurrent_fetcher = ConcurrentFetcher(self, feed_queue, concurrency)
+        
+        # Logging SQL statements slows every query down, so each fetch only
+        # reports how many it took when someone is reading the counts.
+        use_debug_cursor = connection.use_debug_cursor
+        log_queries = use_debug_cursor or settings.DEBUG
+        if self.options.get('record_stats') or self.options.get('verbose'):
+            connection.use_debug_cursor = True
+        
         for feed_id in feed_queue:
             start_duration = time.time()
             feed_fetch_duration = None
             feed_process_duration = None
-            page_duration = None
-            icon_duration = None
             feed_code = None
             ret_entries = None
             start_time = time.time()
             ret_feed = FEED_ERREXC
+            if not log_queries:
+                del connection.queries[:]
+            if concurrent_fetcher:
+                # Loaded and downloaded ahead of time by the concurrent fetcher.
+                loaded_feed, ffeed = concurrent_fetcher.fetched(feed_id)
+                session = FeedFetchSession(feed_id, feed=loaded_feed)
+            else:
+                session = FeedFetchSession(feed_id)
             try:
-                feed = self.refresh_feed(feed_id)
+                feed = session.feed
                 
-                skip = False
-                if self.options.get('fake'):
-                    skip = True
-                    weight = "-"
-                    quick = "-"
-                    rand = "-"
-                elif (self.options.get('quick') and not self.options['force'] and 
-                      feed.known_good and feed.fetched_once and not feed.is_push):
-                    weight = feed.stories_last_month * feed.num_subscribers
-                    random_weight = random.randint(1, max(weight, 1))
-                    quick = float(self.options.get('quick', 0))
-                    rand = random.random()
-                    if random_weight < 1000 and rand < quick:
-                        skip = True
-                elif False and feed.feed_address.startswith("http://news.google.com/news"):
-                    skip = True
-                    weight = "-"
-                    quick = "-"
-                    rand = "-"
-                if skip:
-                    logging.debug('   ---> [%-30s] ~BGFaking fetch, skipping (%s/month, %s subs, %s < %s)...' % (
-                        feed.log_title[:30],
-                        weight,
-                        feed.num_subscribers,
-                        rand, quick))
-                    continue
-                    
-                ffeed = FetchFeed(feed_id, self.options)
-                ret_feed, fetched_feed = ffeed.fetch()
+                if concurrent_fetcher:
+                    if not ffeed:
+                        feed = self.finish_fetch_session(session)
+                        continue
+                    if ffeed.fetch_exc_info:
+                        exc_type, exc_value, exc_traceback = ffeed.fetch_exc_info
+                        raise exc_type, exc_value, exc_traceback
+                    ret_feed, fetched_feed = ffeed.ret_feed, ffeed.fetched_feed
+                    feed_fetch_duration = ffeed.fetch_duration
+                    # Stage durations below are measured from the start of the download
+                    start_duration = time.time() - feed_fetch_duration
+                elif downloaded:
+                    # Already skip checked and downloaded by the pipeline, parse it here.
+                    ffeed = FetchFeed(feed_id, self.options, feed=feed)
+                    ffeed.use_download(downloaded[feed_id])
+                    ret_feed, fetched_feed = ffeed.fetch()
+                    feed_fetch_duration = ffeed.download_duration + time.time() - start_duration
+                    start_duration = time.time() - feed_fetch_duration
+                else:
+                    if self.skip_feed(feed):
+                        feed = self.finish_fetch_session(session)
+                        continue
+                    admitted, host_token = self.admit_feed(feed)
+                    if not admitted:
+                        feed = self.finish_fetch_session(session)
+                        continue
+                    address = feed.feed_address
+                    ffeed = FetchFeed(feed_id, self.options, feed=feed)
+                    try:
+                        ret_feed, fetched_feed = ffeed.fetch()
+                    finally:
+                        self.host_throttle.release(address, host_token)
+                    feed_fetch_duration = time.time() - start_duration
 
-                feed_fetch_duration = time.time() - start_duration
                 raw_feed = ffeed.raw_feed
                 
-                if ((fetched_feed and ret_feed == FEED_OK) or self.options['force']):
-                    pfeed = ProcessFeed(feed_id, fetched_feed, self.options, raw_feed=raw_feed)
+                if ret_feed == FEED_SAME and not fetched_feed:
+                    # Body matched the last processed fingerprint, nothing was parsed.
+                    feed.save_feed_history(304, "Not modified")
+                elif ((fetched_feed and ret_feed == FEED_OK) or self.options['force']):
+                    pfeed = ProcessFeed(feed_id, fetched_feed, self.options, raw_feed=raw_feed,
+                                        feed=feed)
                     ret_feed, ret_entries = pfeed.process()
                     feed = pfeed.feed
+                    # Same cap as the entry digests: a capped fetch must be reprocessed
+                    if (ret_feed == FEED_OK and ffeed.fingerprint and
+                        ret_entries and ret_entries['updated'] < 3):
+                        feed.set_body_fingerprint(ffeed.fingerprint)
                     feed_process_duration = time.time() - start_duration
                     
                     if (ret_entries and ret_entries['new']) or self.options['force']:
@@ -713,7 +1278,7 @@ class Dispatcher:
                             feed.sync_redis()
                             logging.debug('   ---> [%-30s] ~FBDone with feed cleanup. Took ~SB%.4s~SN sec.' % (feed.log_title[:30], time.time() - start_cleanup))
                         try:
-                            self.count_unreads_for_subscribers(feed)
+                            self.count_unreads_for_subscribers(feed, ret_entries and ret_entries.get('new_stories'))
                         except TimeoutError:
                             logging.debug('   ---> [%-30s] Unread count took too long...' % (feed.log_title[:30],))
                         if self.options['verbose']:
@@ -726,6 +1291,7 @@ class Dispatcher:
                 fetched_feed = None
             except Feed.DoesNotExist, e:
                 logging.debug('   ---> [%-30s] ~FRFeed is now gone...' % (unicode(feed_id)[:30]))
+                session.discard()
                 continue
             except SoftTimeLimitExceeded, e:
                 logging.debug(" ---> [%-30s] ~BR~FWTime limit hit!~SB~FR Moving on to next feed..." % feed)
@@ -744,8 +1310,10 @@ class Dispatcher:
                 logging.error(tb)
                 logging.debug('[%d] ! -------------------------' % (feed_id,))
                 ret_feed = FEED_ERREXC 
-                feed = Feed.get_by_id(getattr(feed, 'pk', feed_id))
-                if not feed: continue
+                feed = session.reload()
+                if not feed:
+                    session.discard()
+                    continue
                 feed.save_feed_history(500, "Error", tb)
                 feed_code = 500
                 fetched_feed = None
@@ -766,79 +1334,24 @@ class Dispatcher:
                 elif ret_feed == FEED_ERRPARSE:
                     feed_code = 550
                 
-            if not feed: continue
-            feed = self.refresh_feed(feed.pk)
-            if not feed: continue
+            if not feed:
+                session.discard()
+                continue
             
-            if ((self.options['force']) or 
-                (random.random() > .9) or
-                (fetched_feed and
-                 feed.feed_link and
-                 feed.has_page and
-                 (ret_feed == FEED_OK or
-                  (ret_feed == FEED_SAME and feed.stories_last_month > 10)))):
-                  
-                logging.debug(u'   ---> [%-30s] ~FYFetching page: %s' % (feed.log_title[:30], feed.feed_link))
-                page_importer = PageImporter(feed)
-                try:
-                    page_data = page_importer.fetch_page()
-                    page_duration = time.time() - start_duration
-                except SoftTimeLimitExceeded, e:
-                    logging.debug(" ---> [%-30s] ~BR~FWTime limit hit!~SB~FR Moving on to next feed..." % feed)
-                    page_data = None
-                    feed.save_feed_history(557, 'Timeout', e)
-                except TimeoutError, e:
-                    logging.debug('   ---> [%-30s] ~FRPage fetch timed out...' % (feed.log_title[:30]))
-                    page_data = None
-                    feed.save_page_history(555, 'Timeout', '')
-                except Exception, e:
-                    logging.debug('[%d] ! -------------------------' % (feed_id,))
-                    tb = traceback.format_exc()
-                    logging.error(tb)
-                    logging.debug('[%d] ! -------------------------' % (feed_id,))
-                    feed.save_page_history(550, "Page Error", tb)
-                    fetched_feed = None
-                    page_data = None
-                    # mail_feed_error_to_admin(feed, e, local_vars=locals())
-                    if (not settings.DEBUG and hasattr(settings, 'RAVEN_CLIENT') and
-                        settings.RAVEN_CLIENT):
-                        settings.RAVEN_CLIENT.captureException()
-                
-                feed = self.refresh_feed(feed.pk)
-                logging.debug(u'   ---> [%-30s] ~FYFetching icon: %s' % (feed.log_title[:30], feed.feed_link))
-                force = self.options['force']
-                if random.random() > .99:
-                    force = True
-                icon_importer = IconImporter(feed, page_data=page_data, force=force)
-                try:
-                    icon_importer.save()
-                    icon_duration = time.time() - start_duration
-                except SoftTimeLimitExceeded, e:
-                    logging.debug(" ---> [%-30s] ~BR~FWTime limit hit!~SB~FR Moving on to next feed..." % feed)
-                    feed.save_feed_history(558, 'Timeout', e)
-                except TimeoutError, e:
-                    logging.debug('   ---> [%-30s] ~FRIcon fetch timed out...' % (feed.log_title[:30]))
-                    feed.save_page_history(556, 'Timeout', '')
-                except Exception, e:
-                    logging.debug('[%d] ! -------------------------' % (feed_id,))
-                    tb = traceback.format_exc()
-                    logging.error(tb)
-                    logging.debug('[%d] ! -------------------------' % (feed_id,))
-                    # feed.save_feed_history(560, "Icon Error", tb)
-                    # mail_feed_error_to_admin(feed, e, local_vars=locals())
-                    if (not settings.DEBUG and hasattr(settings, 'RAVEN_CLIENT') and
-                        settings.RAVEN_CLIENT):
-                        settings.RAVEN_CLIENT.captureException()
-            else:
-                logging.debug(u'   ---> [%-30s] ~FBSkipping page fetch: (%s on %s stories) %s' % (feed.log_title[:30], self.feed_trans[ret_feed], feed.stories_last_month, '' if feed.has_page else ' [HAS NO PAGE]'))
+            if fetched_feed or self.options['force']:
+                new_stories = bool(ret_entries and ret_entries['new'])
+                queued = feed.schedule_page_and_icon_fetch(new_stories=new_stories,
+                                                           force=self.options['force'])
+                if not queued:
+                    logging.debug(u'   ---> [%-30s] ~FBSkipping page fetch: (%s on %s stories) %s' % (feed.log_title[:30], self.feed_trans[ret_feed], feed.stories_last_month, '' if feed.has_page else ' [HAS NO PAGE]'))
             
-            feed = self.refresh_feed(feed.pk)
             delta = time.time() - start_time
             
             feed.last_load_time = round(delta)
             feed.fetched_once = True
+            feed.save(update_fields=['last_load_time', 'fetched_once'])
             try:
-                feed = feed.save(update_fields=['last_load_time', 'fetched_once'])
+                feed = self.finish_fetch_session(session)
             except IntegrityError:
                 logging.debug("   ***> [%-30s] ~FRIntegrityError on feed: %s" % (feed.log_title[:30], feed.feed_address,))
             
@@ -847,21 +1360,46 @@ class Dispatcher:
                 
             done_msg = (u'%2s ---> [%-30s] ~FYProcessed in ~FM~SB%.4ss~FY~SN (~FB%s~FY) [%s]' % (
                 identity, feed.log_title[:30], delta,
-                feed.pk, self.feed_trans[ret_feed],))
+                feed.pk, self.feed_trans[ret_feed]))
+            if session.sql_count is not None:
+                done_msg += u' ~SB%s~SN SQL' % session.sql_count
             logging.debug(done_msg)
             total_duration = time.time() - start_duration
             MAnalyticsFetcher.add(feed_id=feed.pk, feed_fetch=feed_fetch_duration,
                                   feed_process=feed_process_duration, 
-                                  page=page_duration, icon=icon_duration,
+                                  page=None, icon=None,
                                   total=total_duration, feed_code=feed_code)
+            if self.options.get('record_stats'):
+                self.fetch_stats.append(dict(feed_id=feed.pk, feed_code=feed_code,
+                                             feed_fetch=feed_fetch_duration,
+                                             feed_process=feed_process_duration,
+                                             total=total_duration, sql=session.sql_count,
+                                             mongo=session.mongo_count, redis=session.redis_count))
             
             self.feed_stats[ret_feed] += 1
+        
+        if concurrent_fetcher:
+            concurrent_fetcher.close()
+        
+        connection.use_debug_cursor = use_debug_cursor
+        if not log_queries:
+            del connection.queries[:]
+        
+        if len(feed_queue) > 1:
+            http_pool.http_pool.log_stats()
+            dns_cache.log_stats()
             
         if len(feed_queue) == 1:
             return feed
         
         # time_taken = datetime.datetime.utcnow() - self.time_start
     
+    def process_feeds_worker(self, feed_queue):
+        # Analytics are flushed by whoever owns the batch. Worker processes
+        # exit without running atexit handlers, so they flush their own.
+        self.process_feed_wrapper(feed_queue)
+        MAnalyticsFetcher.flush()
+    
     def publish_to_subscribers(self, feed, new_count):
         try:
             r = redis.Redis(connection_pool=settings.REDIS_PUBSUB_POOL)
@@ -871,50 +1409,30 @@ class Dispatcher:
         except redis.ConnectionError:
             logging.debug("   ***> [%-30s] ~BMRedis is unavailable for real-time." % (feed.log_title[:30],))
         
-    def count_unreads_for_subscribers(self, feed):
-        user_subs = UserSubscription.objects.filter(feed=feed, 
-                                                    active=True,
-                                                    user__profile__last_seen_on__gte=feed.unread_cutoff)\
-                                            .order_by('-last_read_date')
+    def count_unreads_for_subscribers(self, feed, new_stories=None):
+        # New stories go straight into the counts of most subscriptions, the
+        # rest are recounted.
+        user_subs = UserSubscription.add_unread_stories(feed, new_stories)
         
-        if not user_subs.count():
+        # Flag them all in one UPDATE rather than a save per subscription.
+        user_subs.filter(needs_unread_recalc=False).update(needs_unread_recalc=True)
+        user_sub_ids = list(user_subs.order_by('-last_read_date').values_list('pk', flat=True))
+        if not user_sub_ids:
             return
-            
-        for sub in user_subs:
-            if not sub.needs_unread_recalc:
-                sub.needs_unread_recalc = True
-                sub.save()
 
         if self.options['compute_scores']:
-            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
-            stories = MStory.objects(story_feed_id=feed.pk,
-                                     story_date__gte=feed.unread_cutoff)
-            stories = Feed.format_stories(stories, feed.pk)
-            story_hashes = r.zrangebyscore('zF:%s' % feed.pk, int(feed.unread_cutoff.strftime('%s')),
-                                           int(time.time() + 60*60*24))
-            missing_story_hashes = set(story_hashes) - set([s['story_hash'] for s in stories])
-            if missing_story_hashes:
-                missing_stories = MStory.objects(story_feed_id=feed.pk,
-                                                 story_hash__in=missing_story_hashes)\
-                                        .read_preference(pymongo.ReadPreference.PRIMARY)
-                missing_stories = Feed.format_stories(missing_stories, feed.pk)
-                stories = missing_stories + stories
-                logging.debug(u'   ---> [%-30s] ~FYFound ~SB~FC%s(of %s)/%s~FY~SN un-secondaried stories while computing scores' % (feed.log_title[:30], len(missing_stories), len(missing_story_hashes), len(stories)))
-            cache.set("S:%s" % feed.pk, stories, 60)
+            # Loading the stories here caches them for the recounts, and picks up
+            # stories the secondaries haven't seen yet.
+            stories = UserSubscription.stories_for_scoring(feed)
             logging.debug(u'   ---> [%-30s] ~FYComputing scores: ~SB%s stories~SN with ~SB%s subscribers ~SN(%s/%s/%s)' % (
-                          feed.log_title[:30], len(stories), user_subs.count(),
+                          feed.log_title[:30], len(stories), len(user_sub_ids),
                           feed.num_subscribers, feed.active_subscribers, feed.premium_subscribers))        
-            self.calculate_feed_scores_with_stories(user_subs, stories)
+            for user_sub_ids_batch in chunks(user_sub_ids, UserSubscription.SCORE_BATCH_SIZE):
+                ComputeFeedScores.apply_async(args=(feed.pk, user_sub_ids_batch))
         elif self.options.get('mongodb_replication_lag'):
             logging.debug(u'   ---> [%-30s] ~BR~FYSkipping computing scores: ~SB%s seconds~SN of mongodb lag' % (
               feed.log_title[:30], self.options.get('mongodb_replication_lag')))
     
-    @timelimit(10)
-    def calculate_feed_scores_with_stories(self, user_subs, stories):
-        for sub in user_subs:
-            silent = False if self.options['verbose'] >= 2 else True
-            sub.calculate_feed_scores(silent=silent, stories=stories)
-            
     def add_jobs(self, feeds_queue, feeds_count=1):
         """ adds a feed processing job to the pool
         """
@@ -924,10 +1442,15 @@ class Dispatcher:
     def run_jobs(self):
         if self.options['single_threaded']:
             return self.process_feed_wrapper(self.feeds_queue[0])
+        elif self.options.get('pipeline'):
+            pipeline = FetchPipeline(self, io_workers=self.options.get('io_workers') or self.num_threads,
+                                     cpu_workers=self.options.get('cpu_workers'),
+                                     queue_size=self.options.get('queue_size'))
+            pipeline.run([feed_id for feed_queue in self.feeds_queue for feed_id in feed_queue])
         else:
             for i in range(self.num_threads):
                 feed_queue = self.feeds_queue[i]
-                self.workers.append(multiprocessing.Process(target=self.process_feed_wrapper,
+                self.workers.append(multiprocessing.Process(target=self.process_feeds_worker,
                                                             args=(feed_queue,)))
             for i in range(self.num_threads):
                 self.workers[i].start()
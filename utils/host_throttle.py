@@ -0,0 +1,143 @@
+import time
+import uuid
+import random
+import urlparse
+import redis
+from django.conf import settings
+from utils import log as logging
+
+# Fetches allowed in flight at once against a single host.
+HOST_MAX_CONCURRENT = 8
+# Fetches allowed per minute against a single host.
+HOST_MAX_PER_MINUTE = 120
+# A fetch slot is reclaimed after this long, in case its worker died.
+HOST_SLOT_EXPIRE = 60
+# 429/5xx responses within the window that open the circuit for a host.
+HOST_BREAKER_FAILURES = 5
+HOST_BREAKER_WINDOW = 5 * 60
+HOST_BREAKER_COOLDOWN = 15 * 60
+HOST_BREAKER_MAX_COOLDOWN = 60 * 60
+
+# Hosts that serve feeds for many unrelated publishers from one hostname.
+# They are built for the load, and one publisher's errors say nothing about
+# the rest, so they skip both the caps and the circuit breaker.
+MULTI_TENANT_HOSTS = set(getattr(settings, 'HOST_THROTTLE_EXEMPT_HOSTS', [
+    'feeds.feedburner.com',
+    'feedproxy.google.com',
+    'feeds2.feedburner.com',
+    'medium.com',
+    'www.youtube.com',
+    'news.google.com',
+]))
+
+
+def fetch_host(url):
+    """ The hostname a fetch is throttled under, or None when the host is
+        exempt. Subdomains are kept apart, so blogspot, tumblr and wordpress
+        blogs each get their own budget.
+    """
+    hostname = (urlparse.urlsplit(url).hostname or '').strip('.').lower()
+    if not hostname or hostname in MULTI_TENANT_HOSTS:
+        return None
+    return hostname
+
+
+def is_throttling_status(status_code):
+    return status_code == 429 or 500 <= status_code < 600
+
+
+class HostThrottle(object):
+    """ Host-aware admission for feed fetches, shared by every fetcher through
+        the feed update redis. A feed is admitted only while its host is under
+        both the concurrency and the per-minute cap and its circuit breaker is
+        closed. Refused feeds are deferred, not errored.
+
+        Keys, all per hostname:
+            hA:<host>           zset of in-flight fetch tokens, scored by start
+            hM:<host>:<minute>  fetches started this minute
+            hF:<host>           429/5xx responses in the last breaker window
+            hB:<host>           set while the circuit is open, expires on reopen
+    """
+
+    def __init__(self):
+        self.r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
+
+    def admit(self, url):
+        """ Returns (token, None) when the fetch may go ahead, in which case
+            `release(url, token)` must be called once it finishes. Otherwise
+            returns (None, seconds) with how long to defer the feed for.
+        """
+        host = fetch_host(url)
+        if not host:
+            return None, None
+        now = time.time()
+        minute = int(now / 60)
+        token = uuid.uuid4().hex
+
+        pipe = self.r.pipeline()
+        pipe.ttl('hB:%s' % host)
+        pipe.zremrangebyscore('hA:%s' % host, 0, now - HOST_SLOT_EXPIRE)
+        pipe.zadd('hA:%s' % host, token, now)
+        pipe.expire('hA:%s' % host, HOST_SLOT_EXPIRE)
+        pipe.zcard('hA:%s' % host)
+        pipe.incr('hM:%s:%s' % (host, minute))
+        pipe.expire('hM:%s:%s' % (host, minute), 120)
+        breaker_ttl, _, _, _, in_flight, this_minute, _ = pipe.execute()
+
+        defer = None
+        if breaker_ttl and breaker_ttl > 0:
+            defer = breaker_ttl
+        elif in_flight > HOST_MAX_CONCURRENT:
+            defer = 60
+        elif this_minute > HOST_MAX_PER_MINUTE:
+            defer = 60 - (now % 60)
+
+        if defer is None:
+            return token, None
+
+        pipe = self.r.pipeline()
+        pipe.zrem('hA:%s' % host, token)
+        pipe.decr('hM:%s:%s' % (host, minute))
+        pipe.execute()
+
+        # Spread deferred feeds out so they don't all return in the same minute.
+        return None, int(defer + random.randint(0, 120))
+
+    def release(self, url, token):
+        host = fetch_host(url)
+        if host and token:
+            self.r.zrem('hA:%s' % host, token)
+
+    def record(self, url, status_code, retry_after=None):
+        host = fetch_host(url)
+        if not host or not status_code:
+            return
+
+        # Successes don't touch redis: failures age out with the window instead.
+        if not is_throttling_status(status_code):
+            return
+
+        # The window starts at the first failure and isn't pushed back by later
+        # ones, so occasional errors spread over hours never add up.
+        pipe = self.r.pipeline()
+        pipe.incr('hF:%s' % host)
+        pipe.ttl('hF:%s' % host)
+        failures, window_ttl = pipe.execute()
+        if window_ttl is None or window_ttl < 0:
+            self.r.expire('hF:%s' % host, HOST_BREAKER_WINDOW)
+        if failures < HOST_BREAKER_FAILURES:
+            return
+
+        cooldown = HOST_BREAKER_COOLDOWN
+        try:
+            cooldown = max(cooldown, int(retry_after))
+        except (TypeError, ValueError):
+            pass
+        cooldown = min(cooldown, HOST_BREAKER_MAX_COOLDOWN)
+
+        pipe = self.r.pipeline()
+        pipe.setex('hB:%s' % host, 1, cooldown)
+        pipe.delete('hF:%s' % host)
+        pipe.execute()
+        logging.debug("   ---> ~FRHost ~SB%s~SN returned %s %s times, ~SBdeferring its feeds~SN for %s min" % (
+                      host, status_code, failures, cooldown / 60))
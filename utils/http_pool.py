@@ -0,0 +1,126 @@
+import os
+import time
+import threading
+import collections
+import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from utils import log as logging
+from utils.dns_cache import dns_cache
+
+# Hosts with a live keep-alive session, per process.
+HTTP_POOL_MAX_HOSTS = 256
+# Sockets kept open to a single host. Feedburner, Medium and Blogspot are hot.
+HTTP_POOL_MAX_CONNECTIONS = 4
+# Sessions unused for this many seconds are closed.
+HTTP_POOL_IDLE_SECONDS = 90
+
+
+class HostSessionPool(object):
+    """ Process-wide pool of keep-alive `requests` sessions keyed by scheme and
+        host, so the feed, its page and its favicon share one TCP/TLS
+        connection when fetched close together. Least recently used hosts are
+        evicted once the pool is full, and idle sessions are closed on access.
+    """
+
+    def __init__(self, max_hosts=HTTP_POOL_MAX_HOSTS,
+                 max_connections=HTTP_POOL_MAX_CONNECTIONS,
+                 idle_seconds=HTTP_POOL_IDLE_SECONDS):
+        self.max_hosts = max_hosts
+        self.max_connections = max_connections
+        self.idle_seconds = idle_seconds
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.sessions = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def host_key(url):
+        parts = urlparse.urlsplit(url)
+        return "%s://%s" % (parts.scheme.lower(), parts.netloc.lower())
+
+    def session_for(self, url):
+        key = self.host_key(url)
+        now = time.time()
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked fetcher workers must not share their parent's sockets.
+                self.reset()
+            self.evict_idle(now)
+            if key in self.sessions:
+                session, _ = self.sessions.pop(key)
+                self.hits += 1
+            else:
+                session = self.new_session()
+                self.misses += 1
+                while len(self.sessions) >= self.max_hosts:
+                    _, (evicted, _) = self.sessions.popitem(last=False)
+                    evicted.close()
+                    self.evictions += 1
+            self.sessions[key] = (session, now)
+
+        return session
+
+    def new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def evict_idle(self, now):
+        for key, (session, last_used) in self.sessions.items():
+            if now - last_used <= self.idle_seconds:
+                # Ordered by last use, so the rest are fresher.
+                break
+            del self.sessions[key]
+            session.close()
+            self.evictions += 1
+
+    def request(self, method, url, **kwargs):
+        session = self.session_for(url)
+        try:
+            with dns_cache.resolving():
+                return session.request(method, url, **kwargs)
+        finally:
+            # Sessions are shared across feeds on a host, cookies are not.
+            session.cookies.clear()
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('GET', url, **kwargs)
+
+    def close(self):
+        with self.lock:
+            for session, _ in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hosts': len(self.sessions),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else 0,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        logging.debug("   ---> ~FBHTTP pool: ~SB%s~SN hosts, ~SB%s~SN hits, ~SB%s~SN misses, "
+                      "~SB%s~SN evictions (~SB%.1f%%~SN hit rate)" % (
+                      stats['hosts'], stats['hits'], stats['misses'],
+                      stats['evictions'], stats['hit_rate'] * 100))
+
+
+http_pool = HostSessionPool()
+
+
+def get(url, **kwargs):
+    return http_pool.get(url, **kwargs)
@@ -0,0 +1,31 @@
+#!/srv/newsblur/venv/newsblur/bin/python
+import redis
+from utils.munin.base import MuninGraph
+
+class NBMuninGraph(MuninGraph):
+
+    @property
+    def graph_config(self):
+        return {
+            'graph_category' : 'NewsBlur',
+            'graph_title' : 'NewsBlur Feed Lag',
+            'graph_vlabel' : 'Minutes',
+            'graph_args' : '-l 0',
+            'premium.label': 'Premium',
+            'active.label': 'Active',
+            'inactive.label': 'Inactive',
+            'error.label': 'Error',
+        }
+
+
+    def calculate_metrics(self):
+        from django.conf import settings
+    
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
+        lags = r.hgetall("queued_feeds_lag")
+
+        return dict((feed_class, int(lags.get(feed_class, 0)) / 60)
+                    for feed_class in ('premium', 'active', 'inactive', 'error'))
+
+if __name__ == '__main__':
+    NBMuninGraph().run()
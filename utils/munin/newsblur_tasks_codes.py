@@ -12,35 +12,21 @@ class NBMuninGraph(MuninGraph):
             'graph_args' : '-l 0',
         }
         stats = self.stats
-        graph.update(dict((("_%s.label" % s['_id'], s['_id']) for s in stats)))
-        graph['graph_order'] = ' '.join(sorted(("_%s" % s['_id']) for s in stats))
+        graph.update(dict((("_%s.label" % code, code) for code in stats)))
+        graph['graph_order'] = ' '.join(sorted(("_%s" % code) for code in stats))
 
         return graph
 
     def calculate_metrics(self):
-        servers = dict((("_%s" % s['_id'], s['feeds']) for s in self.stats))
+        servers = dict((("_%s" % code, feeds) for code, feeds in self.stats.items()))
         
         return servers
     
     @property
     def stats(self):
-        import datetime
-        from django.conf import settings
+        from apps.statistics.models import MAnalyticsFetcher
         
-        stats = settings.MONGOANALYTICSDB.nbanalytics.feed_fetches.aggregate([{
-            "$match": {
-                "date": {
-                    "$gt": datetime.datetime.now() - datetime.timedelta(minutes=5),
-                },
-            },
-        }, {
-            "$group": {
-                "_id"   : "$feed_code",
-                "feeds" : {"$sum": 1},
-            },
-        }])
-        
-        return list(stats)
+        return MAnalyticsFetcher.summarize(minutes=5)['feed_codes']
         
 
 if __name__ == '__main__':
@@ -23,27 +23,9 @@ class NBMuninGraph(MuninGraph):
     
     @property
     def stats(self):
-        import datetime
-        from django.conf import settings
+        from apps.statistics.models import MAnalyticsFetcher
         
-        stats = settings.MONGOANALYTICSDB.nbanalytics.feed_fetches.aggregate([{
-            "$match": {
-                "date": {
-                    "$gt": datetime.datetime.now() - datetime.timedelta(minutes=5),
-                },
-            },
-        }, {
-            "$group": {
-                "_id":          1,
-                "feed_fetch":   {"$avg": "$feed_fetch"},
-                "feed_process": {"$avg": "$feed_process"},
-                "page":         {"$avg": "$page"},
-                "icon":         {"$avg": "$icon"},
-                "total":        {"$avg": "$total"},
-            },
-        }])
-        
-        return list(stats)[0]
+        return MAnalyticsFetcher.summarize(minutes=5)['durations']
         
 
 if __name__ == '__main__':
@@ -1,7 +1,5 @@
 #!/srv/newsblur/venv/newsblur/bin/python
 from utils.munin.base import MuninGraph
-import datetime
-from django.conf import settings
 
 
 class NBMuninGraph(MuninGraph):
@@ -16,53 +14,23 @@ class NBMuninGraph(MuninGraph):
             'total.label'    : 'total',
             'total.draw'     : 'LINE1',
         }
-        stats = self.stats
-        graph.update(dict((("%s.label" % s['_id'].replace('-', ''), s['_id']) for s in stats)))
-        graph.update(dict((("%s.draw" % s['_id'].replace('-', ''), "AREASTACK") for s in stats)))
-        graph['graph_order'] = ' '.join(sorted(s['_id'].replace('-', '') for s in stats))
+        stats = self.stats['servers']
+        graph.update(dict((("%s.label" % server.replace('-', ''), server) for server in stats)))
+        graph.update(dict((("%s.draw" % server.replace('-', ''), "AREASTACK") for server in stats)))
+        graph['graph_order'] = ' '.join(sorted(server.replace('-', '') for server in stats))
         return graph
 
     def calculate_metrics(self):
-        servers = dict((("%s" % s['_id'].replace('-', ''), s['feeds']) for s in self.stats))
-        servers['total'] = self.total[0]['feeds']
+        stats = self.stats
+        servers = dict((("%s" % server.replace('-', ''), s['fetches']) for server, s in stats['servers'].items()))
+        servers['total'] = stats['fetches']
         return servers
     
     @property
     def stats(self):
-        stats = settings.MONGOANALYTICSDB.nbanalytics.feed_fetches.aggregate([{
-            "$match": {
-                "date": {
-                    "$gte": datetime.datetime.now() - datetime.timedelta(minutes=5),
-                },
-            },
-        }, {
-            "$group": {
-                "_id"   : "$server",
-                "feeds" : {"$sum": 1},
-            },
-        }])
-        
-        return list(stats)
-        
-    @property
-    def total(self):
-        import datetime
-        from django.conf import settings
-        
-        stats = settings.MONGOANALYTICSDB.nbanalytics.feed_fetches.aggregate([{
-            "$match": {
-                "date": {
-                    "$gt": datetime.datetime.now() - datetime.timedelta(minutes=5),
-                },
-            },
-        }, {
-            "$group": {
-                "_id"   : 1,
-                "feeds" : {"$sum": 1},
-            },
-        }])
+        from apps.statistics.models import MAnalyticsFetcher
         
-        return list(stats)
+        return MAnalyticsFetcher.summarize(minutes=5)
         
 
 if __name__ == '__main__':
@@ -13,36 +13,22 @@ class NBMuninGraph(MuninGraph):
         }
 
         stats = self.stats
-        graph['graph_order'] = ' '.join(sorted(s['_id'] for s in stats))
-        graph.update(dict((("%s.label" % s['_id'], s['_id']) for s in stats)))
-        graph.update(dict((("%s.draw" % s['_id'], 'LINE1') for s in stats)))
+        graph['graph_order'] = ' '.join(sorted(stats.keys()))
+        graph.update(dict((("%s.label" % server, server) for server in stats)))
+        graph.update(dict((("%s.draw" % server, 'LINE1') for server in stats)))
 
         return graph
 
     def calculate_metrics(self):
-        servers = dict((("%s" % s['_id'], s['total']) for s in self.stats))
+        servers = dict((("%s" % server, s['total']) for server, s in self.stats.items()))
 
         return servers
     
     @property
     def stats(self):
-        import datetime
-        from django.conf import settings
+        from apps.statistics.models import MAnalyticsFetcher
         
-        stats = settings.MONGOANALYTICSDB.nbanalytics.feed_fetches.aggregate([{
-            "$match": {
-                "date": {
-                    "$gt": datetime.datetime.now() - datetime.timedelta(minutes=5),
-                },
-            },
-        }, {
-            "$group": {
-                "_id"   : "$server",
-                "total" : {"$avg": "$total"},
-            },
-        }])
-        
-        return list(stats)
+        return MAnalyticsFetcher.summarize(minutes=5)['servers']
         
 
 if __name__ == '__main__':
@@ -17,8 +17,9 @@ from vendor import reseekfile
 from utils import feedparser
 
 import hmac
+import numpy
 from binascii import hexlify
-from hashlib import sha1
+from hashlib import sha1, md5
 
 # COMMENTS_RE = re.compile('\<![ \r\n\t]*(--([^\-]|[\r\n]|-[^\-])*--[ \r\n\t]*)\>')
 COMMENTS_RE = re.compile('\<!--.*?--\>')
@@ -381,4 +382,40 @@ def create_signed_url(base_url, hmac_key, url):
     hex_url = hexlify(url.encode()).decode()
 
     return ('{base}/{signature}/{hex_url}'
-            .format(base=base_url, signature=signature, hex_url=hex_url))
\ No newline at end of file
+            .format(base=base_url, signature=signature, hex_url=hex_url))
+
+
+SIMHASH_TAGS_RE = re.compile(r'<[^>]*>')
+SIMHASH_WORDS_RE = re.compile(r'\w+', re.U)
+SIMHASH_MASK = (1 << 64) - 1
+
+def simhash(html, shingle_size=3):
+    """Returns a 64-bit SimHash of the words in a story, as a signed integer
+    so it fits in a MongoDB long. Near duplicate stories differ in only a
+    few bits. Returns None for stories without words.
+    """
+    words = SIMHASH_WORDS_RE.findall(SIMHASH_TAGS_RE.sub(' ', html or u'').lower())
+    if not words:
+        return None
+    shingles = set(u' '.join(words[i:i+shingle_size])
+                   for i in xrange(max(len(words) - shingle_size + 1, 1)))
+    hashes = numpy.array([int(md5(shingle.encode('utf-8')).hexdigest()[:16], 16)
+                          for shingle in shingles], dtype=numpy.uint64)
+    bits = numpy.unpackbits(hashes.view(numpy.uint8).reshape(-1, 8), axis=1)
+    majority = bits.sum(axis=0) * 2 > len(shingles)
+    fingerprint = int(numpy.packbits(majority).view(numpy.uint64)[0])
+    if fingerprint >= 1 << 63:
+        fingerprint -= 1 << 64
+    return fingerprint
+
+def simhash_distance(first, second):
+    return bin((first ^ second) & SIMHASH_MASK).count('1')
+
+def simhash_bands(fingerprint, bands=8):
+    """Splits a SimHash into bands. Two hashes within `bands - 1` bits of each
+    other share at least one band exactly, so bands work as lookup keys.
+    """
+    fingerprint &= SIMHASH_MASK
+    width = 64 / bands
+    return [(band, (fingerprint >> (band * width)) & ((1 << width) - 1))
+            for band in range(bands)]